@@ -2,8 +2,7 @@ import numpy as np
 import theano.tensor as T
 
 class NCE:
-  def __init__(self, batch_size, vocab_size, noise_dist, noise_sample_size):
-    self.batch_size = batch_size
+  def __init__(self, vocab_size, noise_dist, noise_sample_size):
     self.vocab_size = vocab_size
     self.noise_dist = noise_dist
     self.noise_sample_size = noise_sample_size
@@ -15,10 +14,21 @@ class NCE:
   def evaluate(self, O, Y, N):
     
     # w is the next word in the training data
-    pw = O[np.arange(0, self.batch_size), Y]
-    qw = self.noise_dist[Y]
+    pw = O[T.arange(Y.shape[0]), Y]
     # wb is the noise word in the noise samples
     pwb = T.take(O, N) # (noise_sample_size, )
+
+    return self.evaluate_sparse(pw, pwb, Y, N)
+
+  # same loss as evaluate, but only takes the entries of the network output that are actually read,
+  #   so that the caller doesn't have to compute the output over the whole vocabulary
+  # pw is the (unnormalized) probability of the next word,
+  #   should have shape of (batch_size,)
+  # pwb is the (unnormalized) probability of the noise sample,
+  #   should have shape of (noise_sample_size,)
+  def evaluate_sparse(self, pw, pwb, Y, N):
+
+    qw = self.noise_dist[Y]
     qwb = T.take(self.noise_dist, N) # (noise_sample_size, )
     
     # P(D = 1 | c, w)
@@ -27,4 +37,3 @@ class NCE:
     pd0 = (self.noise_sample_size * qwb) / (pwb + self.noise_sample_size * qwb) # (noise_sample_size, )
 
     return T.sum(T.log(pd1) + T.sum(T.log(pd0))) # scalar
-
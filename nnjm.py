@@ -5,17 +5,30 @@
 import argparse
 from collections import Counter
 import codecs
-from io import StringIO
+import ctypes
+import itertools
 import logging
 from loss import NCE
 from utils.numberizer import numberizer
 from utils.numberizer import TARGET_TYPE, SOURCE_TYPE
+from utils.heuristics import get_affiliations, get_all_affiliations, read_alignment, parse_alignment
+from utils.ragged import ragged
+from utils.prefetch import prefetch
+from utils import binfile
+from utils import cache
+from utils import textmatrix
 import numpy as np
 import pdb
 import cPickle as pickle
+import Queue
+import multiprocessing
+import os
+from multiprocessing.sharedctypes import RawArray
 import sys
 import theano
 import theano.tensor as T
+from theano.tensor.extra_ops import Unique
+import time
 import rand
 
 logging.basicConfig(
@@ -31,9 +44,11 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--target-file", "-tf", dest="target_file", metavar="PATH", help="file with target sentences.")
 parser.add_argument("--source-file", "-sf", dest="source_file", metavar="PATH", help="file with source sentences.")
 parser.add_argument("--alignment-file", "-af", dest="align_file", metavar="PATH", help="file with word alignments between source-target (giza style).")
-parser.add_argument("--model-file", "-mf", dest="model_file", metavar="PATH", help="file with already trained model as a initialization (moses style).")
-parser.add_argument("--vocab-file", "-vf", dest="vocab_file", metavar="PATH", help="if you have a pickled dictionary (numberizer), you can use it here.")
+parser.add_argument("--model-file", "-mf", dest="model_file", metavar="PATH", help="file with already trained model as a initialization (moses style, or binary, see nnjm_convert.py).")
+parser.add_argument("--vocab-file", "-vf", dest="vocab_file", metavar="PATH", help="if you have a pickled dictionary (numberizer), or one converted to the binary format by nnjm_convert.py, you can use it here.")
 parser.add_argument("--working-dir", "-w", dest="working_dir", metavar="PATH", help="Directory used to dump models etc.", required=True)
+parser.add_argument("--cache-dir", dest="cache_dir", metavar="PATH", help="Directory where the extracted training instances are cached, keyed by a hash of the corpora, the vocabulary and the context sizes (default = WORKING_DIR/cache).")
+parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Always extract the training instances from the corpora, and don't cache them (default = False).")
 parser.add_argument("--validation-target-file", "-vtf", dest="val_trg_file", metavar="PATH", help="Validation target corpus used for stopping criteria.")
 parser.add_argument("--validation-source-file", "-vsf", dest="val_src_file", metavar="PATH", help="Validation source corpus used for stopping criteria.")
 parser.add_argument("--validation-alignment-file", "-vaf", dest="val_align_file", metavar="PATH", help="Validation alignment corpus used for stopping criteria.")
@@ -49,6 +64,20 @@ parser.add_argument("--max-epoch", dest="max_epoch", type=int, metavar="INT", he
 parser.add_argument("--save-interval", dest="save_interval", type=int, metavar="INT", help="Saving model only for every several epochs (default = 1).")
 parser.add_argument("--batch-size", "-b", dest="batch_size", type=int, metavar="INT", help="Batch size (in sentences) of SGD (default = 1000).")
 parser.add_argument("--gradient-check", dest="gradient_check", type=int, metavar="INT", help="The iteration interval for gradient check. Pass 0 if gradient check should not be performed (default = 0).")
+parser.add_argument("--sparse-output", dest="sparse_output", action="store_true", help="Only compute and update the output rows of the labels and noise samples during training (default = False).")
+parser.add_argument("--sparse-input", dest="sparse_input", action="store_true", help="Only update the input embeddings of the words that appear in each batch (default = False).")
+parser.add_argument("--workers", dest="workers", type=int, metavar="INT", help="Number of processes running lock-free (hogwild) SGD on disjoint shards of the training data. Works best with --sparse-input and --sparse-output, and with single-threaded BLAS (default = 1).")
+parser.add_argument("--optimizer", dest="optimizer", choices=["sgd", "adagrad", "adam"], help="Update rule used for training. The adaptive optimizers keep their state for the rows of the embedding and output tables per row, and only update it for the rows touched by each batch in --sparse-input/--sparse-output mode (default = sgd).")
+parser.add_argument("--epsilon", dest="epsilon", type=float, metavar="FLOAT", help="Constant epsilon of adagrad and adam (default = 1e-8).")
+parser.add_argument("--adam-beta1", dest="adam_beta1", type=float, metavar="FLOAT", help="Decay rate of the first moment estimates of adam (default = 0.9).")
+parser.add_argument("--adam-beta2", dest="adam_beta2", type=float, metavar="FLOAT", help="Decay rate of the second moment estimates of adam (default = 0.999).")
+parser.add_argument("--self-norm-alpha", dest="self_norm_alpha", type=float, metavar="FLOAT", help="Weight of the squared log partition function penalty that trains the NNJM to be self-normalized (Devlin et al. 2014). Pass 0 to train with NCE only (default = 0.0).")
+parser.add_argument("--prefetch", dest="prefetch", type=int, metavar="INT", help="Number of batches (with their noise samples) prepared in the background ahead of the training step. Pass 0 to prepare them in the training loop (default = 4).")
+parser.add_argument("--prefetch-process", dest="prefetch_process", action="store_true", help="Prepare the batches in a separate process (default = True).")
+parser.add_argument("--prefetch-thread", dest="prefetch_process", action="store_false", help="Prepare the batches in a thread of the training process instead, which saves pickling them but doesn't overlap with the training step, since theano holds the GIL while it runs (default = False).")
+parser.add_argument("--shuffle-buffer", dest="shuffle_buffer", type=int, metavar="INT", help="Stream the training instances in chunks, and shuffle them through a buffer of this many instances, instead of loading and shuffling them all in memory. The chunks are read in a random order from the instance cache if it's there (see nnjm_preprocess.py), or extracted from the corpora in their order otherwise. Pass 0 to load them all (default = 0).")
+parser.add_argument("--binary-model", dest="binary_model", action="store_true", help="Also save the models in the binary format, as NNJM.model.N.bin, which loads much faster than the text format and is accepted by --model-file (default = False).")
+parser.add_argument("--processes", dest="processes", type=int, metavar="INT", help="Number of processes counting the vocabulary of the corpora and formatting the saved models (and, in nnjm_preprocess.py, extracting the shards of the corpora) (default = number of cores).")
 
 parser.set_defaults(
   learning_rate=0.001,
@@ -61,7 +90,21 @@ parser.set_defaults(
   tc_size=4,
   max_epoch=5,
   batch_size=1000,
-  save_interval=1)
+  save_interval=1,
+  no_cache=False,
+  sparse_output=False,
+  sparse_input=False,
+  workers=1,
+  self_norm_alpha=0.0,
+  optimizer="sgd",
+  epsilon=1e-8,
+  adam_beta1=0.9,
+  adam_beta2=0.999,
+  prefetch=4,
+  prefetch_process=True,
+  shuffle_buffer=0,
+  binary_model=False,
+  processes=multiprocessing.cpu_count())
 
 if theano.config.floatX=='float32':
   floatX = np.float32
@@ -70,16 +113,25 @@ else:
 
 class NNJM:
 
+  # loads the weights of a model file into this network, see load_weights
   def load(self, model_dir, noise_sample_size=100, batch_size=1000, noise_dist=[]):
-    self.load_model(model_dir)
+    self.load_weights(model_dir)
     self.noise_sample_size = noise_sample_size
     self.batch_size = batch_size
-    self.noise_dist = theano.shared(noise_dist, name='nd') \
-        if noise_dist != [] \
-        else theano.shared(np.array([floatX(1. / vocab_size)] * vocab_size, dtype=floatX), name = 'nd')
+    if len(noise_dist) > 0:
+      self.noise_dist.set_value(np.asarray(noise_dist, dtype=floatX), borrow=True)
 
   # the default noise_distribution is uniform
-  def __init__(self, num_inputs, vocab_size, target_vocab_size, word_dim=150, hidden_dim1=150, hidden_dim2=750, noise_sample_size=100, batch_size=1000, noise_dist=[]):
+  # sparse_output: only compute the output rows for the labels and the noise sample when training,
+  #   so that the cost of an update doesn't grow with the target vocabulary
+  # sparse_input: only update the embedding columns that appear in the batch,
+  #   so that the cost of an update doesn't grow with the input vocabulary
+  # self_norm_alpha: weight of the (log Z)^2 penalty added to the training objective, see __theano_init__
+  # optimizer: update rule of the sgd function, one of sgd, adagrad or adam, see optimizer_updates
+  # train: with train=False, only the functions that evaluate the network are compiled (e.g. to score with a loaded model),
+  #   and the weights start as zeros, whose memory isn't touched before load_weights replaces them
+  def __init__(self, num_inputs, vocab_size, target_vocab_size, word_dim=150, hidden_dim1=150, hidden_dim2=750, noise_sample_size=100, batch_size=1000, noise_dist=[], sparse_output=False, sparse_input=False, self_norm_alpha=0.0,
+      optimizer="sgd", epsilon=1e-8, adam_beta1=0.9, adam_beta2=0.999, train=True):
 
     self.num_inputs = num_inputs
     self.vocab_size = vocab_size
@@ -89,29 +141,44 @@ class NNJM:
     self.hidden_dim2 = hidden_dim2
     self.noise_sample_size = noise_sample_size
     self.batch_size = batch_size
+    self.sparse_output = sparse_output
+    self.sparse_input = sparse_input
+    self.self_norm_alpha = self_norm_alpha
+    self.optimizer = optimizer
+    self.epsilon = epsilon
+    self.adam_beta1 = adam_beta1
+    self.adam_beta2 = adam_beta2
+    self.train = train
+    # shared variables of the optimizer, see optimizer_updates
+    self.opt_state = []
+    if train:
+      init = lambda shape: np.random.uniform(-0.05, 0.05, shape).astype(floatX)
+    else:
+      init = lambda shape: np.zeros(shape, dtype=floatX)
     self.noise_dist = theano.shared(noise_dist, name='nd') \
         if noise_dist != [] \
         else theano.shared(np.array([floatX(1. / vocab_size)] * vocab_size, dtype=floatX), name = 'nd')
+    # the shared variables take the initial weights as they are (borrow), so the zeros aren't copied
     self.D = theano.shared(
-        np.random.uniform(-0.05, 0.05, (word_dim, vocab_size)).astype(floatX),
-        name = 'D')
+        init((word_dim, vocab_size)),
+        name = 'D', borrow = True)
     if hidden_dim1 > 0:
       self.C = theano.shared(
-          np.random.uniform(-0.05, 0.05, (hidden_dim1, word_dim * self.num_inputs)).astype(floatX),
-          name = 'C') 
+          init((hidden_dim1, word_dim * self.num_inputs)),
+          name = 'C', borrow = True)
     else:
       pass
 
     if hidden_dim1 > 0:
       self.M = theano.shared(
-          np.random.uniform(-0.05, 0.05, (hidden_dim2, hidden_dim1)).astype(floatX),
-          name = 'M')
+          init((hidden_dim2, hidden_dim1)),
+          name = 'M', borrow = True)
     else:
-      self.M = theano.shared(np.random.uniform(-0.05, 0.05, (hidden_dim2,  word_dim * self.num_inputs)).astype(floatX), name='M') 
+      self.M = theano.shared(init((hidden_dim2,  word_dim * self.num_inputs)), name='M', borrow=True)
 
     self.E = theano.shared(
-        np.random.uniform(-0.05, 0.05, (target_vocab_size, hidden_dim2)).astype(floatX),
-        name = 'E')
+        init((target_vocab_size, hidden_dim2)),
+        name = 'E', borrow = True)
 
     if hidden_dim1 > 0:
       self.Cb = theano.shared(
@@ -137,26 +204,38 @@ class NNJM:
     # XXX: new NCE loss shares one sample across the whole batch
     self.symN = T.lvector('N')
 
+    # biases are broadcasted over the batch, so the compiled functions accept any batch size
     if self.hidden_dim1 > 0:
-      CCb = T.tile(self.Cb, (1, self.batch_size)) # (hidden_dim1, batch_size)
+      CCb = T.addbroadcast(self.Cb, 1) # (hidden_dim1, 1)
     else:
       pass
 
-    MMb = T.tile(self.Mb, (1, self.batch_size)) # (hidden_dim2, batch_size)
-    EEb = T.tile(self.Eb, (1, self.batch_size)) # (target_vocab_size, batch_size)
+    MMb = T.addbroadcast(self.Mb, 1) # (hidden_dim2, 1)
+    EEb = T.addbroadcast(self.Eb, 1) # (target_vocab_size, 1)
     
-    Du = self.D.take(self.symX.T, axis = 1).T # (batch_size, num_inputs, word_dim)
+    if self.sparse_input:
+      # gather the embedding columns of the batch as a subtensor of D, so that they can be updated in place
+      self.symDs = self.D[:, T.flatten(self.symX)] # (word_dim, batch_size * num_inputs)
+      Dx = T.reshape(self.symDs.T, (self.symX.shape[0], self.num_inputs * self.word_dim)) # (batch_size, num_inputs * word_dim)
+    else:
+      Du = self.D.take(self.symX.T, axis = 1).T # (batch_size, num_inputs, word_dim)
+      Dx = T.flatten(Du, outdim=2) # (batch_size, num_inputs * word_dim) #TODO: T.flatten look into it...
 
     if self.hidden_dim1 > 0:
-      h1 = T.nnet.relu(self.C.dot(T.flatten(Du, outdim=2).T) + CCb) # (hidden_dim1, batch_size) #TODO: T.flatten look into it...
+      h1 = T.nnet.relu(self.C.dot(Dx.T) + CCb) # (hidden_dim1, batch_size)
       h2 = T.nnet.relu(self.M.dot(h1) + MMb) # (hidden_dim2, batch_size)
     else:
-      h2 = T.nnet.relu(self.M.dot(T.flatten(Du, outdim=2).T) + MMb) # (hidden_dim2, batch_size)
+      h2 = T.nnet.relu(self.M.dot(Dx.T) + MMb) # (hidden_dim2, batch_size)
 
-    O = T.exp(self.E.dot(h2) + EEb).T # (batch_size, target_vocab_size)
+    S = (self.E.dot(h2) + EEb).T # (batch_size, target_vocab_size)
+    O = T.exp(S) # (batch_size, target_vocab_size)
 
     predictions = T.argmax(O, axis=1)
     xent = T.sum(T.nnet.categorical_crossentropy(O, self.symY))
+    log_z = T.log(T.sum(O, axis=1)) # (batch_size, )
+    # log probability of each label, from the scores before exp and a stable log-sum-exp, so extreme scores don't overflow
+    S_max = T.max(S, axis=1) # (batch_size, )
+    log_prob = S[T.arange(self.symY.shape[0]), self.symY] - S_max - T.log(T.sum(T.exp(S - S_max.dimshuffle(0, 'x')), axis=1)) # (batch_size, )
 
     """
     YY = Y + self.offset # offset indexes used to construct pw and qw
@@ -172,362 +251,823 @@ class NNJM:
     """
 
     # XXX: use new NCE loss introduced in http://www.aclweb.org/anthology/N16-1145
-    lossfunc = NCE(self.batch_size, self.target_vocab_size, self.noise_dist, self.noise_sample_size)
+    lossfunc = NCE(self.target_vocab_size, self.noise_dist, self.noise_sample_size)
     loss = lossfunc.evaluate(O, self.symY, self.symN)
     # loss = T.sum(T.log(pd1) + T.sum(T.log(pd0), axis=1)) # scalar
 
-    self.symdD = T.grad(loss, self.D)
+    if self.sparse_output:
+      # only gather the rows of E/Eb that NCE actually reads: the labels, followed by the noise sample
+      self.symYN = T.concatenate([self.symY, self.symN]) # (batch_size + noise_sample_size, )
+      self.symEs = self.E[self.symYN] # (batch_size + noise_sample_size, hidden_dim2)
+      self.symEbs = self.Eb[self.symYN] # (batch_size + noise_sample_size, 1)
+      nY = self.symY.shape[0]
+      pw = T.exp(T.sum(self.symEs[:nY] * h2.T, axis=1) + self.symEbs[:nY, 0]) # (batch_size, )
+      sn = self.symEs[nY:].dot(h2) + T.addbroadcast(self.symEbs[nY:], 1) # (noise_sample_size, batch_size)
+      # same as T.take(O, N) in NCE.evaluate, the noise sample is scored against the first instance of the batch
+      pwb = T.exp(sn[:, 0]) # (noise_sample_size, )
+      train_loss = lossfunc.evaluate_sparse(pw, pwb, self.symY, self.symN)
+      # the partition function isn't available without the full output layer,
+      #   so it is estimated by importance sampling with the noise sample as proposal
+      qwb = T.take(self.noise_dist, self.symN).dimshuffle(0, 'x') # (noise_sample_size, 1)
+      train_log_z = T.log(T.mean(T.exp(sn) / qwb, axis=0)) # (batch_size, )
+    else:
+      train_loss = loss
+      train_log_z = log_z
+
+    # statistics returned by each training step: loss, mean log partition function and number of instances
+    self.symstats = [train_loss, T.mean(train_log_z), self.symY.shape[0]]
+
+    # self-normalization (Devlin et al. 2014): penalize (log Z)^2 so that log Z stays close to 0,
+    #   and the unnormalized output score of a single row can be used as a log probability when decoding
+    # the objective is maximized, hence the penalty is subtracted
+    # in sparse output mode, the penalty applies to the importance sampling estimate of log Z
+    if self.self_norm_alpha > 0:
+      objective = train_loss - self.self_norm_alpha * T.sum(T.sqr(train_log_z))
+    else:
+      objective = train_loss
+
+    # in sparse input mode, this is the gradient of the gathered columns (symDs) instead of the whole matrix
+    if self.sparse_input:
+      self.symdD = T.grad(objective, self.symDs)
+    else:
+      self.symdD = T.grad(objective, self.D)
     if self.hidden_dim1 > 0:
-      self.symdC = T.grad(loss, self.C)
+      self.symdC = T.grad(objective, self.C)
     else:
       pass
-    self.symdM = T.grad(loss, self.M)
-    self.symdE = T.grad(loss, self.E)
+    self.symdM = T.grad(objective, self.M)
+    # in sparse output mode, these are the gradients of the gathered rows (symEs, symEbs) instead of the whole matrix
+    if self.sparse_output:
+      self.symdE = T.grad(objective, self.symEs)
+    else:
+      self.symdE = T.grad(objective, self.E)
     if self.hidden_dim1 > 0:
-      self.symdCb = T.grad(loss, self.Cb)
-    self.symdMb = T.grad(loss, self.Mb)
-    self.symdEb = T.grad(loss, self.Eb)
+      self.symdCb = T.grad(objective, self.Cb)
+    self.symdMb = T.grad(objective, self.Mb)
+    if self.sparse_output:
+      self.symdEb = T.grad(objective, self.symEbs)
+    else:
+      self.symdEb = T.grad(objective, self.Eb)
     
     self.symlr = T.scalar('lr', dtype=theano.config.floatX)
 
     self.pred = theano.function(inputs = [self.symX], outputs = predictions)
     self.xent = theano.function(inputs = [self.symX, self.symY], outputs = xent)
     self.loss = theano.function(inputs = [self.symX, self.symY, self.symN], outputs = loss)
+    self.log_z = theano.function(inputs = [self.symX], outputs = log_z)
+    self.log_prob = theano.function(inputs = [self.symX, self.symY], outputs = log_prob)
+    # the cross entropy, NCE loss and log partition functions of a batch from a single forward pass, see validate
+    self.validation_stats = theano.function(inputs = [self.symX, self.symY, self.symN], outputs = [xent, loss, log_z])
     if self.hidden_dim1 > 0:
-      self.backprop = theano.function(inputs = [self.symX, self.symY, self.symN], outputs = [self.symdD, self.symdC, self.symdM, self.symdE, self.symdCb, self.symdMb, self.symdEb])
-      self.sgd = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = [], 
-          updates = [
-              (self.D, self.D + self.symlr * self.symdD),
-              (self.C, self.C + self.symlr * self.symdC),
-              (self.M, self.M + self.symlr * self.symdM),
-              (self.E, self.E + self.symlr * self.symdE),
-              (self.Cb, self.Cb + self.symlr * self.symdCb), 
-              (self.Mb, self.Mb + self.symlr * self.symdMb), 
-              (self.Eb, self.Eb + self.symlr * self.symdEb), 
-              ])
+      self.params = [self.D, self.C, self.M, self.E, self.Cb, self.Mb, self.Eb]
+      self.symgrads = [self.symdD, self.symdC, self.symdM, self.symdE, self.symdCb, self.symdMb, self.symdEb]
       self.weights = theano.function(inputs = [], outputs = [self.D, self.C, self.M, self.E, self.Cb, self.Mb, self.Eb])
-      
     else:
-      self.backprop = theano.function(inputs = [self.symX, self.symY, self.symN], outputs = [self.symdD, self.symdM, self.symdE, self.symdMb, self.symdEb])
-      self.sgd = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = [], 
-          updates = [
-              (self.D, self.D + self.symlr * self.symdD),
-              (self.M, self.M + self.symlr * self.symdM),
-              (self.E, self.E + self.symlr * self.symdE),
-              (self.Mb, self.Mb + self.symlr * self.symdMb), 
-              (self.Eb, self.Eb + self.symlr * self.symdEb), 
-              ])
+      self.params = [self.D, self.M, self.E, self.Mb, self.Eb]
+      self.symgrads = [self.symdD, self.symdM, self.symdE, self.symdMb, self.symdEb]
       self.weights = theano.function(inputs = [], outputs = [self.D, self.M, self.E, self.Mb, self.Eb])
 
-  def dump_matrix(self, m, model_file):
-      np.savetxt(model_file, m, fmt="%.6f", delimiter='\t')
-  
-  def dump(self, model_dir):
-      model_file = open(model_dir, 'w')
-  
-      # config
-      model_file.write("\\config\n")
-      model_file.write("version 1\n")
-      model_file.write("ngram_size {0}\n".format(self.num_inputs + 1))
-      model_file.write("input_vocab_size {0}\n".format(self.vocab_size))
-      model_file.write("output_vocab_size {0}\n".format(self.target_vocab_size))
-      model_file.write("input_embedding_dimension {0}\n".format(self.word_dim))
-      model_file.write("num_hidden {0}\n".format(self.hidden_dim1))
-      model_file.write("output_embedding_dimension {0}\n".format(self.hidden_dim2))
-      model_file.write("activation_function rectifier\n\n") # currently only supporting rectifier... 
-  
-      if self.hidden_dim1 > 0:
-        [D, C, M, E, Cb, Mb, Eb] = self.weights()
+    # the training functions (and the optimizer state) are only compiled for a network that is trained
+    if self.train:
+      self.backprop = theano.function(inputs = [self.symX, self.symY, self.symN], outputs = self.symgrads)
+      self.sgd = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = self.symstats, 
+          updates = self.optimizer_updates(self.symlr))
+      # same as sgd, but returns the gradients (in the same order as backprop) instead of applying them
+      # used by processes that update the weights outside of theano, see apply_grads
+      self.grads = theano.function(inputs = [self.symX, self.symY, self.symN], outputs = self.symstats + self.symgrads)
+
+  # symbolic updates moving every weight by lr * gradient
+  # in sparse output mode, only the rows of E/Eb that are read by the NCE loss are touched
+  # in sparse input mode, only the columns of D that appear in the batch are touched
+  def sgd_updates(self, lr):
+    if self.sparse_input:
+      D_update = T.inc_subtensor(self.symDs, lr * self.symdD)
+    else:
+      D_update = self.D + lr * self.symdD
+
+    if self.sparse_output:
+      E_update = T.inc_subtensor(self.symEs, lr * self.symdE)
+      Eb_update = T.inc_subtensor(self.symEbs, lr * self.symdEb)
+    else:
+      E_update = self.E + lr * self.symdE
+      Eb_update = self.Eb + lr * self.symdEb
+
+    if self.hidden_dim1 > 0:
+      return [
+          (self.D, D_update),
+          (self.C, self.C + lr * self.symdC),
+          (self.M, self.M + lr * self.symdM),
+          (self.E, E_update),
+          (self.Cb, self.Cb + lr * self.symdCb), 
+          (self.Mb, self.Mb + lr * self.symdMb), 
+          (self.Eb, Eb_update), 
+          ]
+    else:
+      return [
+          (self.D, D_update),
+          (self.M, self.M + lr * self.symdM),
+          (self.E, E_update),
+          (self.Mb, self.Mb + lr * self.symdMb), 
+          (self.Eb, Eb_update), 
+          ]
+
+  # symbolic updates of the weights (and the optimizer state) for the optimizer given to the constructor
+  #
+  # the embedding and output tables (D, E and Eb) keep their adagrad accumulator and adam second moment per row
+  #   (the mean over the row of the squared gradients) rather than per element, so that their state only costs one number per word,
+  #   except for the first moment of adam, which has the size of the table
+  # in sparse input/output mode, the state of the tables is only read and written for the rows touched by the batch:
+  #   adagrad needs no decay, so it is exact; adam defers the decay of a row until it is touched again,
+  #   so that its moments are the same as if they were decayed on every step, but the row doesn't move in between (lazy adam)
+  def optimizer_updates(self, lr):
+    if self.optimizer == "sgd":
+      return self.sgd_updates(lr)
+
+    self.opt_state = []
+    updates = []
+    if self.optimizer == "adam":
+      self.adam_step = theano.shared(np.int64(0), name = 'adam_step')
+      self.opt_state.append(self.adam_step)
+      step = self.adam_step + 1
+      updates.append((self.adam_step, step))
+      # bias correction of both moments, folded into the learning rate
+      lr = lr * T.cast(T.sqrt(1 - self.adam_beta2 ** step) / (1 - self.adam_beta1 ** step), theano.config.floatX)
+    else:
+      step = None
+
+    for param, grad in zip(self.params, self.symgrads):
+      if param is self.D:
+        rows = T.flatten(self.symX) if self.sparse_input else None
+        (update, state_updates) = self.table_updates(param, grad, rows, lr, step, transposed=True)
+      elif param is self.E or param is self.Eb:
+        rows = self.symYN if self.sparse_output else None
+        (update, state_updates) = self.table_updates(param, grad, rows, lr, step)
       else:
-        [D, M, E, Mb, Eb] = self.weights()
-  
-      # input_embeddings
-      model_file.write("\\input_embeddings\n")
-      self.dump_matrix(np.transpose(D), model_file)
-      model_file.write("\n")
-  
-      # hidden_weights 1
-      if self.hidden_dim1 > 0:
-        model_file.write("\\hidden_weights 1\n")
-        self.dump_matrix(C, model_file)
-        model_file.write("\n")
-  
-        # hidden_biases 1
-        model_file.write("\\hidden_biases 1\n")
-        self.dump_matrix(Cb, model_file)
-        model_file.write("\n")
+        (update, state_updates) = self.dense_updates(param, grad, lr)
+      updates.append((param, update))
+      updates += state_updates
+    return updates
+
+  def new_state(self, name, shape, broadcastable=None, dtype=floatX):
+    state = theano.shared(np.zeros(shape, dtype=dtype), name = name, broadcastable = broadcastable)
+    self.opt_state.append(state)
+    return state
+
+  # element-wise adagrad/adam update for a weight with a dense gradient
+  def dense_updates(self, param, grad, lr):
+    shape = param.get_value(borrow=True).shape
+    if self.optimizer == "adagrad":
+      acc = self.new_state(param.name + '_acc', shape)
+      acc_update = acc + T.sqr(grad)
+      return (param + lr * grad / (T.sqrt(acc_update) + self.epsilon), [(acc, acc_update)])
+    else:
+      m = self.new_state(param.name + '_m', shape)
+      v = self.new_state(param.name + '_v', shape)
+      m_update = self.adam_beta1 * m + (1 - self.adam_beta1) * grad
+      v_update = self.adam_beta2 * v + (1 - self.adam_beta2) * T.sqr(grad)
+      return (param + lr * m_update / (T.sqrt(v_update) + self.epsilon), [(m, m_update), (v, v_update)])
+
+  # row-wise adagrad/adam update for a table of shape (rows, cols), or (cols, rows) if transposed (as D)
+  # rows is None if grad is the gradient of the whole table,
+  #   otherwise grad holds the gradient of the given rows (which may repeat)
+  def table_updates(self, param, grad, rows, lr, step, transposed=False):
+    (num_rows, num_cols) = param.get_value(borrow=True).shape
+    if transposed:
+      (num_rows, num_cols) = (num_cols, num_rows)
+      (update, state_updates) = self.row_updates(param.name, param.T, grad.T, rows, num_rows, num_cols, lr, step)
+      return (update.T, state_updates)
+    else:
+      return self.row_updates(param.name, param, grad, rows, num_rows, num_cols, lr, step)
+
+  def row_updates(self, name, table, grad, rows, num_rows, num_cols, lr, step):
+    if rows is not None:
+      # sum up the gradients of repeated rows, so that the state of each row is updated once
+      (rows, inverse) = Unique(return_inverse=True)(rows)
+      grad = T.inc_subtensor(T.zeros((rows.shape[0], num_cols), dtype=grad.dtype)[inverse], grad)
+    sqr_grad = T.mean(T.sqr(grad), axis=1, keepdims=True) # (rows, 1)
+
+    if self.optimizer == "adagrad":
+      acc = self.new_state(name + '_acc', (num_rows, 1), broadcastable=(False, True))
+      if rows is None:
+        acc_update = acc + sqr_grad
+        return (table + lr * grad / (T.sqrt(acc_update) + self.epsilon), [(acc, acc_update)])
+      acc_rows = acc[rows] + sqr_grad
+      return (T.inc_subtensor(table[rows], lr * grad / (T.sqrt(acc_rows) + self.epsilon)),
+          [(acc, T.set_subtensor(acc[rows], acc_rows))])
+
+    m = self.new_state(name + '_m', (num_rows, num_cols))
+    v = self.new_state(name + '_v', (num_rows, 1), broadcastable=(False, True))
+    if rows is None:
+      m_update = self.adam_beta1 * m + (1 - self.adam_beta1) * grad
+      v_update = self.adam_beta2 * v + (1 - self.adam_beta2) * sqr_grad
+      return (table + lr * m_update / (T.sqrt(v_update) + self.epsilon), [(m, m_update), (v, v_update)])
+    # step of the last update of each row, to catch up with the decays it missed in the meantime
+    last = self.new_state(name + '_last', (num_rows,), dtype='int64')
+    elapsed = (step - last[rows]).dimshuffle(0, 'x') # (rows, 1)
+    m_rows = T.cast(self.adam_beta1 ** elapsed, theano.config.floatX) * m[rows] + (1 - self.adam_beta1) * grad
+    v_rows = T.cast(self.adam_beta2 ** elapsed, theano.config.floatX) * v[rows] + (1 - self.adam_beta2) * sqr_grad
+    return (T.inc_subtensor(table[rows], lr * m_rows / (T.sqrt(v_rows) + self.epsilon)),
+        [(m, T.set_subtensor(m[rows], m_rows)), (v, T.set_subtensor(v[rows], v_rows)), (last, T.set_subtensor(last[rows], step))])
+
+  # numpy counterpart of sgd_updates: add lr * gradients (as returned by grads) to the weights in place
+  def apply_grads(self, X, Y, N, grads, lr):
+    for param, grad in zip(self.params, grads):
+      w = param.get_value(borrow=True)
+      if param is self.D and self.sparse_input:
+        np.add.at(w.T, X.flatten(), lr * grad.T)
+      elif (param is self.E or param is self.Eb) and self.sparse_output:
+        np.add.at(w, np.concatenate([Y, N]), lr * grad)
       else:
-        # hidden_weights 2
-        model_file.write("\\hidden_weights 1\n")
-        self.dump_matrix(M, model_file)
-        model_file.write("\n")
-    
-        # hidden_biases 2
-        model_file.write("\\hidden_biases 1\n")
-        self.dump_matrix(Mb, model_file)
-        model_file.write("\n")
-  
-      # Made compliant to Moses-accepted format
-      # Note hidden_dim1 in the options is defined differently as in model file
-      if self.hidden_dim1 > 0: 
-        # hidden_weights 2
-        model_file.write("\\hidden_weights 2\n")
-        self.dump_matrix(M, model_file)
-        model_file.write("\n")
+        w += lr * grad
+
+  # replace the values of the weights (in the same order as backprop) without recompiling anything
+  def set_weights(self, weights):
+    for param, w in zip(self.params, weights):
+      param.set_value(w, borrow=True)
+
+  # move all the weights into shared memory, so that processes forked afterwards
+  #   read and update the same weights as this one (and each other)
+  # the compiled functions keep working since only the values of the shared variables are replaced
+  def share_memory(self):
+    for param in self.params:
+      w = param.get_value(borrow=True)
+      shared_w = np.frombuffer(RawArray(ctypes.c_char, w.nbytes), dtype=w.dtype).reshape(w.shape)
+      shared_w[...] = w
+      param.set_value(shared_w, borrow=True)
+
+  # the sizes of the network, see MODEL_CONFIG
+  def config(self):
+    return dict((name, getattr(self, name)) for name in MODEL_CONFIG)
+
+  # the current weights, named as the shared variables
+  def weight_dict(self):
+    return dict(zip(model_weight_names(self.hidden_dim1), self.weights()))
+
+  # saves the model in the Moses text format, formatted by that many processes
+  def dump(self, model_dir, processes=1):
+    write_text_model(model_dir, self.config(), self.weight_dict(), processes)
+
+  # saves the model in the binary format, which loads much faster, see write_binary_model
+  def dump_binary(self, model_dir):
+    write_binary_model(model_dir, self.config(), self.weight_dict())
+
+  # replaces the weights with those of a model file of either format (see read_model),
+  #   which must have the same sizes as this network, and resets the optimizer state, which belonged to the old weights
+  # the values of the shared variables are replaced, so the compiled functions use the new weights without being recompiled,
+  #   e.g. to switch checkpoints in a long-running process
+  # the arrays read from the file are used as they are (borrowed) when they have the right dtype:
+  #   the weights of a binary model stay memory-mapped copy-on-write, so its pages are shared with the page cache
+  #   (and other processes mapping the same file) until training writes to them, and the file is never modified
+  # (a read-only map wouldn't do, the compiled updates write to the weights in place without checking)
+  def load_weights(self, model_dir):
+    logging.info("loading model...")
+    (config, weights) = read_model(model_dir, mode='c')
+    differences = ["{0} {1} (network has {2})".format(name, config[name], getattr(self, name)) for name in MODEL_CONFIG if config[name] != getattr(self, name)]
+    if differences:
+      raise Exception("{0} doesn't fit the network: {1}".format(model_dir, ", ".join(differences)))
+    for (name, param) in zip(model_weight_names(self.hidden_dim1), self.params):
+      param.set_value(np.ascontiguousarray(weights[name], dtype=floatX), borrow=True)
+    self.reset_optimizer_state()
+    logging.info("model loaded")
+
+  # zeroes the adagrad accumulators, the adam moments and the adam steps, as for a new network
+  def reset_optimizer_state(self):
+    for state in self.opt_state:
+      value = state.get_value(borrow=True)
+      state.set_value(np.zeros(value.shape, dtype=value.dtype), borrow=True)
+
+# ==================== END OF NNJM CLASS DEF ====================
+
+# model files come in two formats:
+#   the Moses text format (the one the Moses feature function reads, see write_text_model), with every weight printed as %.6f
+#   and a binary format (see utils/binfile.py) with the same config and the weights as raw float32 arrays,
+#     named and shaped as the shared variables of the NNJM, which read_binary_model maps instead of parsing
+# nnjm_convert.py converts from one to the other
+
+BINARY_MODEL_VERSION = 1
+# the NNJM attributes saved as the config of a model
+MODEL_CONFIG = ["num_inputs", "vocab_size", "target_vocab_size", "word_dim", "hidden_dim1", "hidden_dim2"]
+
+def model_weight_names(hidden_dim1):
+  return ["D", "C", "M", "E", "Cb", "Mb", "Eb"] if hidden_dim1 > 0 else ["D", "M", "E", "Mb", "Eb"]
+
+# shapes of the weights of a model with the given config, as in NNJM.__init__
+def model_weight_shapes(config):
+  input_dim = config["word_dim"] * config["num_inputs"]
+  shapes = {"D": (config["word_dim"], config["vocab_size"]),
+      "E": (config["target_vocab_size"], config["hidden_dim2"]),
+      "Mb": (config["hidden_dim2"], 1),
+      "Eb": (config["target_vocab_size"], 1)}
+  if config["hidden_dim1"] > 0:
+    shapes.update({"C": (config["hidden_dim1"], input_dim), "M": (config["hidden_dim2"], config["hidden_dim1"]), "Cb": (config["hidden_dim1"], 1)})
+  else:
+    shapes["M"] = (config["hidden_dim2"], input_dim)
+  return shapes
+
+# the vocabulary sizes of a model config that differ from those of the numberizer nz, as messages
+#   (none if the model could have been trained with nz)
+def vocab_size_differences(config, nz):
+  sizes = [("vocab_size", len(nz.v2i)), ("target_vocab_size", len(nz.t2i))]
+  return ["{0} {1} (numberizer has {2})".format(name, config[name], size) for (name, size) in sizes if config[name] != size]
+
+# returns the config (see MODEL_CONFIG) and the weights (float32 arrays, named as the shared variables) of a model file of either format
+# mode only matters for the binary format, see read_binary_model
+def read_model(model_dir, mode='r'):
+  if binfile.is_binfile(model_dir):
+    return read_binary_model(model_dir, mode)
+  return read_text_model(model_dir)
+
+# the weights are memory maps of the file, read-only or copy-on-write (mode='c')
+def read_binary_model(model_dir, mode='r'):
+  (version, config, weights) = binfile.load(model_dir, "nnjm", mode)
+  if version > BINARY_MODEL_VERSION:
+    raise Exception("{0} has binary model version {1}, this code only reads up to version {2}".format(model_dir, version, BINARY_MODEL_VERSION))
+  return dict((str(name), value) for (name, value) in config.items()), weights
+
+def write_binary_model(model_dir, config, weights):
+  binfile.save(model_dir, "nnjm", BINARY_MODEL_VERSION, config,
+      [(name, np.asarray(weights[name], dtype=np.float32)) for name in model_weight_names(config["hidden_dim1"])])
+
+# with processes > 1, the matrices are formatted in parallel, see utils/textmatrix.py
+def write_text_model(model_dir, config, weights, processes=1):
+  # the strings and the matrices of the file, in order
+  items = []
+
+  # config
+  items.append("\\config\n")
+  items.append("version 1\n")
+  items.append("ngram_size {0}\n".format(config["num_inputs"] + 1))
+  items.append("input_vocab_size {0}\n".format(config["vocab_size"]))
+  items.append("output_vocab_size {0}\n".format(config["target_vocab_size"]))
+  items.append("input_embedding_dimension {0}\n".format(config["word_dim"]))
+  items.append("num_hidden {0}\n".format(config["hidden_dim1"]))
+  items.append("output_embedding_dimension {0}\n".format(config["hidden_dim2"]))
+  items.append("activation_function rectifier\n\n") # currently only supporting rectifier... 
+
+  # input_embeddings
+  items.append("\\input_embeddings\n")
+  items.append(np.transpose(weights["D"]))
+  items.append("\n")
+
+  # hidden_weights 1
+  if config["hidden_dim1"] > 0:
+    items.append("\\hidden_weights 1\n")
+    items.append(weights["C"])
+    items.append("\n")
+
+    # hidden_biases 1
+    items.append("\\hidden_biases 1\n")
+    items.append(weights["Cb"])
+    items.append("\n")
+  else:
+    # hidden_weights 2
+    items.append("\\hidden_weights 1\n")
+    items.append(weights["M"])
+    items.append("\n")
+
+    # hidden_biases 2
+    items.append("\\hidden_biases 1\n")
+    items.append(weights["Mb"])
+    items.append("\n")
+
+  # Made compliant to Moses-accepted format
+  # Note hidden_dim1 in the options is defined differently as in model file
+  if config["hidden_dim1"] > 0: 
+    # hidden_weights 2
+    items.append("\\hidden_weights 2\n")
+    items.append(weights["M"])
+    items.append("\n")
+
+    # hidden_biases 2
+    items.append("\\hidden_biases 2\n")
+    items.append(weights["Mb"])
+    items.append("\n")
+  else:
+    items.append("\\hidden_weights 2\n")
+    items.append("0.5\n")
+    items.append("\n")
     
-        # hidden_biases 2
-        model_file.write("\\hidden_biases 2\n")
-        self.dump_matrix(Mb, model_file)
-        model_file.write("\n")
-      else:
-        model_file.write("\\hidden_weights 2\n")
-        model_file.write("0.5\n")
-        model_file.write("\n")
-        
-        model_file.write("\\hidden_biases 2\n")
-        model_file.write("0.5\n")
-        model_file.write("\n")
-  
-      # output_weights
-      model_file.write("\\output_weights\n")
-      self.dump_matrix(E, model_file)
-      model_file.write("\n")
-  
-      # output_biases
-      model_file.write("\\output_biases\n")
-      self.dump_matrix(Eb, model_file)
-      model_file.write("\n")
-  
-      model_file.write("\\end")
-      model_file.close()
-
-  def load_matrix(self, model_file):
-    line = model_file.readline()
-    mstr = ""
-    while line.strip() != "":
-      mstr += line
+    items.append("\\hidden_biases 2\n")
+    items.append("0.5\n")
+    items.append("\n")
+
+  # output_weights
+  items.append("\\output_weights\n")
+  items.append(weights["E"])
+  items.append("\n")
+
+  # output_biases
+  items.append("\\output_biases\n")
+  items.append(weights["Eb"])
+  items.append("\n")
+
+  items.append("\\end")
+  with open(model_dir, 'w') as model_file:
+    textmatrix.write_items(model_file, items, processes)
+
+# parses the matrix that starts at the current line of model_file (and ends with a blank line) into a float32 array of the given shape
+# the lines are parsed block_size bytes at a time, straight into the preallocated array,
+#   so the extra memory doesn't grow with the size of the matrix
+def load_matrix(model_file, shape, block_size=1 << 22):
+  m = np.empty(shape, dtype=np.float32)
+  flat = m.reshape(-1)
+  filled = 0
+  line = model_file.readline()
+  while line.strip() != "":
+    lines = []
+    size = 0
+    while line.strip() != "" and size < block_size:
+      lines.append(line)
+      size += len(line)
       line = model_file.readline()
-    logging.info("read all lines for this matrix")
-    mstrio = StringIO(unicode(mstr))
-    return np.loadtxt(mstrio)
+    # sep=' ' matches any run of whitespace, tabs and newlines included
+    values = np.fromstring("".join(lines), dtype=np.float32, sep=' ')
+    if filled + len(values) > len(flat):
+      raise Exception("a matrix of shape {0} has more than {1} values".format(shape, len(flat)))
+    flat[filled: filled + len(values)] = values
+    filled += len(values)
+  if filled != len(flat):
+    raise Exception("a matrix of shape {0} has only {1} values".format(shape, filled))
+  return m
 
-  def load_model(self, model_dir):
-    model_file = open(model_dir)
+# the sections of the text format that hold each weight, which depend on whether there's a first hidden layer:
+#   without it, the only hidden layer (M) is written as the first one, and the second one is a placeholder
+def text_model_sections(hidden_dim1):
+  if hidden_dim1 > 0:
+    return {"input_embeddings": "D", "hidden_weights 1": "C", "hidden_biases 1": "Cb", "hidden_weights 2": "M", "hidden_biases 2": "Mb",
+        "output_weights": "E", "output_biases": "Eb"}
+  return {"input_embeddings": "D", "hidden_weights 1": "M", "hidden_biases 1": "Mb", "output_weights": "E", "output_biases": "Eb"}
 
-    logging.info("loading model...")
-    line = model_file.readline()
-    while line.strip() != "\\end":
+# the config of a model file of either format, without reading its weights
+def read_model_config(model_dir):
+  if binfile.is_binfile(model_dir):
+    return read_binary_model(model_dir)[0]
+  with open(model_dir) as model_file:
+    for line in iter(model_file.readline, ""):
       if line.strip() == "\\config":
-        line = model_file.readline()
-        while line.strip() != "":
-          pair = line.strip().split(' ')
-          if pair[0] == "ngram_size":
-            self.num_inputs = int(pair[1]) - 1
-          if pair[0] == "input_vocab_size":
-            self.vocab_size = int(pair[1])
-          if pair[0] == "output_vocab_size":
-            self.target_vocab_size = int(pair[1])
-          if pair[0] == "input_embedding_dimension":
-            self.word_dim = int(pair[1])
-          if pair[0] == "num_hidden":
-            self.hidden_dim1 = int(pair[1])
-          if pair[0] == "output_embedding_dimension":
-            self.hidden_dim2 = int(pair[1])
-          logging.info("config loaded")
-          line = model_file.readline()
-      if line.strip() == "\\input_embeddings":
-        logging.info("input loading...")
-        self.D = np.transpose(self.load_matrix(model_file))
-        logging.info("input loaded")
-      if line.strip() == "\\hidden_weights 1":
-        logging.info("hidden_W1 loading...")
-        self.C = self.load_matrix(model_file)
-        logging.info("hidden_W1 loaded")
-      if line.strip() == "\\hidden_biases 1":
-        logging.info("hidden_b1 loading...")
-        self.Cb = self.load_matrix(model_file)
-        logging.info("hidden_b1 loaded")
-      if line.strip() == "\\hidden_weights 2":
-	logging.info("hidden_W2 loading...")
-        self.M = self.load_matrix(model_file)
-	logging.info("hidden_W2 loaded")
-      if line.strip() == "\\hidden_biases 2":
-	logging.info("hidden_b2 loading...")
-        self.Mb = self.load_matrix(model_file)
-	logging.info("hidden_b2 loaded")
-      if line.strip() == "\\output_weights":
-	logging.info("output_W loading...")
-        self.E = self.load_matrix(model_file)
-	logging.info("output_W loaded")
-      if line.strip() == "\\output_biases":
-	logging.info("output_b loading...")
-        self.Eb = self.load_matrix(model_file)
-	logging.info("output_b loaded")
-      line = model_file.readline()
+        return read_text_config(model_file)
+  raise Exception("{0} has no config".format(model_dir))
 
-# ==================== END OF NNJM CLASS DEF ====================
+# reads the lines of the \config section of a text model, up to the empty line that ends it
+def read_text_config(model_file):
+  config = {}
+  line = model_file.readline()
+  while line.strip() != "":
+    pair = line.strip().split(' ')
+    if pair[0] == "ngram_size":
+      config["num_inputs"] = int(pair[1]) - 1
+    if pair[0] == "input_vocab_size":
+      config["vocab_size"] = int(pair[1])
+    if pair[0] == "output_vocab_size":
+      config["target_vocab_size"] = int(pair[1])
+    if pair[0] == "input_embedding_dimension":
+      config["word_dim"] = int(pair[1])
+    if pair[0] == "num_hidden":
+      config["hidden_dim1"] = int(pair[1])
+    if pair[0] == "output_embedding_dimension":
+      config["hidden_dim2"] = int(pair[1])
+    line = model_file.readline()
+  return config
 
-def shuffle(indexed_ngrams, predictions):
+def read_text_model(model_dir):
+  model_file = open(model_dir)
+  config = {}
+  weights = {}
+  sections = {}
+  line = model_file.readline()
+  while line and line.strip() != "\\end":
+    if line.strip() == "\\config":
+      config = read_text_config(model_file)
+      logging.info("config loaded")
+      sections = text_model_sections(config["hidden_dim1"])
+      shapes = model_weight_shapes(config)
+    elif line.startswith("\\") and line[1:].strip() in sections:
+      name = sections[line[1:].strip()]
+      logging.info("{0} loading...".format(line[1:].strip()))
+      if name == "D":
+        weights[name] = np.transpose(load_matrix(model_file, shapes[name][::-1]))
+      else:
+        weights[name] = load_matrix(model_file, shapes[name])
+    line = model_file.readline()
+  model_file.close()
+  missing = [name for name in model_weight_names(config["hidden_dim1"]) if name not in weights]
+  if missing:
+    raise Exception("{0} has no {1} weights".format(model_dir, ", ".join(missing)))
+  return config, weights
+
+# a random order of the instances: make_batches gathers each batch through it,
+#   instead of the whole data set being copied in a shuffled order on every epoch
+def shuffled_order(num_instances):
   logging.info("shuffling data... ")
-  arr = np.arange(len(indexed_ngrams))
-  np.random.shuffle(arr)
-  indexed_ngrams_shuffled = indexed_ngrams[arr, :]
-  predictions_shuffled = predictions[arr]
-  return (indexed_ngrams_shuffled, predictions_shuffled)
+  return np.random.permutation(num_instances)
+
+# yields the (X, Y, N) batches of an epoch, each with its own noise sample
+# the batches follow order (see shuffled_order) if given, or the order of the instances otherwise
+# the last batch may be smaller than batch_size
+def make_batches(indexed_ngrams, predictions, options, noise_sampler, order=None):
+  num_instances = len(indexed_ngrams) if order is None else len(order)
+  for start in range(0, num_instances, options.batch_size):
+    if order is None:
+      batch = slice(start, start + options.batch_size)
+    else:
+      # the order within a batch doesn't matter, and sorted indices gather with better locality
+      batch = np.sort(order[start: start + options.batch_size])
+    X = np.asarray(indexed_ngrams[batch], dtype='int64')
+    Y = np.asarray(predictions[batch], dtype='int64')
+    N = noise_sampler.sample((options.noise_sample_size,)) # (noise_sample_size, )
+    # N = noise_sampler.sample((options.batch_size, options.noise_sample_size)) # (batch_size, noise_sample_size)
+    yield (X, Y, N)
+
+# make_batches, prepared in the background as configured by --prefetch and --prefetch-process
+def prefetch_batches(indexed_ngrams, predictions, options, noise_sampler, order=None):
+  return prefetch(make_batches(indexed_ngrams, predictions, options, noise_sampler, order),
+      size=options.prefetch, process=options.prefetch_process)
+
+# streaming mode (--shuffle-buffer): the instances of an epoch come in chunks of (indexed_ngrams, predictions),
+#   so that memory is bounded by the shuffle buffer rather than by the size of the corpus
+
+# chunks of block_size instances of the (memory-mapped) instance arrays, in a random order
+def block_chunks(indexed_ngrams, predictions, block_size=10000):
+  starts = np.arange(0, len(indexed_ngrams), block_size)
+  np.random.shuffle(starts)
+  for start in starts:
+    yield (np.array(indexed_ngrams[start: start + block_size]), np.array(predictions[start: start + block_size]))
+
+# instances extracted from the training corpora on the fly, lines_per_chunk sentences at a time
+def corpus_chunks(nz, options, lines_per_chunk=1000):
+  with codecs.open(options.target_file, 'r', 'utf8') as target_file, \
+      codecs.open(options.source_file, 'r', 'utf8') as source_file, open(options.align_file) as align_file:
+    while True:
+      target_lines = list(itertools.islice(target_file, lines_per_chunk))
+      if not target_lines:
+        break
+      trnz_target = nz.numberize_lines(TARGET_TYPE, target_lines, flat=True)
+      trnz_source = nz.numberize_lines(SOURCE_TYPE, itertools.islice(source_file, lines_per_chunk), flat=True)
+      trnz_align = parse_alignment(itertools.islice(align_file, lines_per_chunk), flat=True)
+      yield make_training_instances(nz, trnz_align, trnz_target, trnz_source, tc_size=options.tc_size, sw_size=options.sw_size)
 
-def sgd(indexed_ngrams, predictions, net, options, epoch, noise_dist):
+# shuffles a stream of chunks through a buffer of buffer_size instances:
+#   once the buffer is full, each incoming instance takes the place of a random one in the buffer, which goes out instead
+def shuffle_buffer(chunks, buffer_size):
+  buffered = 0
+  for (indexed_ngrams, predictions) in chunks:
+    if buffered == 0:
+      buffer_ngrams = np.empty((buffer_size,) + indexed_ngrams.shape[1:], dtype=indexed_ngrams.dtype)
+      buffer_predictions = np.empty((buffer_size,), dtype=predictions.dtype)
+    count = min(buffer_size - buffered, len(indexed_ngrams))
+    buffer_ngrams[buffered: buffered + count] = indexed_ngrams[:count]
+    buffer_predictions[buffered: buffered + count] = predictions[:count]
+    buffered += count
+    for start in range(count, len(indexed_ngrams), buffer_size):
+      end = min(start + buffer_size, len(indexed_ngrams))
+      slots = np.random.permutation(buffer_size)[:end - start]
+      yield (buffer_ngrams[slots], buffer_predictions[slots])
+      buffer_ngrams[slots] = indexed_ngrams[start: end]
+      buffer_predictions[slots] = predictions[start: end]
+  if buffered > 0:
+    order = np.random.permutation(buffered)
+    yield (buffer_ngrams[order], buffer_predictions[order])
+
+# cuts a stream of chunks into the (X, Y, N) batches of make_batches
+def make_stream_batches(chunks, options, noise_sampler):
+  pending = []
+  for chunk in chunks:
+    pending.append(chunk)
+    if sum(len(predictions) for (_, predictions) in pending) >= options.batch_size:
+      indexed_ngrams = np.concatenate([ngrams for (ngrams, _) in pending])
+      predictions = np.concatenate([predictions for (_, predictions) in pending])
+      end = len(predictions) // options.batch_size * options.batch_size
+      for batch in make_batches(indexed_ngrams[:end], predictions[:end], options, noise_sampler):
+        yield batch
+      pending = [(indexed_ngrams[end:], predictions[end:])]
+  if pending:
+    indexed_ngrams = np.concatenate([ngrams for (ngrams, _) in pending])
+    predictions = np.concatenate([predictions for (_, predictions) in pending])
+    for batch in make_batches(indexed_ngrams, predictions, options, noise_sampler):
+      yield batch
+
+# the batches of an epoch in streaming mode, prepared in the background like prefetch_batches
+# indexed_ngrams and predictions are the cached instances, or None to extract them from the corpora
+def prefetch_stream_batches(indexed_ngrams, predictions, nz, options, noise_sampler):
+  if indexed_ngrams is not None:
+    chunks = block_chunks(indexed_ngrams, predictions)
+  else:
+    chunks = corpus_chunks(nz, options)
+  return prefetch(make_stream_batches(shuffle_buffer(chunks, options.shuffle_buffer), options, noise_sampler),
+      size=options.prefetch, process=options.prefetch_process)
+
+# batches are the (X, Y, N) of the epoch, see prefetch_batches and prefetch_stream_batches
+def sgd(batches, net, options, epoch):
   logging.info("epoch {0} started".format(epoch))  
   instance_count = 0
   batch_count = 0
-  # for performance issue, if the remaining data is smaller than batch_size, we just discard them
-  for start in range(0, len(indexed_ngrams), options.batch_size):
-    if len(indexed_ngrams) - start >= options.batch_size:
-      X = indexed_ngrams[start: start + options.batch_size]
-      Y = predictions[start: start + options.batch_size]
-      N = np.array(rand.distint(noise_dist, (options.noise_sample_size,)), dtype='int64') # (noise_sample_size, )
-      # N = np.array(rand.distint(noise_dist, (options.batch_size, options.noise_sample_size)), dtype='int64') # (batch_size, noise_sample_size)
-      net.sgd(X, Y, N, floatX(options.learning_rate))
-    instance_count += options.batch_size
+  total_loss = 0.0
+  total_log_z = 0.0
+  for (X, Y, N) in batches:
+    # the loss is the one before this update, which comes for free from the same forward pass
+    (loss, mean_log_z, count) = net.sgd(X, Y, N, floatX(options.learning_rate))
+    total_loss += loss
+    total_log_z += mean_log_z * count
+    instance_count += count
     batch_count += 1
     if batch_count % 1 == 0:
-      logging.info("{0} instances seen".format(instance_count))
-  # N = np.array(rand.distint(noise_dist, (len(indexed_ngrams), options.noise_sample_size)))
-  # total_loss = net.loss(indexed_ngrams, predictions, N)
-  # logging.info("epoch {0} finished with NCE loss {1}".format(epoch, total_loss))
-  logging.info("epoch {0} finished".format(epoch))
+      logging.info("{0} instances seen, NCE loss so far {1}".format(instance_count, total_loss))
+  logging.info("epoch {0} finished with NCE loss {1}, mean log partition function {2}"
+      .format(epoch, total_loss, total_log_z / max(instance_count, 1)))
+
+# order is the shard of the shuffled order this worker trains on
+def hogwild_worker(worker_id, indexed_ngrams, predictions, order, net, options, noise_sampler, results):
+  # forked workers inherit the random state, so each of them has to reseed to draw different noise samples
+  np.random.seed()
+  instance_count = 0
+  total_loss = 0.0
+  total_log_z = 0.0
+  for (X, Y, N) in prefetch_batches(indexed_ngrams, predictions, options, noise_sampler, order):
+    # no locking here: the weights are shared with the other workers, who may update them at the same time
+    outputs = net.grads(X, Y, N)
+    (loss, mean_log_z, count) = outputs[:3]
+    net.apply_grads(X, Y, N, outputs[3:], floatX(options.learning_rate))
+    total_loss += loss
+    total_log_z += mean_log_z * count
+    instance_count += count
+  logging.info("worker {0} finished with {1} instances seen".format(worker_id, instance_count))
+  results.put((total_loss, total_log_z, instance_count))
+
+# lock-free parallel SGD (Recht et al. 2011) with one process per shard of the shuffled order (see shuffled_order)
+# the weights must have been moved to shared memory with net.share_memory()
+def hogwild_sgd(indexed_ngrams, predictions, order, net, options, epoch, noise_sampler):
+  logging.info("epoch {0} started with {1} workers".format(epoch, options.workers))
+  start_time = time.time()
+  results = multiprocessing.Queue()
+  shard_size = (len(indexed_ngrams) + options.workers - 1) // options.workers
+  workers = []
+  for worker_id in range(options.workers):
+    shard = slice(worker_id * shard_size, (worker_id + 1) * shard_size)
+    # forked workers share the instance arrays with this process, only their shard of the order is theirs
+    worker = multiprocessing.Process(target=hogwild_worker,
+        args=(worker_id, indexed_ngrams, predictions, order[shard], net, options, noise_sampler, results))
+    worker.start()
+    workers.append(worker)
+
+  # the results are read before the workers are joined, since a worker doesn't exit until its result has left the queue,
+  #   and a failed worker never sends one: the others are then terminated rather than waited for
+  total_loss = 0.0
+  total_log_z = 0.0
+  instance_count = 0
+  num_results = 0
+  while num_results < len(workers):
+    try:
+      (loss, log_z, count) = results.get(timeout=1.0)
+    except Queue.Empty:
+      failed = [worker for worker in workers if worker.exitcode not in (None, 0)]
+      if failed:
+        for worker in workers:
+          if worker.is_alive():
+            worker.terminate()
+        logging.fatal("hogwild worker exited with code {0}".format(failed[0].exitcode))
+        sys.exit(1)
+      continue
+    total_loss += loss
+    total_log_z += log_z
+    instance_count += count
+    num_results += 1
+  for worker in workers:
+    worker.join()
+  elapsed = time.time() - start_time
+  logging.info("epoch {0} finished with NCE loss {1}, mean log partition function {2}, {3} instances/sec"
+      .format(epoch, total_loss, total_log_z / max(instance_count, 1), instance_count / elapsed))
 
-def validate(indexed_ngrams, predictions, net, options, epoch, noise_dist):
+# log Z statistics tell whether the unnormalized output scores can be used in place of log probabilities,
+#   which is the case when the mean is close to 0 and the variance is small
+def validate(indexed_ngrams, predictions, net, options, epoch, noise_sampler):
+  if len(indexed_ngrams) == 0:
+    logging.warning("no validation instances, skipping the validation upon completing epoch {0}".format(epoch))
+    return
   xent = 0.0
   loss = 0.0
-  for start in range(0, len(indexed_ngrams), options.batch_size):
-    if len(indexed_ngrams) - start >= options.batch_size:
-      X = indexed_ngrams[start: start + options.batch_size]
-      Y = predictions[start: start + options.batch_size]
-      N = np.array(rand.distint(noise_dist, (options.noise_sample_size,)), dtype='int64') # (noise_sample_size, )
-      xent += net.xent(X, Y)
-      loss += net.loss(X, Y, N)
-  logging.info("validation upon completing epoch {0}: cross entropy {1}, NCE loss {2}".format(epoch, xent, loss))
-
-def read_alignment(align_file):
-  n_align = []
-  with open(align_file) as f:
-    for line in f:
-      n = [(int(t.split('-')[0]), int(t.split('-')[1])) for t in line.strip().split()]
-      n_align.append(n)
-  return n_align
-
-def get_left_src(nz, src, a, w):
-  lsc =  src[a - w if a - w > 0 else 0: a]
-  if len(lsc) < w:
-    lsc = [nz.v2i[SOURCE_TYPE, nz.bos]] * (w - len(lsc)) + lsc
-  return lsc
-
-def get_right_src(nz, src, a, w):
-  rsc = src[a+1: a + 1 + w]
-  if len(rsc) < w:
-    rsc = rsc + [nz.v2i[SOURCE_TYPE, nz.eos]] * (w - len(rsc))
-  return rsc
-
-def get_nearest_src_align(ta2sa, idx):
-  assert idx not in ta2sa
-  for dist in range(1,100):
-    for d in [+1, -1]:
-      idx_d_dist = idx + (dist * d)
-      if idx_d_dist in ta2sa and len(ta2sa[idx_d_dist]) == 1:
-        #if target word is aligned to just one source word
-        return ta2sa[idx_d_dist][0]
-      elif idx_d_dist in ta2sa and len(ta2sa[idx_d_dist]) > 1:
-        #if target word is aligned to many source words, pick the middle alignment
-        _s = sorted(ta2sa[idx_d_dist])
-        return _s[int(len(_s)/2)]
-      else:
-        pass
-
-def get_effective_align(align, idx):
-  ta2sa = {}
-  sa2ta = {}
-  for sa,ta in align:
-    _s = ta2sa.get(ta, [])
-    _s.append(sa)
-    ta2sa[ta] = _s
-    _t = sa2ta.get(sa, [])
-    _t.append(ta)
-    sa2ta[sa] = _t
-  if idx in ta2sa and len(ta2sa[idx]) == 1:
-    #if target word is aligned to just one source word
-    return ta2sa[idx][0]
-  elif idx in ta2sa and len(ta2sa[idx]) > 1:
-    #if target word is aligned to many source words, pick the middle alignment
-    _s = sorted(ta2sa[idx])
-    return _s[int(len(_s)/2)]
-  elif idx not in ta2sa:
-    #if the target word is aligned to null
-    nearest_sa = get_nearest_src_align(ta2sa, idx)
-    return nearest_sa
-  else:
-    raise NotImplementedError
-
-def make_training_instances(nz, trnz_align, trnz_target, trnz_source, tc_size=4, sw_size=4):
-  input_contexts = []
-  output_labels = []
-  linen = 0
-  for trg, src, align in zip(trnz_target, trnz_source, trnz_align):
-    for idx in range(1, len(trg)):
-      tc = [] # contains target context
-      sc = [] # contains source context
-      tc = trg[idx - tc_size if idx - tc_size > 0 else 0 :idx]
-      if len(tc) < tc_size:
-        tc_pad = [nz.v2i[TARGET_TYPE,nz.bos]] * (tc_size - len(tc))
-        tc = tc_pad + tc
-      assert len(tc) == tc_size
-      h_a = get_effective_align(align, idx)
-      if h_a < len(src):
-        pass
-      else:
-        pdb.set_trace()
-      sc = get_left_src(nz, src, h_a,sw_size) 
-      sc += [src[h_a]] 
-      sc += get_right_src(nz, src, h_a, sw_size)
-      fullc = sc + tc
-      assert len(fullc) == tc_size + 1 + (2 * sw_size)
-      input_contexts.append(fullc)
-      output_labels.append(trg[idx])
-    linen += 1
-  return np.array(input_contexts), np.array(output_labels)
+  log_z = []
+  for (X, Y, N) in prefetch_batches(indexed_ngrams, predictions, options, noise_sampler):
+    (batch_xent, batch_loss, batch_log_z) = net.validation_stats(X, Y, N)
+    xent += batch_xent
+    loss += batch_loss
+    log_z.append(batch_log_z)
+  log_z = np.concatenate(log_z)
+  logging.info("validation upon completing epoch {0}: cross entropy {1}, NCE loss {2}, log partition function mean {3} variance {4}"
+      .format(epoch, xent, loss, np.mean(log_z), np.var(log_z)))
 
-def main(options):
+# the narrowest integer type that holds every vocabulary id of nz, usually uint16
+def instance_dtype(nz):
+  return np.min_scalar_type(len(nz.v2i) - 1)
+
+# windows[i] is a[i: i + w], as a read-only view on a (no copy)
+def sliding_windows(a, w):
+  return np.lib.stride_tricks.as_strided(a, shape=(len(a) - w + 1, w), strides=(a.strides[0], a.strides[0]), writeable=False)
+
+# each instance is the source window around the affiliated source word (sw_size words on each side),
+#   followed by the tc_size target words before the predicted one, padded with bos/eos at sentence boundaries
+# instances are written straight into preallocated arrays: each sentence is padded once,
+#   and its instances are gathered from sliding windows over the padded sentence by the affiliation indices
+# instances are stored in the narrowest integer type that holds the vocabulary ids (see instance_dtype) unless dtype is given
+# the corpora are either lists of lists, or raggeds from numberize_sent and read_alignment with flat=True,
+#   which are extracted by make_flat_training_instances
+def make_training_instances(nz, trnz_align, trnz_target, trnz_source, tc_size=4, sw_size=4, dtype=None):
+  if dtype is None:
+    dtype = instance_dtype(nz)
+  if isinstance(trnz_target, ragged):
+    return make_flat_training_instances(nz, trnz_align, trnz_target, trnz_source, tc_size, sw_size, dtype)
+  # as with zip, the sentences past the end of the shortest corpus are left out
+  num_sentences = min(len(trnz_target), len(trnz_source), len(trnz_align))
+  num_instances = sum(max(len(trg) - 1, 0) for trg in trnz_target[:num_sentences])
+  input_contexts = np.empty((num_instances, 2 * sw_size + 1 + tc_size), dtype=dtype)
+  output_labels = np.empty((num_instances,), dtype=dtype)
+  src_bos = [nz.v2i[SOURCE_TYPE, nz.bos]] * sw_size
+  src_eos = [nz.v2i[SOURCE_TYPE, nz.eos]] * sw_size
+  trg_bos = [nz.v2i[TARGET_TYPE, nz.bos]] * tc_size
+  start = 0
+  for linen, (trg, src, align) in enumerate(zip(trnz_target, trnz_source, trnz_align)):
+    if len(trg) < 2:
+      continue
+    end = start + len(trg) - 1
+    affiliations = get_affiliations(align, len(trg))[1:]
+    if np.any(affiliations < 0) or np.any(affiliations >= len(src)):
+      raise Exception("target words of sentence {0} have no affiliated source word: {1}".format(linen, affiliations))
+    src_windows = sliding_windows(np.array(src_bos + src + src_eos, dtype=dtype), 2 * sw_size + 1)
+    trg_windows = sliding_windows(np.array(trg_bos + trg, dtype=dtype), tc_size)
+    input_contexts[start: end, :2 * sw_size + 1] = src_windows[affiliations]
+    input_contexts[start: end, 2 * sw_size + 1:] = trg_windows[1: len(trg)]
+    output_labels[start: end] = trg[1:]
+    start = end
+  return input_contexts, output_labels
+
+# same instances as make_training_instances, gathered for the whole corpus at once, one column at a time
+def make_flat_training_instances(nz, trnz_align, trnz_target, trnz_source, tc_size, sw_size, dtype):
+  num_sentences = min(len(trnz_target), len(trnz_source), len(trnz_align))
+  # as with zip in make_training_instances, the sentences past the end of the shortest corpus are left out
+  (target, source, align) = [corpus.head(num_sentences) for corpus in [trnz_target, trnz_source, trnz_align]]
+  target_lengths = target.lengths()
+  source_lengths = source.lengths()
+  affiliations = get_all_affiliations(align, target_lengths)
+
+  # every target position but the first of each sentence is predicted
+  predicted = np.ones(target.offsets[-1] - target.offsets[0], dtype=bool)
+  predicted[(target.offsets[:-1] - target.offsets[0])[target_lengths > 0]] = False
+  positions = np.flatnonzero(predicted)
+  sentences = np.repeat(np.arange(num_sentences), target_lengths)[positions]
+  affiliations = affiliations[positions]
+  positions += target.offsets[0]
+  lengths = source_lengths[sentences]
+  invalid = (affiliations < 0) | (affiliations >= lengths)
+  if np.any(invalid):
+    linen = sentences[np.flatnonzero(invalid)[0]]
+    raise Exception("target words of sentence {0} have no affiliated source word: {1}".format(linen, affiliations[sentences == linen]))
+
+  input_contexts = np.empty((len(positions), 2 * sw_size + 1 + tc_size), dtype=dtype)
+  output_labels = target.values[positions].astype(dtype)
+  for k in range(-sw_size, sw_size + 1):
+    window = affiliations + k
+    column = source.values[source.offsets[sentences] + np.clip(window, 0, lengths - 1)]
+    column[window < 0] = nz.v2i[SOURCE_TYPE, nz.bos]
+    column[window >= lengths] = nz.v2i[SOURCE_TYPE, nz.eos]
+    input_contexts[:, sw_size + k] = column
+  starts = target.offsets[sentences]
+  for k in range(-tc_size, 0):
+    column = target.values[np.maximum(positions + k, starts)]
+    column[positions + k < starts] = nz.v2i[TARGET_TYPE, nz.bos]
+    input_contexts[:, 2 * sw_size + 1 + tc_size + k] = column
+  return input_contexts, output_labels
+
+# reads the corpora and extracts the training (and validation) instances
+# validation instances are None if no validation files are given
+# the instances and the noise distribution are cached (see utils/cache.py), so later runs on the same corpora,
+#   vocabulary and context sizes memory-map them instead of extracting them again
+# with stream=True, the training instances are None unless they're cached, see prefetch_stream_batches
+def load_data(options, stream=False):
   options.n_gram = options.sw_size * 2 + options.tc_size + 2
-  # collecting vocab
-  logging.info("start collecting vocabulary")
-  #indexed_ngrams = []
-  #predictions = []
-  if not options.vocab_file:
-    nz = numberizer(limit = options.vocab_size)
-    nz.build_vocab(TARGET_TYPE,options.target_file)
-    nz.build_vocab(SOURCE_TYPE,options.source_file)
+  names = instance_names(options)
+
+  arrays = None
+  if not options.no_cache:
+    cache_dir = instance_cache_dir(options)
+    vocab_file = options.vocab_file or os.path.join(cache_dir, "numberizer.pickle")
+    if os.path.exists(vocab_file):
+      arrays = cache.load_arrays(cache_dir, names)
+  if arrays is not None:
+    logging.info("loading cached training instances from {0}".format(cache_dir))
+    nz = numberizer.load(vocab_file)
+  elif stream:
+    # the cache entry stays incomplete without the training instances, so nothing is saved
+    names = [name for name in names if name not in ["input_contexts", "output_labels"]]
+    (nz, arrays) = extract_data(options, names)
   else:
-    nz = pickle.load(open(options.vocab_file))
-  
-  trnz_target = nz.numberize_sent(TARGET_TYPE, options.target_file)
-  trnz_source = nz.numberize_sent(SOURCE_TYPE, options.source_file)
-  trnz_align = read_alignment(options.align_file) 
+    (nz, arrays) = extract_data(options, names)
+    if not options.no_cache:
+      cache.save_arrays(cache_dir, names, arrays)
+      if not options.vocab_file:
+        pickle.dump(nz, open(vocab_file, 'wb'))
   if not options.vocab_file:
     pickle.dump(nz, open(options.working_dir + "/numberizer.pickle", 'wb'))
-  input_contexts, output_labels =  make_training_instances(nz, trnz_align, trnz_target, trnz_source, tc_size=options.tc_size, sw_size=options.sw_size)
-  if options.val_trg_file and options.val_src_file and options.val_align_file:
-    vanz_target = nz.numberize_sent(TARGET_TYPE, options.val_trg_file)
-    vanz_source = nz.numberize_sent(SOURCE_TYPE, options.val_src_file)
-    vanz_align = read_alignment(options.val_align_file)
-    val_input_contexts, val_output_labels =  make_training_instances(nz, vanz_align, vanz_target, vanz_source, tc_size=options.tc_size, sw_size=options.sw_size)
-  elif options.val_trg_file or options.val_src_file or options.val_align_file:
-    logging.fatal("You have to supply all three validation files (source, target, alignment) to trigger validation.")
-    sys.exit(1)
-
-  target_unigram_counts = np.zeros(len(nz.t2c), dtype=floatX)
-  for tw, tw_count in nz.t2c.iteritems():
-    t_idx = nz.t2i[tw]
-    target_unigram_counts[t_idx] = floatX(tw_count)
-  target_unigram_dist  = target_unigram_counts / np.sum(target_unigram_counts)
+  arrays = dict(zip(names, arrays))
+  target_unigram_dist = np.array(arrays["target_unigram_dist"])
   logging.info("vocabulary collection finished")
 
   # training
@@ -537,23 +1077,114 @@ def main(options):
       "We don't know what will happen to NNJM in that case, but for safety we'll decrease vocab_size as the vocabulary size in the corpus.")
   options.vocab_size = len(nz.v2i)
   options.target_vocab_size = len(nz.t2i)
+  return nz, arrays.get("input_contexts"), arrays.get("output_labels"), arrays.get("val_input_contexts"), arrays.get("val_output_labels"), target_unigram_dist
+
+def validation_files(options):
+  val_files = [options.val_trg_file, options.val_src_file, options.val_align_file]
+  if any(val_files) and not all(val_files):
+    logging.fatal("You have to supply all three validation files (source, target, alignment) to trigger validation.")
+    sys.exit(1)
+  return val_files
+
+# names of the arrays load_data reads from the cache (or extracts)
+def instance_names(options):
+  names = ["input_contexts", "output_labels", "target_unigram_dist"]
+  if all(validation_files(options)):
+    names += ["val_input_contexts", "val_output_labels"]
+  return names
+
+# version of the extraction and storage of the cached instances (here and in nnjm_tune.py), part of the cache keys:
+#   bump it whenever the instances extracted from the same corpora, or their dtypes, change,
+#   so that entries written by older code are extracted again instead of being reused
+INSTANCE_CACHE_VERSION = 2
+
+# the cache directory of the instances extracted from the corpora with these options
+def instance_cache_dir(options):
+  key = cache.digest([options.target_file, options.source_file, options.align_file] + validation_files(options) + [options.vocab_file],
+      "nnjm training instances", INSTANCE_CACHE_VERSION, options.vocab_size, options.tc_size, options.sw_size)
+  return os.path.join(options.cache_dir or os.path.join(options.working_dir, "cache"), key)
 
+# builds the numberizer (unless given) and the arrays named in names from the corpora
+def extract_data(options, names):
+  nz = get_numberizer(options)
+  arrays = {}
+  if "input_contexts" in names:
+    trnz_target = nz.numberize_sent(TARGET_TYPE, options.target_file, flat=True)
+    trnz_source = nz.numberize_sent(SOURCE_TYPE, options.source_file, flat=True)
+    trnz_align = read_alignment(options.align_file, flat=True)
+    arrays["input_contexts"], arrays["output_labels"] = make_training_instances(nz, trnz_align, trnz_target, trnz_source, tc_size=options.tc_size, sw_size=options.sw_size)
+  if "val_input_contexts" in names:
+    vanz_target = nz.numberize_sent(TARGET_TYPE, options.val_trg_file, flat=True)
+    vanz_source = nz.numberize_sent(SOURCE_TYPE, options.val_src_file, flat=True)
+    vanz_align = read_alignment(options.val_align_file, flat=True)
+    arrays["val_input_contexts"], arrays["val_output_labels"] = make_training_instances(nz, vanz_align, vanz_target, vanz_source, tc_size=options.tc_size, sw_size=options.sw_size)
+
+  arrays["target_unigram_dist"] = get_target_unigram_dist(nz)
+  return nz, [arrays[name] for name in names]
+
+# builds the numberizer from the training corpora, unless one is given with --vocab-file
+def get_numberizer(options):
+  # collecting vocab
+  logging.info("start collecting vocabulary")
+  if not options.vocab_file:
+    nz = numberizer(limit = options.vocab_size)
+    nz.build_vocabs([(TARGET_TYPE, options.target_file), (SOURCE_TYPE, options.source_file)], options.processes)
+  else:
+    nz = numberizer.load(options.vocab_file)
+  return nz
+
+def get_target_unigram_dist(nz):
+  target_unigram_counts = np.zeros(len(nz.t2c), dtype=floatX)
+  (t_idx, tw_count) = nz.target_counts()
+  target_unigram_counts[t_idx] = tw_count
+  return target_unigram_counts / np.sum(target_unigram_counts)
+
+def build_net(options, nz, target_unigram_dist):
   logging.info("start training with n-gram size {0}, vocab size {1}, learning rate {2}, "
       .format(options.n_gram, len(nz.v2i), options.learning_rate) + 
       "word dimension {0}, hidden dimension 1 {1}, hidden dimension 2 {2}, noise sample size {3}"
       .format(options.word_dim, options.hidden_dim1, options.hidden_dim2, options.noise_sample_size))
   net = NNJM(options.n_gram - 1, len(nz.v2i), len(nz.t2i), options.word_dim, options.hidden_dim1, options.hidden_dim2,
-      options.noise_sample_size, options.batch_size, target_unigram_dist)
+      options.noise_sample_size, options.batch_size, target_unigram_dist,
+      sparse_output=options.sparse_output, sparse_input=options.sparse_input, self_norm_alpha=options.self_norm_alpha,
+      optimizer=options.optimizer, epsilon=options.epsilon, adam_beta1=options.adam_beta1, adam_beta2=options.adam_beta2)
   if not options.model_file == None:
     net.load(options.model_file, options.noise_sample_size, options.batch_size, target_unigram_dist)
+  return net
+
+def main(options):
+  # gradients computed by the workers are applied by apply_grads, which only knows plain sgd
+  if options.workers > 1 and options.optimizer != "sgd":
+    logging.fatal("Hogwild training only supports --optimizer sgd.")
+    sys.exit(1)
+  if options.workers > 1 and options.shuffle_buffer > 0:
+    logging.fatal("Hogwild training doesn't support --shuffle-buffer.")
+    sys.exit(1)
+  stream = options.shuffle_buffer > 0
+  nz, input_contexts, output_labels, val_input_contexts, val_output_labels, target_unigram_dist = load_data(options, stream=stream)
+  if stream:
+    logging.info("streaming the training instances {0}, shuffled through a buffer of {1} instances"
+        .format("from the cache" if input_contexts is not None else "from the corpora", options.shuffle_buffer))
+  net = build_net(options, nz, target_unigram_dist)
+  noise_sampler = rand.distsampler(target_unigram_dist)
   nz.save_vocab_in_moses_format(options.working_dir + "/vocab")
+  if options.workers > 1:
+    net.share_memory()
   for epoch in range(1, options.max_epoch + 1):
-    (input_contexts_shuffled, output_labels_shuffled) = shuffle(input_contexts, output_labels)
-    sgd(input_contexts_shuffled, output_labels_shuffled, net, options, epoch, target_unigram_dist)
+    if stream:
+      sgd(prefetch_stream_batches(input_contexts, output_labels, nz, options, noise_sampler), net, options, epoch)
+    else:
+      order = shuffled_order(len(input_contexts))
+      if options.workers > 1:
+        hogwild_sgd(input_contexts, output_labels, order, net, options, epoch, noise_sampler)
+      else:
+        sgd(prefetch_batches(input_contexts, output_labels, options, noise_sampler, order), net, options, epoch)
     if options.val_trg_file and options.val_src_file and options.val_align_file:
-      validate(val_input_contexts, val_output_labels, net, options, epoch, target_unigram_dist)
+      validate(val_input_contexts, val_output_labels, net, options, epoch, noise_sampler)
     if epoch % options.save_interval == 0:
-      net.dump(options.working_dir + "/NNJM.model." + str(epoch))
+      net.dump(options.working_dir + "/NNJM.model." + str(epoch), options.processes)
+      if options.binary_model:
+        net.dump_binary(options.working_dir + "/NNJM.model." + str(epoch) + ".bin")
   logging.info("training finished")
 
 if __name__ == "__main__":
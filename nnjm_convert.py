@@ -0,0 +1,85 @@
+# NNJM -- conversion between the file formats of the vocabularies (numberizers) and of the models
+#
+# vocab: converts a pickled numberizer (e.g. the numberizer.pickle written by nnjm.py) to the binary format
+#   of numberizer.save_binary, which --vocab-file and --numberizer-file also accept, or a binary one back to a pickle;
+#   the converted file is read back and compared to the input before the command succeeds
+# model: converts a model in the Moses text format (e.g. NNJM.model.N) to the binary format of nnjm.write_binary_model,
+#   which --model-file also accepts, or a binary one to the text format (Moses reads the text format only);
+#   the converted model is read back and compared to the input: weights converted to binary have to be
+#   the same float32 values, and weights converted to text the same up to the 6 decimals of the text format
+#
+# usage: python nnjm_convert.py {vocab,model} INPUT_FILE OUTPUT_FILE
+
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+import sys
+import time
+from utils.numberizer import numberizer
+from utils import binfile
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("what", choices=["vocab", "model"], help="What kind of file to convert.")
+parser.add_argument("input_file", metavar="INPUT_FILE", help="File to convert, its format is detected.")
+parser.add_argument("output_file", metavar="OUTPUT_FILE", help="Converted file, in the binary format if the input is in the other one and vice versa.")
+
+# the dicts of a numberizer, as plain dicts
+def vocab_dicts(nz):
+  return [dict(d.iteritems()) for d in [nz.v2i, nz.t2i, nz.t2c, nz.s2i, nz.s2c]] + [nz.limit, nz.unk, nz.bos, nz.eos]
+
+def convert_vocab(input_file, output_file):
+  nz = numberizer.load(input_file)
+  if binfile.is_binfile(input_file):
+    for name in ["v2i", "t2i", "t2c", "s2i", "s2c"]:
+      setattr(nz, name, dict(getattr(nz, name).iteritems()))
+    numberizer.save(nz, output_file)
+  else:
+    nz.save_binary(output_file)
+  if vocab_dicts(numberizer.load(output_file)) != vocab_dicts(nz):
+    logging.fatal("{0} doesn't hold the same vocabulary as {1}".format(output_file, input_file))
+    sys.exit(1)
+  logging.info("converted the vocabulary of {0} words in {1} to {2}".format(len(nz.v2i), input_file, output_file))
+
+def convert_model(input_file, output_file):
+  # imported here, so that converting a vocabulary doesn't need theano
+  import nnjm
+  start_time = time.time()
+  (config, weights) = nnjm.read_model(input_file)
+  logging.info("read {0} in {1:.2f}s".format(input_file, time.time() - start_time))
+  to_binary = not binfile.is_binfile(input_file)
+  start_time = time.time()
+  if to_binary:
+    nnjm.write_binary_model(output_file, config, weights)
+  else:
+    nnjm.write_text_model(output_file, config, weights, multiprocessing.cpu_count())
+  logging.info("wrote {0} in {1:.2f}s".format(output_file, time.time() - start_time))
+
+  (converted_config, converted_weights) = nnjm.read_model(output_file)
+  if converted_config != config or sorted(converted_weights.keys()) != sorted(weights.keys()):
+    logging.fatal("{0} doesn't have the same config and weights as {1}".format(output_file, input_file))
+    sys.exit(1)
+  for name in weights:
+    if to_binary:
+      same = np.array_equal(converted_weights[name], weights[name])
+    else:
+      # rounding to 6 decimals, and back to the nearest float32
+      same = np.allclose(converted_weights[name], weights[name], rtol=1e-6, atol=5.1e-7)
+    if not same:
+      logging.fatal("weights {0} of {1} differ from those of {2}".format(name, output_file, input_file))
+      sys.exit(1)
+  logging.info("converted the model in {0} to {1}".format(input_file, output_file))
+
+def main(options):
+  if options.what == "vocab":
+    convert_vocab(options.input_file, options.output_file)
+  else:
+    convert_model(options.input_file, options.output_file)
+
+if __name__ == "__main__":
+  options = parser.parse_args()
+  main(options)
@@ -0,0 +1,240 @@
+# NNJM -- data-parallel training through a parameter server
+#
+# the parameter server keeps the reference copy of the weights and is served over TCP,
+#   so the workers can run on other hosts as well as on the same machine (--ps-role local)
+#
+# sync mode: on each step, every worker pushes its gradients and waits for those of all the other workers,
+#   then the server and each worker apply the averaged update, so all the copies stay identical
+# async mode: workers apply their own gradients locally and push them to the server, which applies them as they come,
+#   a worker pulls fresh weights as soon as it misses more than --max-staleness updates from the others
+#
+# for remote workers (--ps-role worker), pass the numberizer.pickle written by the server as --vocab-file,
+#   so that they extract the same training instances
+
+import logging
+from multiprocessing.managers import BaseManager
+import multiprocessing
+import numpy as np
+import sys
+import threading
+import time
+from nnjm import parser, load_data, build_net, shuffled_order, validate, prefetch_batches, floatX
+import rand
+
+parser.add_argument("--ps-role", dest="ps_role", choices=["local", "server", "worker"], help="local: run the parameter server and all the workers on this machine; server: only run the parameter server; worker: only run the worker --worker-id (default = local).")
+parser.add_argument("--ps-address", dest="ps_address", metavar="HOST:PORT", help="Address of the parameter server (default = localhost:5790).")
+parser.add_argument("--ps-authkey", dest="ps_authkey", metavar="STRING", help="Shared secret between the parameter server and the workers (default = nnjm).")
+parser.add_argument("--worker-id", dest="worker_id", type=int, metavar="INT", help="The shard of the training data this worker trains on, from 0 to workers - 1 (default = 0).")
+parser.add_argument("--sync-mode", dest="sync_mode", choices=["sync", "async"], help="Whether the workers synchronize on every step or push their updates asynchronously (default = sync).")
+parser.add_argument("--max-staleness", dest="max_staleness", type=int, metavar="INT", help="Async mode only: a worker pulls fresh weights when it misses more than this many updates from the other workers (default = 10).")
+
+parser.set_defaults(
+  ps_role="local",
+  ps_address="localhost:5790",
+  ps_authkey="nnjm",
+  worker_id=0,
+  sync_mode="sync",
+  max_staleness=10)
+
+class ParameterServerManager(BaseManager):
+  pass
+
+class ParameterServer:
+
+  def __init__(self, net, num_workers, sync_mode, learning_rate):
+    self.net = net
+    self.num_workers = num_workers
+    self.sync_mode = sync_mode
+    self.learning_rate = learning_rate
+    self.cond = threading.Condition()
+    self.version = 0 # number of updates applied so far
+    self.epoch = 1
+    self.active = num_workers # number of workers that haven't finished the current epoch
+    self.pending = [] # gradients pushed for the current step (sync mode)
+    self.step_grads = [] # gradients of the last finished step (sync mode)
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.start_time = time.time()
+    self.instance_count = 0
+    self.total_loss = 0.0
+    self.wait_time = 0.0
+    self.staleness = []
+
+  def pull(self):
+    with self.cond:
+      return self.version, [param.get_value() for param in self.net.params]
+
+  # X, Y and N are needed to apply sparse gradients, see NNJM.apply_grads
+  # version is the number of updates the worker's weights have seen (async mode)
+  # sync mode: blocks until every other active worker pushed, returns all the gradients of this step
+  # async mode: applies the gradients right away, returns the number of updates applied so far
+  def push(self, X, Y, N, grads, loss, version):
+    with self.cond:
+      self.instance_count += len(Y)
+      self.total_loss += loss
+      if self.sync_mode == "sync":
+        start_time = time.time()
+        step = self.version
+        self.pending.append((X, Y, N, grads))
+        if len(self.pending) == self.active:
+          self.finish_step()
+        while self.version == step:
+          self.cond.wait()
+        self.wait_time += time.time() - start_time
+        return self.step_grads
+      else:
+        self.staleness.append(self.version - version)
+        self.net.apply_grads(X, Y, N, grads, floatX(self.learning_rate))
+        self.version += 1
+        return self.version
+
+  # should be called with self.cond acquired
+  def finish_step(self):
+    self.step_grads = self.pending
+    self.pending = []
+    apply_step(self.net, self.step_grads, self.learning_rate)
+    self.version += 1
+    self.cond.notify_all()
+
+  # called by each worker at the end of the epoch, blocks until the server starts the next epoch
+  def finish_epoch(self):
+    with self.cond:
+      epoch = self.epoch
+      self.active -= 1
+      # the other workers may be waiting for this one to finish the step
+      if self.sync_mode == "sync" and self.active > 0 and len(self.pending) == self.active:
+        self.finish_step()
+      self.cond.notify_all()
+      while self.epoch == epoch:
+        self.cond.wait()
+
+  # called by the server, blocks until every worker finished the epoch
+  def wait_epoch(self):
+    with self.cond:
+      while self.active > 0:
+        self.cond.wait()
+
+  def next_epoch(self):
+    with self.cond:
+      self.active = self.num_workers
+      self.epoch += 1
+      self.reset_stats()
+      self.cond.notify_all()
+
+# ==================== END OF PARAMETER SERVER CLASS DEF ====================
+
+def parse_address(address):
+  (host, port) = address.rsplit(':', 1)
+  return (host, int(port))
+
+def serve(ps, options):
+  ParameterServerManager.register("parameter_server", callable=lambda: ps)
+  manager = ParameterServerManager(address=parse_address(options.ps_address), authkey=options.ps_authkey)
+  server = manager.get_server()
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  logging.info("parameter server listening on {0}".format(options.ps_address))
+
+def connect(options):
+  ParameterServerManager.register("parameter_server")
+  manager = ParameterServerManager(address=parse_address(options.ps_address), authkey=options.ps_authkey)
+  manager.connect()
+  return manager.parameter_server()
+
+# apply the gradients pushed by every worker for one sync step, averaged
+def apply_step(net, step_grads, learning_rate):
+  for (X, Y, N, grads) in step_grads:
+    net.apply_grads(X, Y, N, grads, floatX(learning_rate / len(step_grads)))
+
+def run_worker(worker_id, input_contexts, output_labels, net, options, noise_sampler):
+  ps = connect(options)
+  # forked workers inherit the random state, so each of them has to reseed to draw different noise samples
+  np.random.seed()
+  shard_size = (len(input_contexts) + options.workers - 1) // options.workers
+  shard = slice(worker_id * shard_size, (worker_id + 1) * shard_size)
+  (input_contexts, output_labels) = (input_contexts[shard], output_labels[shard])
+
+  for epoch in range(1, options.max_epoch + 1):
+    (version, weights) = ps.pull()
+    net.set_weights(weights)
+    local_steps = 0 # updates applied locally since the last pull (async mode)
+    instance_count = 0
+    compute_time = 0.0
+    start_time = time.time()
+    order = shuffled_order(len(input_contexts))
+    for (X, Y, N) in prefetch_batches(input_contexts, output_labels, options, noise_sampler, order):
+      compute_start_time = time.time()
+      outputs = net.grads(X, Y, N)
+      compute_time += time.time() - compute_start_time
+      (loss, _, count) = outputs[:3]
+      if options.sync_mode == "sync":
+        apply_step(net, ps.push(X, Y, N, outputs[3:], float(loss), version), options.learning_rate)
+      else:
+        net.apply_grads(X, Y, N, outputs[3:], floatX(options.learning_rate))
+        ps_version = ps.push(X, Y, N, outputs[3:], float(loss), version + local_steps)
+        local_steps += 1
+        if ps_version - (version + local_steps) > options.max_staleness:
+          (version, weights) = ps.pull()
+          net.set_weights(weights)
+          local_steps = 0
+      instance_count += count
+    elapsed = time.time() - start_time
+    logging.info("worker {0} finished epoch {1}: {2} instances/sec, {3:.1f}% of the time spent computing gradients"
+        .format(worker_id, epoch, instance_count / elapsed, 100.0 * compute_time / elapsed))
+    ps.finish_epoch()
+
+def main(options):
+  # gradients computed by the workers are applied by apply_grads, which only knows plain sgd
+  if options.optimizer != "sgd":
+    logging.fatal("Distributed training only supports --optimizer sgd.")
+    sys.exit(1)
+  nz, input_contexts, output_labels, val_input_contexts, val_output_labels, target_unigram_dist = load_data(options)
+  net = build_net(options, nz, target_unigram_dist)
+  noise_sampler = rand.distsampler(target_unigram_dist)
+  if options.ps_role == "worker":
+    run_worker(options.worker_id, input_contexts, output_labels, net, options, noise_sampler)
+    return
+
+  nz.save_vocab_in_moses_format(options.working_dir + "/vocab")
+  ps = ParameterServer(net, options.workers, options.sync_mode, options.learning_rate)
+  serve(ps, options)
+  workers = []
+  if options.ps_role == "local":
+    for worker_id in range(options.workers):
+      worker = multiprocessing.Process(target=run_worker,
+          args=(worker_id, input_contexts, output_labels, net, options, noise_sampler))
+      worker.start()
+      workers.append(worker)
+
+  for epoch in range(1, options.max_epoch + 1):
+    ps.wait_epoch()
+    elapsed = time.time() - ps.start_time
+    if options.sync_mode == "sync":
+      logging.info("epoch {0} finished with NCE loss {1}: {2} instances/sec, {3} synchronous updates, {4:.2f}s average wait per worker"
+          .format(epoch, ps.total_loss, ps.instance_count / elapsed, ps.version, ps.wait_time / options.workers))
+    else:
+      logging.info("epoch {0} finished with NCE loss {1}: {2} instances/sec, {3} updates, staleness mean {4:.2f} max {5}"
+          .format(epoch, ps.total_loss, ps.instance_count / elapsed, ps.version,
+              np.mean(ps.staleness) if ps.staleness else 0.0, max(ps.staleness) if ps.staleness else 0))
+    if options.val_trg_file and options.val_src_file and options.val_align_file:
+      validate(val_input_contexts, val_output_labels, net, options, epoch, noise_sampler)
+    if epoch % options.save_interval == 0:
+      net.dump(options.working_dir + "/NNJM.model." + str(epoch), options.processes)
+      if options.binary_model:
+        net.dump_binary(options.working_dir + "/NNJM.model." + str(epoch) + ".bin")
+    ps.next_epoch()
+
+  for worker in workers:
+    worker.join()
+  logging.info("training finished")
+
+if __name__ == "__main__":
+  ret = parser.parse_known_args()
+  options = ret[0]
+  if ret[1]:
+    logging.warning(
+      "unknown arguments: {0}".format(
+          parser.parse_known_args()[1]))
+  main(options)
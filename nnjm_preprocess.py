@@ -0,0 +1,197 @@
+# NNJM -- multi-process preprocessing of the training corpora
+#
+# splits the parallel target/source/alignment files into line ranges (shards), and a pool of processes
+#   numberizes each shard with the same numberizer, reads its alignments and extracts its training instances;
+#   the shards are then concatenated into the instance cache read by nnjm.py (see nnjm.load_data),
+#   so a training run with the same corpora and options starts right away
+#
+# usage: python nnjm_preprocess.py [--processes INT] followed by the corpus, vocabulary, context size
+#   and working/cache directory options of the training run
+
+import cPickle as pickle
+import logging
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import sys
+import time
+from nnjm import parser, instance_names, instance_cache_dir, get_numberizer, get_target_unigram_dist, parse_alignment, make_training_instances
+from utils.numberizer import TARGET_TYPE, SOURCE_TYPE
+from utils import cache
+
+STAGES = ["numberize", "alignments", "instances", "write"]
+
+# set in each process of the pool by init_worker
+nz = None
+options = None
+
+def init_worker(worker_nz, worker_options):
+  global nz, options
+  nz = worker_nz
+  options = worker_options
+
+# the corpora are split into lines like nnjm.py reads them, through codecs, i.e. as by unicode.splitlines,
+#   which also breaks lines on \r, \x0b, \x0c, \x1c-\x1e, U+0085, U+2028 and U+2029,
+#   and the alignments on \n only, like read_alignment does
+TEXT = "text"
+ALIGNMENT = "alignment"
+
+# bytes read at a time when looking for the line breaks
+CHUNK_SIZE = 1 << 20
+
+# positions of the last byte of each line break of data
+def line_break_ends(data, kind):
+  b = np.frombuffer(data, dtype=np.uint8)
+  ends = b == ord('\n')
+  if kind == TEXT:
+    ends |= (b == 0x0b) | (b == 0x0c) | ((b >= 0x1c) & (b <= 0x1e))
+    # \r\n is a single line break, which ends at the \n
+    cr = b == ord('\r')
+    cr[:-1] &= b[1:] != ord('\n')
+    ends |= cr
+    # U+0085, U+2028 and U+2029 in utf8
+    ends[1:] |= (b[:-1] == 0xc2) & (b[1:] == 0x85)
+    ends[2:] |= (b[:-2] == 0xe2) & (b[1:-1] == 0x80) & ((b[2:] == 0xa8) | (b[2:] == 0xa9))
+  return np.flatnonzero(ends)
+
+# yields arrays of the byte offsets where the lines after the first one start, i.e. right after each line break
+# a line break may span two chunks of the file, so the last 3 bytes of each chunk are scanned again with the next one,
+#   and whether the last byte ends a line (a \r may be followed by \n) is only decided then
+def line_starts(path, kind):
+  carry = b''
+  position = 0
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+      data = carry + chunk
+      ends = line_break_ends(data, kind)
+      yield ends[(ends >= max(len(carry) - 1, 0)) & (ends < len(data) - 1)] + position + 1
+      position += len(data) - len(data[-3:])
+      carry = data[-3:]
+  ends = line_break_ends(carry, kind)
+  yield ends[ends == len(carry) - 1] + position + 1
+
+def count_lines(path, kind):
+  lines = 0
+  last_start = 0
+  for starts in line_starts(path, kind):
+    lines += len(starts)
+    if len(starts) > 0:
+      last_start = starts[-1]
+  # the last line may not end with a line break
+  return lines + 1 if os.path.getsize(path) > last_start else lines
+
+# byte offsets where the given (increasing) line numbers start, or the size of the file for the lines past its end
+def line_offsets(path, kind, line_numbers):
+  offsets = [0 for line in line_numbers if line == 0]
+  breaks = 0
+  for starts in line_starts(path, kind):
+    # line breaks + i + 1 starts right after the i-th line break of the chunk
+    while len(offsets) < len(line_numbers) and line_numbers[len(offsets)] - 1 - breaks < len(starts):
+      offsets.append(int(starts[line_numbers[len(offsets)] - 1 - breaks]))
+    breaks += len(starts)
+  return offsets + [os.path.getsize(path)] * (len(line_numbers) - len(offsets))
+
+def read_range(path, byte_range):
+  with open(path, 'rb') as f:
+    f.seek(byte_range[0])
+    return f.read(byte_range[1] - byte_range[0])
+
+# runs in the pool: extracts the instances of one shard and saves them under prefix,
+#   returns the saved files and the time spent on each stage
+def extract_shard(shard):
+  (prefix, (trg_file, src_file, align_file), byte_ranges) = shard
+  times = []
+  start_time = time.time()
+  trnz_target = nz.numberize_lines(TARGET_TYPE, read_range(trg_file, byte_ranges[0]).decode('utf8').splitlines(), flat=True)
+  trnz_source = nz.numberize_lines(SOURCE_TYPE, read_range(src_file, byte_ranges[1]).decode('utf8').splitlines(), flat=True)
+  times.append(time.time() - start_time)
+  start_time = time.time()
+  trnz_align = parse_alignment([read_range(align_file, byte_ranges[2])], flat=True)
+  times.append(time.time() - start_time)
+  start_time = time.time()
+  input_contexts, output_labels = make_training_instances(nz, trnz_align, trnz_target, trnz_source, tc_size=options.tc_size, sw_size=options.sw_size)
+  times.append(time.time() - start_time)
+  start_time = time.time()
+  np.save(prefix + ".input_contexts.npy", input_contexts)
+  np.save(prefix + ".output_labels.npy", output_labels)
+  times.append(time.time() - start_time)
+  return (prefix + ".input_contexts.npy", prefix + ".output_labels.npy"), times
+
+# extracts the instances of the (target, source, alignment) files with the pool, one shard per process,
+#   and saves them in the cache as input_contexts and output_labels, prefixed with name_prefix
+def extract_sharded(pool, files, shard_dir, name_prefix):
+  start_time = time.time()
+  kinds = [TEXT, TEXT, ALIGNMENT]
+  num_lines = count_lines(files[0], kinds[0])
+  for (path, kind) in zip(files[1:], kinds[1:]):
+    if count_lines(path, kind) != num_lines:
+      logging.fatal("{0} and {1} don't have the same number of lines.".format(files[0], path))
+      sys.exit(1)
+  names = [name_prefix + "input_contexts", name_prefix + "output_labels"]
+  if num_lines == 0:
+    logging.warning("{0} is empty, there are no instances to extract".format(files[0]))
+    cache.save_arrays(options.cache_dir, names, make_training_instances(nz, [], [], [], tc_size=options.tc_size, sw_size=options.sw_size))
+    return
+  num_shards = min(options.processes, num_lines)
+  boundaries = [shard * num_lines // num_shards for shard in range(num_shards + 1)]
+  offsets = [line_offsets(path, kind, boundaries) for (path, kind) in zip(files, kinds)]
+  shards = [(os.path.join(shard_dir, "{0}{1}".format(name_prefix, shard)), files, [(o[shard], o[shard + 1]) for o in offsets])
+      for shard in range(num_shards)]
+  logging.info("split {0} lines into {1} shards in {2:.2f}s".format(num_lines, num_shards, time.time() - start_time))
+
+  start_time = time.time()
+  shard_files = []
+  stage_times = np.zeros(len(STAGES))
+  for (files, times) in pool.imap(extract_shard, shards):
+    shard_files.append(files)
+    stage_times += times
+  logging.info("extracted the shards in {0:.2f}s, time spent summed over the shards: ".format(time.time() - start_time) +
+      ", ".join("{0} {1:.2f}s".format(stage, stage_time) for (stage, stage_time) in zip(STAGES, stage_times)))
+
+  start_time = time.time()
+  for (name, shard_name_files) in zip(names, zip(*shard_files)):
+    cache.save_concatenated(options.cache_dir, name, [np.load(path, mmap_mode='r') for path in shard_name_files])
+  logging.info("concatenated the shards in {0:.2f}s".format(time.time() - start_time))
+
+def main(options):
+  start_time = time.time()
+  names = instance_names(options)
+  cache_dir = instance_cache_dir(options)
+  if cache.load_arrays(cache_dir, names) is not None:
+    logging.info("the instances are already cached in {0}".format(cache_dir))
+    return
+
+  stage_start_time = time.time()
+  nz = get_numberizer(options)
+  logging.info("vocabulary collection finished in {0:.2f}s".format(time.time() - stage_start_time))
+  # extract_sharded saves to options.cache_dir, which is the entry of these corpora from now on
+  options.cache_dir = cache_dir
+  shard_dir = os.path.join(cache_dir, "shards.{0}".format(os.getpid()))
+  os.makedirs(shard_dir)
+  pool = multiprocessing.Pool(options.processes, initializer=init_worker, initargs=(nz, options))
+  try:
+    init_worker(nz, options)
+    extract_sharded(pool, [options.target_file, options.source_file, options.align_file], shard_dir, "")
+    if "val_input_contexts" in names:
+      extract_sharded(pool, [options.val_trg_file, options.val_src_file, options.val_align_file], shard_dir, "val_")
+  finally:
+    pool.close()
+    pool.join()
+    shutil.rmtree(shard_dir)
+
+  # the noise distribution goes in last, so load_data doesn't use the entry before it's complete
+  if not options.vocab_file:
+    pickle.dump(nz, open(os.path.join(cache_dir, "numberizer.pickle"), 'wb'))
+    pickle.dump(nz, open(options.working_dir + "/numberizer.pickle", 'wb'))
+  cache.save_arrays(cache_dir, ["target_unigram_dist"], [get_target_unigram_dist(nz)])
+  logging.info("preprocessing finished in {0:.2f}s, the instances are cached in {1}".format(time.time() - start_time, cache_dir))
+
+if __name__ == "__main__":
+  ret = parser.parse_known_args()
+  options = ret[0]
+  if ret[1]:
+    logging.warning(
+      "unknown arguments: {0}".format(
+          parser.parse_known_args()[1]))
+  main(options)
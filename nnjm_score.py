@@ -0,0 +1,139 @@
+# NNJM -- scores n-best lists (or any parallel corpus) with a trained model, in parallel
+#
+# writes one line per target sentence: the sum of the log probabilities (natural log) of its words given their
+#   source windows and target contexts, i.e. the NNJM feature of that n-best entry
+#
+# the workers are forked after the model is loaded and read the same copy of the weights:
+#   a binary model (see nnjm_convert.py) stays memory-mapped, so its pages live in the page cache
+#   and are shared by every process mapping the file, including independent scoring jobs on the same model;
+#   a text model is parsed once and moved to shared memory (see NNJM.share_memory)
+# either way, the memory used by the weights doesn't grow with --workers
+# (with floatX other than float32, the float32 weights of a binary model have to be converted, i.e. copied once)
+
+import argparse
+import ctypes
+import logging
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from nnjm import NNJM, make_training_instances, read_model_config, vocab_size_differences
+from utils.numberizer import numberizer
+from utils.numberizer import TARGET_TYPE, SOURCE_TYPE
+from utils.heuristics import read_alignment
+from utils import binfile
+import numpy as np
+import sys
+import theano
+import time
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model-file", "-m", dest="model_file", metavar="PATH", help="file of a trained nnjm, in the Moses text format or the binary format (the binary format loads much faster and is shared by the workers without being parsed).", required=True)
+parser.add_argument("--numberizer-file", "-z", dest="numberizer_file", metavar="PATH", help="file of pickled vocab object the model was trained with, or of a vocabulary converted to the binary format by nnjm_convert.py", required=True)
+parser.add_argument("--target-file", "-t", dest="target_file", metavar="PATH", help="file with n-best target sentences.", required=True)
+parser.add_argument("--source-file", "-s", dest="source_file", metavar="PATH", help="file with repeated (aligned to n-best target sentences) source sentences.", required=True)
+parser.add_argument("--alignment-file", "-a", dest="align_file", metavar="PATH", help="file with word alignments between repeated source- n-best target (giza style).", required=True)
+parser.add_argument("--output-file", "-o", dest="output_file", metavar="PATH", help="file the scores are written to, one per target sentence (default = standard output).")
+parser.add_argument("--sw-size", dest="sw_size", type=int, metavar="INT", help="Size of the one-side source context (default = 4).")
+parser.add_argument("--tc-size", dest="tc_size", type=int, metavar="INT", help="Size of the target context (default = 4).")
+parser.add_argument("--batch-size", "-b", dest="batch_size", type=int, metavar="INT", help="Number of instances scored at a time by each worker, whose output layer takes batch size x output vocabulary size floats (default = 100).")
+parser.add_argument("--workers", dest="workers", type=int, metavar="INT", help="Number of scoring processes, which share the weights of the model. Works best with single-threaded BLAS (default = number of cores).")
+
+parser.set_defaults(
+  sw_size=4,
+  tc_size=4,
+  batch_size=100,
+  workers=multiprocessing.cpu_count())
+
+# builds a network of the sizes of the model file (trained with the vocabulary of nz), without its training functions,
+#   and loads its weights, so that processes forked afterwards share them
+def load_shared_net(options, nz):
+  config = read_model_config(options.model_file)
+  differences = vocab_size_differences(config, nz)
+  if differences:
+    logging.fatal("{0} wasn't trained with the vocabulary of {1}: {2}".format(options.model_file, options.numberizer_file, ", ".join(differences)))
+    sys.exit(1)
+  if config["num_inputs"] != 2 * options.sw_size + 1 + options.tc_size:
+    logging.fatal("{0} has {1} inputs, but --sw-size {2} and --tc-size {3} make {4}"
+        .format(options.model_file, config["num_inputs"], options.sw_size, options.tc_size, 2 * options.sw_size + 1 + options.tc_size))
+    sys.exit(1)
+  net = NNJM(config["num_inputs"], config["vocab_size"], config["target_vocab_size"], config["word_dim"], config["hidden_dim1"], config["hidden_dim2"],
+      batch_size=options.batch_size, train=False)
+  net.load_weights(options.model_file)
+  if binfile.is_binfile(options.model_file):
+    if theano.config.floatX != 'float32':
+      logging.warning("floatX is {0}: the weights are converted from float32 instead of being mapped".format(theano.config.floatX))
+  else:
+    net.share_memory()
+  return net
+
+# the instances of every target word but the first (<s>) of each sentence, the sentence each of them belongs to,
+#   and the number of sentences
+def load_instances(nz, options):
+  target = nz.numberize_sent(TARGET_TYPE, options.target_file, flat=True)
+  source = nz.numberize_sent(SOURCE_TYPE, options.source_file, flat=True)
+  align = read_alignment(options.align_file, flat=True)
+  num_sentences = min(len(target), len(source), len(align))
+  if num_sentences < len(target):
+    logging.warning("only scoring the first {0} of the {1} target sentences, which have a source sentence and an alignment"
+        .format(num_sentences, len(target)))
+  (input_contexts, output_labels) = make_training_instances(nz, align, target, source, tc_size=options.tc_size, sw_size=options.sw_size)
+  sentences = np.repeat(np.arange(num_sentences), np.maximum(target.lengths()[:num_sentences] - 1, 0))
+  return input_contexts, output_labels, sentences, num_sentences
+
+# writes the log probabilities of the instances of the shard into log_probs, a batch at a time
+def score_worker(net, input_contexts, output_labels, shard, batch_size, log_probs):
+  for start in range(shard.start, shard.stop, batch_size):
+    batch = slice(start, min(start + batch_size, shard.stop))
+    X = np.asarray(input_contexts[batch], dtype='int64')
+    Y = np.asarray(output_labels[batch], dtype='int64')
+    log_probs[batch] = net.log_prob(X, Y)
+
+# the log probability of every instance, scored by that many workers on contiguous shards
+# the workers are forked, so they share the weights and the instances with this process,
+#   and write their results straight into a shared array
+def score(net, input_contexts, output_labels, workers, batch_size):
+  num_instances = len(input_contexts)
+  if workers <= 1:
+    log_probs = np.empty(num_instances, dtype=np.float64)
+    score_worker(net, input_contexts, output_labels, slice(0, num_instances), batch_size, log_probs)
+    return log_probs
+  log_probs = np.frombuffer(RawArray(ctypes.c_double, max(num_instances, 1)), dtype=np.float64)[:num_instances]
+  # shards are made of whole batches, so the batches (and the float32 sums within them) don't depend on the number of workers
+  num_batches = (num_instances + batch_size - 1) // batch_size
+  shard_size = (num_batches + workers - 1) // workers * batch_size
+  processes = []
+  for worker_id in range(workers):
+    shard = slice(worker_id * shard_size, min((worker_id + 1) * shard_size, num_instances))
+    process = multiprocessing.Process(target=score_worker,
+        args=(net, input_contexts, output_labels, shard, batch_size, log_probs))
+    process.start()
+    processes.append(process)
+  for process in processes:
+    process.join()
+    if process.exitcode != 0:
+      logging.fatal("scoring worker exited with code {0}".format(process.exitcode))
+      sys.exit(1)
+  return log_probs
+
+def main(options):
+  nz = numberizer.load(options.numberizer_file)
+  net = load_shared_net(options, nz)
+  (input_contexts, output_labels, sentences, num_sentences) = load_instances(nz, options)
+  logging.info("scoring {0} instances of {1} sentences with {2} workers".format(len(input_contexts), num_sentences, options.workers))
+  start_time = time.time()
+  log_probs = score(net, input_contexts, output_labels, options.workers, options.batch_size)
+  logging.info("scored {0} instances/sec".format(len(input_contexts) / max(time.time() - start_time, 1e-6)))
+
+  scores = np.bincount(sentences, weights=log_probs, minlength=num_sentences)
+  output_file = open(options.output_file, 'w') if options.output_file else sys.stdout
+  for s in scores:
+    output_file.write("{0:.6f}\n".format(s))
+  if options.output_file:
+    output_file.close()
+
+if __name__ == "__main__":
+  options = parser.parse_args()
+  main(options)
@@ -7,12 +7,16 @@ from collections import Counter
 import codecs
 import logging
 from loss import NCE
-from nnjm import NNJM, shuffle, validate, make_training_instances
+from nnjm import NNJM, shuffled_order, validate, make_training_instances, get_target_unigram_dist, read_model_config, vocab_size_differences, INSTANCE_CACHE_VERSION
 from utils.numberizer import numberizer
 from utils.numberizer import TARGET_TYPE, SOURCE_TYPE
 from utils.heuristics import *
+from utils.prefetch import prefetch
+from utils import cache
 import numpy as np
+import os
 import pdb
+import sys
 import theano
 import theano.tensor as T
 import rand
@@ -28,11 +32,13 @@ EOS = "</s>"
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--model-file", "-m", dest="model_file", metavar="PATH", help="file of a trained nnjm", required=True)
-parser.add_argument("--numberizer-file", "-z", dest="numberizer_file", metavar="PATH", help="file of pickled vocab object", required=True)
+parser.add_argument("--numberizer-file", "-z", dest="numberizer_file", metavar="PATH", help="file of pickled vocab object, or of a vocabulary converted to the binary format by nnjm_convert.py", required=True)
 parser.add_argument("--target-file", "-t", dest="target_file", metavar="PATH", help="file with n-best target sentences.", required=True)
 parser.add_argument("--source-file", "-s", dest="source_file", metavar="PATH", help="file with repeated (aligned to n-best target sentences) source sentences.", required=True)
 parser.add_argument("--alignment-file", "-a", dest="align_file", metavar="PATH", help="file with word alignments between repeated source- n-best target (giza style).", required=True)
 parser.add_argument("--working-dir", "-w", dest="working_dir", metavar="PATH", help="Directory used to dump models etc.", required=True)
+parser.add_argument("--cache-dir", dest="cache_dir", metavar="PATH", help="Directory where the extracted tuning instances are cached, keyed by a hash of the corpora, the numberizer and the context sizes (default = WORKING_DIR/cache).")
+parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Always extract the tuning instances from the corpora, and don't cache them (default = False).")
 parser.add_argument("--validation-target-file", "-vtf", dest="val_trg_file", metavar="PATH", help="Validation target corpus used for stopping criteria.")
 parser.add_argument("--validation-source-file", "-vsf", dest="val_src_file", metavar="PATH", help="Validation source corpus used for stopping criteria.")
 parser.add_argument("--validation-alignment-file", "-vaf", dest="val_align_file", metavar="PATH", help="Validation alignment corpus used for stopping criteria.")
@@ -49,6 +55,11 @@ parser.add_argument("--max-epoch", dest="max_epoch", type=int, metavar="INT", he
 parser.add_argument("--save-interval", dest="save_interval", type=int, metavar="INT", help="Saving model only for every several epochs (default = 1).")
 parser.add_argument("--batch-size", "-b", dest="batch_size", type=int, metavar="INT", help="Batch size (in sentences) of SGD (default = 1000).")
 parser.add_argument("--gradient-check", dest="gradient_check", type=int, metavar="INT", help="The iteration interval for gradient check. Pass 0 if gradient check should not be performed (default = 0).")
+parser.add_argument("--sparse-output", dest="sparse_output", action="store_true", help="Only compute and update the output rows of the labels and noise samples during tuning (default = False).")
+parser.add_argument("--sparse-input", dest="sparse_input", action="store_true", help="Only update the input embeddings of the words that appear in each batch (default = False).")
+parser.add_argument("--prefetch", dest="prefetch", type=int, metavar="INT", help="Number of batches (with their noise samples) prepared in the background ahead of the tuning step. Pass 0 to prepare them in the tuning loop (default = 4).")
+parser.add_argument("--prefetch-process", dest="prefetch_process", action="store_true", help="Prepare the batches in a separate process (default = True).")
+parser.add_argument("--prefetch-thread", dest="prefetch_process", action="store_false", help="Prepare the batches in a thread of the training process instead, which saves pickling them but doesn't overlap with the training step, since theano holds the GIL while it runs (default = False).")
 
 parser.set_defaults(
   learning_rate=0.001,
@@ -63,7 +74,12 @@ parser.set_defaults(
   n_best=200,
   max_epoch=5,
   batch_size=128,
-  save_interval=1)
+  save_interval=1,
+  no_cache=False,
+  sparse_output=False,
+  sparse_input=False,
+  prefetch=4,
+  prefetch_process=True)
 
 if theano.config.floatX=='float32':
   floatX = np.float32
@@ -71,188 +87,116 @@ else:
   floatX = np.float64
   
 class NNJMBasicTune(NNJM):
-  def __init__(self, num_inputs, vocab_size, target_vocab_size, word_dim=150, hidden_dim1=150, hidden_dim2=750, noise_sample_size=100, batch_size=1000, noise_dist=[]):
-    NNJM.__init__(self, num_inputs, vocab_size, target_vocab_size, word_dim, hidden_dim1, hidden_dim2, noise_sample_size, batch_size, noise_dist)
-    if self.hidden_dim1 > 0:
-      self.update_pos = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = [], 
-          updates = [
-              (self.D, self.D + self.symlr * self.symdD),
-              (self.C, self.C + self.symlr * self.symdC),
-              (self.M, self.M + self.symlr * self.symdM),
-              (self.E, self.E + self.symlr * self.symdE),
-              (self.Cb, self.Cb + self.symlr * self.symdCb), 
-              (self.Mb, self.Mb + self.symlr * self.symdMb), 
-              (self.Eb, self.Eb + self.symlr * self.symdEb), 
-              ])
-      self.update_neg = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = [], 
-          updates = [
-              (self.D, self.D - self.symlr * self.symdD),
-              (self.C, self.C - self.symlr * self.symdC),
-              (self.M, self.M - self.symlr * self.symdM),
-              (self.E, self.E - self.symlr * self.symdE),
-              (self.Cb, self.Cb - self.symlr * self.symdCb), 
-              (self.Mb, self.Mb - self.symlr * self.symdMb), 
-              (self.Eb, self.Eb - self.symlr * self.symdEb), 
-              ])
-    else:
-      self.update_pos = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = [], 
-          updates = [
-              (self.D, self.D + self.symlr * self.symdD),
-              (self.M, self.M + self.symlr * self.symdM),
-              (self.E, self.E + self.symlr * self.symdE),
-              (self.Mb, self.Mb + self.symlr * self.symdMb), 
-              (self.Eb, self.Eb + self.symlr * self.symdEb), 
-              ])
-      self.update_neg = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = [], 
-          updates = [
-              (self.D, self.D - self.symlr * self.symdD),
-              (self.M, self.M - self.symlr * self.symdM),
-              (self.E, self.E - self.symlr * self.symdE),
-              (self.Mb, self.Mb - self.symlr * self.symdMb), 
-              (self.Eb, self.Eb - self.symlr * self.symdEb), 
-              ])
+  def __init__(self, num_inputs, vocab_size, target_vocab_size, word_dim=150, hidden_dim1=150, hidden_dim2=750, noise_sample_size=100, batch_size=1000, noise_dist=[], sparse_output=False, sparse_input=False):
+    NNJM.__init__(self, num_inputs, vocab_size, target_vocab_size, word_dim, hidden_dim1, hidden_dim2, noise_sample_size, batch_size, noise_dist, sparse_output, sparse_input)
+    self.update_pos = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = self.symstats, 
+        updates = self.sgd_updates(self.symlr))
+    self.update_neg = theano.function(inputs = [self.symX, self.symY, self.symN, self.symlr], outputs = self.symstats, 
+        updates = self.sgd_updates(-self.symlr))
 # ==================== END OF NNJM CLASS DEF ====================
 
 
-def sgd_epoch(pos_contexts, pos_outputs, neg_contexts, neg_outputs, net, options, epoch, noise_dist):
+# yields the (X_pos, Y_pos, X_neg, Y_neg, N) batches of an epoch, with a noise sample shared by both sides
+# positive and negative instances don't have to be of the same size,
+#   the last batch of each may be smaller than batch_size (or empty)
+# the positive and negative batches are gathered through pos_order and neg_order (see nnjm.shuffled_order)
+def make_batches(pos_contexts, pos_outputs, neg_contexts, neg_outputs, options, noise_sampler, pos_order, neg_order):
+  for start in range(0, max(len(pos_contexts), len(neg_contexts)), options.batch_size):
+    pos_batch = np.sort(pos_order[start: start + options.batch_size])
+    neg_batch = np.sort(neg_order[start: start + options.batch_size])
+    X_pos = np.asarray(pos_contexts[pos_batch], dtype='int64')
+    X_neg = np.asarray(neg_contexts[neg_batch], dtype='int64')
+    Y_pos = np.asarray(pos_outputs[pos_batch], dtype='int64')
+    Y_neg = np.asarray(neg_outputs[neg_batch], dtype='int64')
+    N = noise_sampler.sample((options.noise_sample_size,)) # (batch_size, noise_sample_size)
+    # N = noise_sampler.sample((options.batch_size, options.noise_sample_size)) # (batch_size, noise_sample_size)
+    yield (X_pos, Y_pos, X_neg, Y_neg, N)
+
+def sgd_epoch(pos_contexts, pos_outputs, neg_contexts, neg_outputs, net, options, epoch, noise_sampler, pos_order, neg_order):
   logging.info("epoch {0} started".format(epoch))  
   instance_count = 0
   batch_count = 0
-  # for performance issue, if the remaining data is smaller than batch_size, we just discard them
-  for start in range(0, len(pos_contexts), options.batch_size):
-    if len(pos_contexts) - start >= options.batch_size:
-      X_pos = pos_contexts[start: start + options.batch_size]
-      X_neg = neg_contexts[start: start + options.batch_size]
-      Y_pos = pos_outputs[start: start + options.batch_size]
-      Y_neg = neg_outputs[start: start + options.batch_size]
-      N = np.array(rand.distint(noise_dist, (options.noise_sample_size,)), dtype='int64') # (batch_size, noise_sample_size)
-      # N = np.array(rand.distint(noise_dist, (options.batch_size, options.noise_sample_size)), dtype='int64') # (batch_size, noise_sample_size)
-      net.update_pos(X_pos, Y_pos, N, floatX(options.learning_rate))
-      net.update_neg(X_neg, Y_neg, N, floatX(options.learning_rate))
-    instance_count += options.batch_size
+  pos_loss = 0.0
+  neg_loss = 0.0
+  batches = make_batches(pos_contexts, pos_outputs, neg_contexts, neg_outputs, options, noise_sampler, pos_order, neg_order)
+  for (X_pos, Y_pos, X_neg, Y_neg, N) in prefetch(batches, size=options.prefetch, process=options.prefetch_process):
+    if len(X_pos) > 0:
+      (loss, _, count) = net.update_pos(X_pos, Y_pos, N, floatX(options.learning_rate))
+      pos_loss += loss
+      instance_count += count
+    if len(X_neg) > 0:
+      (loss, _, count) = net.update_neg(X_neg, Y_neg, N, floatX(options.learning_rate))
+      neg_loss += loss
+      instance_count += count
     batch_count += 1
     if batch_count % 1 == 0:
       logging.info("{0} instances seen".format(instance_count))
-  # N = np.array(rand.distint(noise_dist, (len(indexed_ngrams), options.noise_sample_size)))
-  # total_loss = net.loss(indexed_ngrams, predictions, N)
-  # logging.info("epoch {0} finished with NCE loss {1}".format(epoch, total_loss))
-  logging.info("epoch {0} finished".format(epoch))
-
-def read_alignment(align_file):
-  n_align = []
-  with open(align_file) as f:
-    for line in f:
-      n = [(int(t.split('-')[0]), int(t.split('-')[1])) for t in line.strip().split()]
-      n_align.append(n)
-  return n_align
-
-def get_dummy_training_tuple(nz, tc_size, sw_size):
-    fullc =  [nz.v2i[SOURCE_TYPE, UNK]] * (1 + 2 * sw_size) + [nz.v2i[TARGET_TYPE, UNK]] * tc_size
-    t = nz.v2i[TARGET_TYPE, UNK]
-    return fullc, t
+  logging.info("epoch {0} finished with NCE loss {1} on positive instances, {2} on negative instances".format(epoch, pos_loss, neg_loss))
+
+# the instances of the top 50 (positive) and bottom 50 (negative) entries of each list of 200 n-best translations,
+#   i.e. of every target word but the first of these entries, see make_training_instances
+# the corpora are raggeds from numberize_sent and read_alignment with flat=True
+def make_tuning_instances(nz, n_best_alignments, n_best_targets,  n_best_sources, n=200, tc_size=5, sw_size=4):
+  num_sentences = min(len(n_best_targets), len(n_best_sources), len(n_best_alignments))
+  ranks = np.arange(num_sentences) % 200
+  instances = []
+  for entries in [np.flatnonzero(ranks < 50), np.flatnonzero(ranks >= 150)]:
+    instances += make_training_instances(nz, n_best_alignments.take(entries), n_best_targets.take(entries), n_best_sources.take(entries),
+        tc_size=tc_size, sw_size=sw_size)
+  return tuple(instances)
+
+# reads the corpora and extracts the tuning (and validation) instances, through the cache like nnjm.load_data
+def load_data(options):
+  val_files = [options.val_trg_file, options.val_src_file, options.val_align_file]
+  if any(val_files) and not all(val_files):
+    logging.fatal("You have to supply all three validation files (source, target, alignment) to trigger validation.")
+    sys.exit(1)
+  names = ["pos_contexts", "pos_outputs", "neg_contexts", "neg_outputs", "target_unigram_dist"]
+  if all(val_files):
+    names += ["val_input_contexts", "val_output_labels"]
 
-def get_training_tuple(nz, idx, trg, src, align, tc_size, sw_size): 
-  tc = [] # contains target context
-  sc = [] # contains source context
-  tc = trg[idx - tc_size if idx - tc_size > 0 else 0 :idx]
-  if len(tc) < tc_size:
-    tc_pad = [nz.v2i[TARGET_TYPE,nz.bos]] * (tc_size - len(tc))
-    tc = tc_pad + tc
-  assert len(tc) == tc_size
-  h_a = get_effective_align(align, idx)
-  if h_a < len(src):
-    pass
+  nz = numberizer.load(options.numberizer_file)
+  arrays = None
+  if not options.no_cache:
+    key = cache.digest([options.target_file, options.source_file, options.align_file] + val_files + [options.numberizer_file],
+        "nnjm tuning instances", INSTANCE_CACHE_VERSION, options.n_best, options.tc_size, options.sw_size)
+    cache_dir = os.path.join(options.cache_dir or os.path.join(options.working_dir, "cache"), key)
+    arrays = cache.load_arrays(cache_dir, names)
+  if arrays is not None:
+    logging.info("loading cached tuning instances from {0}".format(cache_dir))
   else:
-    pdb.set_trace()
-  sc = get_left_src(nz, src, h_a,sw_size) 
-  sc += [src[h_a]] 
-  sc += get_right_src(nz, src, h_a, sw_size)
-  fullc = sc + tc
-  assert len(fullc) == tc_size + 1 + (2 * sw_size)
-  return fullc, trg[idx]
-
-def make_tuning_instances(nz, n_best_alignments, n_best_targets,  n_best_sources, batch_size, n=200, tc_size=5, sw_size=4):
-  positive_input_contexts = []
-  positive_output_labels = []
-  negative_input_contexts = []
-  negative_output_labels = []
-
-  for n_idx, (trg, src, align) in enumerate(zip(n_best_targets, n_best_sources, n_best_alignments)):
-    if n_idx % 200 >= 0 and n_idx % 200 < 50: # convert this to a range if we want top k and bottom k in the n-best 
-      for idx in range(1, len(trg)):
-        fullc, trg_idx = get_training_tuple(nz, idx, trg, src, align, tc_size, sw_size)
-        positive_input_contexts.append(fullc)
-        positive_output_labels.append(trg[idx])
-    elif n_idx % 200 >= 150:
-      for idx in range(1, len(trg)):
-        fullc, trg_idx = get_training_tuple(nz, idx, trg, src, align, tc_size, sw_size)
-        negative_input_contexts.append(fullc)
-        negative_output_labels.append(trg_idx)
-    else:
-        pass
+    arrays = extract_data(options, nz, names)
+    if not options.no_cache:
+      cache.save_arrays(cache_dir, names, arrays)
+  arrays = dict(zip(names, arrays))
+  arrays["target_unigram_dist"] = np.array(arrays["target_unigram_dist"])
+  logging.info("vocabulary collection finished")
+  return nz, arrays
 
-  #pad to same size
-  max_num_pad = np.abs(len(positive_output_labels) - len(negative_output_labels)) 
-  if max_num_pad > 0:
-    dummy_input_context, dummy_output_label = get_dummy_training_tuple(nz, tc_size, sw_size)
-    dummy_input_contexts = [dummy_input_context] * max_num_pad
-    dummy_output_labels = [dummy_output_label] * max_num_pad
-    if len(positive_output_labels) < len(negative_output_labels):
-      positive_output_labels += dummy_output_labels
-      positive_input_contexts += dummy_input_contexts
-    elif len(negative_output_labels) < len(positive_output_labels):
-      negative_output_labels += dummy_output_labels
-      negative_input_contexts += dummy_input_contexts
-    else:
-      pass
-  assert len(positive_output_labels) == len(positive_input_contexts) == len(negative_output_labels) == len(negative_input_contexts)
+# extracts the arrays named in names from the corpora
+def extract_data(options, nz, names):
+  arrays = {}
+  trnz_target = nz.numberize_sent(TARGET_TYPE, options.target_file, flat=True)
+  trnz_source = nz.numberize_sent(SOURCE_TYPE, options.source_file, flat=True)
+  trnz_align = read_alignment(options.align_file, flat=True)
+  arrays["pos_contexts"], arrays["pos_outputs"], arrays["neg_contexts"], arrays["neg_outputs"] = make_tuning_instances(nz,trnz_align, trnz_target, trnz_source, n=options.n_best, tc_size=options.tc_size, sw_size=options.sw_size) 
 
-  # pad to be a multiple of batch size
-  num_pad = batch_size - (len(positive_output_labels) % batch_size)
-  if num_pad > 0:
-    dummy_input_context, dummy_output_label = get_dummy_training_tuple(nz, tc_size, sw_size)
-    dummy_input_contexts = [dummy_input_context] * num_pad
-    dummy_output_labels = [dummy_output_label] * num_pad
-    positive_output_labels += dummy_output_labels
-    positive_input_contexts += dummy_input_contexts
-    negative_output_labels += dummy_output_labels
-    negative_input_contexts += dummy_input_contexts
-  
-  assert len(positive_output_labels) % batch_size == 0
-  return np.array(positive_input_contexts), np.array(positive_output_labels), np.array(negative_input_contexts), np.array(negative_output_labels)
+  if "val_input_contexts" in names:
+    vanz_target = nz.numberize_sent(TARGET_TYPE, options.val_trg_file, flat=True)
+    vanz_source = nz.numberize_sent(SOURCE_TYPE, options.val_src_file, flat=True)
+    vanz_align = read_alignment(options.val_align_file, flat=True)
+    arrays["val_input_contexts"], arrays["val_output_labels"] = make_training_instances(nz, vanz_align, vanz_target, vanz_source, tc_size=options.tc_size, sw_size=options.sw_size)
 
+  arrays["target_unigram_dist"] = get_target_unigram_dist(nz)
+  return [arrays[name] for name in names]
 
 def main(options):
   # collecting vocab
   logging.info("start collecting vocabulary")
-  #indexed_ngrams = []
-  #predictions = []
-  nz = numberizer()
-  nz = numberizer.load(options.numberizer_file)
-  #nz.load('path/to/saved/pickled/numberizer')
-  #nz = numberizer(limit = options.vocab_size)
-  #nz.build_vocab(TARGET_TYPE,options.target_file)
-  #nz.build_vocab(SOURCE_TYPE,options.source_file)
-  trnz_target = nz.numberize_sent(TARGET_TYPE, options.target_file)
-  trnz_source = nz.numberize_sent(SOURCE_TYPE, options.source_file)
-  trnz_align = read_alignment(options.align_file) 
-  pos_contexts, pos_outputs, neg_contexts, neg_outputs = make_tuning_instances(nz,trnz_align, trnz_target, trnz_source, options.batch_size, n=options.n_best, tc_size=options.tc_size, sw_size=options.sw_size) 
-
-  if options.val_trg_file and options.val_src_file and options.val_align_file:
-    vanz_target = nz.numberize_sent(TARGET_TYPE, options.val_trg_file)
-    vanz_source = nz.numberize_sent(SOURCE_TYPE, options.val_src_file)
-    vanz_align = read_alignment(options.val_align_file)
-    val_input_contexts, val_output_labels = make_training_instances(nz, vanz_align, vanz_target, vanz_source, tc_size=options.tc_size, sw_size=options.sw_size)
-  elif options.val_trg_file or options.val_src_file or options.val_align_file:
-    logging.fatal("You have to supply all three validation files (source, target, alignment) to trigger validation.")
-    sys.exit(1)
-
-  target_unigram_counts = np.zeros(len(nz.t2c), dtype=floatX)
-  for tw, tw_count in nz.t2c.iteritems():
-    t_idx = nz.t2i[tw]
-    target_unigram_counts[t_idx] = floatX(tw_count)
-  target_unigram_dist  = target_unigram_counts / np.sum(target_unigram_counts)
-  logging.info("vocabulary collection finished")
+  nz, arrays = load_data(options)
+  (pos_contexts, pos_outputs, neg_contexts, neg_outputs) = (arrays["pos_contexts"], arrays["pos_outputs"], arrays["neg_contexts"], arrays["neg_outputs"])
+  (val_input_contexts, val_output_labels) = (arrays.get("val_input_contexts"), arrays.get("val_output_labels"))
+  target_unigram_dist = arrays["target_unigram_dist"]
 
   # training
   if len(nz.v2i) < options.vocab_size:
@@ -260,19 +204,30 @@ def main(options):
       "is smaller than the vocab_size option as specified {0}. ".format(options.vocab_size) + 
       "We don't know what will happen to NNJM in that case, but for safety we'll decrease vocab_size as the vocabulary size in the corpus.")
     options.vocab_size = len(nz.v2i)
+  # the network is built with the sizes of the model being tuned, whose weights then replace its initial ones
+  config = read_model_config(options.model_file)
+  differences = vocab_size_differences(config, nz)
+  if differences:
+    logging.fatal("{0} wasn't trained with the vocabulary of {1}: {2}".format(options.model_file, options.numberizer_file, ", ".join(differences)))
+    sys.exit(1)
+  if (config["num_inputs"] + 1, config["word_dim"], config["hidden_dim1"], config["hidden_dim2"]) != \
+      (options.n_gram, options.word_dim, options.hidden_dim1, options.hidden_dim2):
+    logging.warning("the sizes of {0} override those given as options".format(options.model_file))
   logging.info("start training with n-gram size {0}, vocab size {1}, learning rate {2}, "
-      .format(options.n_gram, len(nz.v2i), options.learning_rate) + 
+      .format(config["num_inputs"] + 1, config["vocab_size"], options.learning_rate) + 
       "word dimension {0}, hidden dimension 1 {1}, hidden dimension 2 {2}, noise sample size {3}"
-      .format(options.word_dim, options.hidden_dim1, options.hidden_dim2, options.noise_sample_size))
-  net = NNJMBasicTune(options.n_gram - 1, len(nz.v2i), len(nz.t2i), options.word_dim, options.hidden_dim1, options.hidden_dim2,
-      options.noise_sample_size, options.batch_size, target_unigram_dist)
+      .format(config["word_dim"], config["hidden_dim1"], config["hidden_dim2"], options.noise_sample_size))
+  net = NNJMBasicTune(config["num_inputs"], config["vocab_size"], config["target_vocab_size"], config["word_dim"], config["hidden_dim1"], config["hidden_dim2"],
+      options.noise_sample_size, options.batch_size, target_unigram_dist,
+      sparse_output=options.sparse_output, sparse_input=options.sparse_input)
   net.load(options.model_file, options.noise_sample_size, options.batch_size, target_unigram_dist)
+  noise_sampler = rand.distsampler(target_unigram_dist)
   for epoch in range(1, options.max_epoch + 1):
-    (pos_contexts_shuffled, pos_outputs_shuffled) = shuffle(pos_contexts, pos_outputs)
-    (neg_contexts_shuffled, neg_outputs_shuffled) = shuffle(neg_contexts, neg_outputs)
-    sgd_epoch(pos_contexts_shuffled, pos_outputs_shuffled, neg_contexts_shuffled, neg_outputs_shuffled, net, options, epoch, target_unigram_dist)
+    pos_order = shuffled_order(len(pos_contexts))
+    neg_order = shuffled_order(len(neg_contexts))
+    sgd_epoch(pos_contexts, pos_outputs, neg_contexts, neg_outputs, net, options, epoch, noise_sampler, pos_order, neg_order)
     if options.val_trg_file and options.val_src_file and options.val_align_file:
-      validate(val_input_contexts, val_output_labels, net, options, epoch, target_unigram_dist)
+      validate(val_input_contexts, val_output_labels, net, options, epoch, noise_sampler)
     if epoch % options.save_interval == 0:
     	net.dump(options.working_dir + "/NNJMBasicTune.model." + str(epoch))
   logging.info("training finished")
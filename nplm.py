@@ -8,12 +8,15 @@
 import argparse
 from collections import Counter
 import logging
+import multiprocessing
 from numberizer import numberizer
 import numpy as np
 import pdb
 import theano
 import theano.tensor as T
 import rand
+from prefetch import prefetch
+from textmatrix import write_items
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s: %(message)s',
@@ -39,6 +42,9 @@ parser.add_argument("--max-epoch", dest="max_epoch", type=int, metavar="INT", he
 parser.add_argument("--save-interval", dest="save_interval", type=int, metavar="INT", help="Saving model only for every several epochs (default = 1).")
 parser.add_argument("--batch-size", "-b", dest="batch_size", type=int, metavar="INT", help="Batch size (in sentences) of SGD (default = 1000).")
 parser.add_argument("--gradient-check", dest="gradient_check", type=int, metavar="INT", help="The iteration interval for gradient check. Pass 0 if gradient check should not be performed (default = 0).")
+parser.add_argument("--prefetch", dest="prefetch", type=int, metavar="INT", help="Number of batches (with their noise samples) prepared in the background ahead of the training step. Pass 0 to prepare them in the training loop (default = 4).")
+parser.add_argument("--prefetch-process", dest="prefetch_process", action="store_true", help="Prepare the batches in a separate process (default = True).")
+parser.add_argument("--prefetch-thread", dest="prefetch_process", action="store_false", help="Prepare the batches in a thread of the training process instead, which saves pickling them but doesn't overlap with the training step, since theano holds the GIL while it runs (default = False).")
 
 parser.set_defaults(
   learning_rate=1.0,
@@ -50,7 +56,9 @@ parser.set_defaults(
   n_gram=5,
   max_epoch=5,
   batch_size=1000,
-  save_interval=1)
+  save_interval=1,
+  prefetch=4,
+  prefetch_process=True)
 
 if theano.config.floatX=='float32':
   floatX = np.float32
@@ -168,100 +176,94 @@ class nplm:
   
 # ==================== END OF NPLM CLASS DEF ====================
 
-def dump_matrix(m, model_file):
-    shape = m.shape
-    if len(shape) == 1:
-      shape = (shape, 1)
-
-    index = 0
-    for i in range(0, shape[0]):
-      model_file.write("{0:.6f}".format(m.take(index)))
-      for j in range(1, shape[1]):
-        index += 1
-        model_file.write('\t')
-        model_file.write("{0:.6f}".format(m.take(index)))
-      model_file.write('\n')
-
+# the matrices are formatted by a pool of processes, see textmatrix.write_items
 def dump(net, model_dir, options, vocab):
-    model_file = open(model_dir, 'w')
+    # the strings and the matrices of the file, in order
+    items = []
 
     # config
-    model_file.write("\\config\n")
-    model_file.write("version 1\n")
-    model_file.write("ngram_size {0}\n".format(options.n_gram))
-    model_file.write("input_vocab_size {0}\n".format(options.vocab_size))
-    model_file.write("output_vocab_size {0}\n".format(options.vocab_size))
-    model_file.write("input_embedding_dimension {0}\n".format(options.word_dim))
-    model_file.write("num_hidden {0}\n".format(options.hidden_dim1))
-    model_file.write("output_embedding_dimension {0}\n".format(options.hidden_dim2))
-    model_file.write("activation_function rectifier\n\n") # currently only supporting rectifier... 
+    items.append("\\config\n")
+    items.append("version 1\n")
+    items.append("ngram_size {0}\n".format(options.n_gram))
+    items.append("input_vocab_size {0}\n".format(options.vocab_size))
+    items.append("output_vocab_size {0}\n".format(options.vocab_size))
+    items.append("input_embedding_dimension {0}\n".format(options.word_dim))
+    items.append("num_hidden {0}\n".format(options.hidden_dim1))
+    items.append("output_embedding_dimension {0}\n".format(options.hidden_dim2))
+    items.append("activation_function rectifier\n\n") # currently only supporting rectifier... 
 
     # input_vocab
-    model_file.write("\\input_vocab\n")
+    items.append("\\input_vocab\n")
     for word in vocab:
-      model_file.write(word + "\n")
-    model_file.write("\n")
-    model_file.write("\\output_vocab\n")
+      items.append(word + "\n")
+    items.append("\n")
+    items.append("\\output_vocab\n")
     for word in vocab:
-      model_file.write(word + "\n")
-    model_file.write("\n")
+      items.append(word + "\n")
+    items.append("\n")
 
     [D, C, M, E, Cb, Mb, Eb] = net.weights()
 
     # input_embeddings
-    model_file.write("\\input_embeddings\n")
-    dump_matrix(D.T, model_file)
-    model_file.write("\n")
+    items.append("\\input_embeddings\n")
+    items.append(D.T)
+    items.append("\n")
 
     # hidden_weights 1
-    model_file.write("\\hidden_weights 1\n")
-    dump_matrix(C.T, model_file)
-    model_file.write("\n")
+    items.append("\\hidden_weights 1\n")
+    items.append(C.T)
+    items.append("\n")
 
     # hidden_biases 1
-    model_file.write("\\hidden_biases 1\n")
-    dump_matrix(Cb, model_file)
-    model_file.write("\n")
+    items.append("\\hidden_biases 1\n")
+    items.append(Cb)
+    items.append("\n")
 
     # hidden_weights 2
-    model_file.write("\\hidden_weights 2\n")
-    dump_matrix(M.T, model_file)
-    model_file.write("\n")
+    items.append("\\hidden_weights 2\n")
+    items.append(M.T)
+    items.append("\n")
 
     # hidden_biases 2
-    model_file.write("\\hidden_biases 2\n")
-    dump_matrix(Mb, model_file)
-    model_file.write("\n")
+    items.append("\\hidden_biases 2\n")
+    items.append(Mb)
+    items.append("\n")
 
     # output_weights
-    model_file.write("\\output_weights\n")
-    dump_matrix(E, model_file)
-    model_file.write("\n")
+    items.append("\\output_weights\n")
+    items.append(E)
+    items.append("\n")
 
     # output_biases
-    model_file.write("\\output_biases\n")
-    dump_matrix(Eb, model_file)
-    model_file.write("\n")
-
-    model_file.write("\\end")
-    model_file.close()
-
-def sgd(indexed_ngrams, predictions, net, options, epoch, noise_dist):
+    items.append("\\output_biases\n")
+    items.append(Eb)
+    items.append("\n")
+
+    items.append("\\end")
+    with open(model_dir, 'w') as model_file:
+      write_items(model_file, items, multiprocessing.cpu_count())
+
+# yields the (X, Y, N) batches of an epoch, each with its own noise sample
+# for performance issue, if the remaining data is smaller than batch_size, we just discard them
+def make_batches(indexed_ngrams, predictions, options, noise_sampler):
+  for start in range(0, len(indexed_ngrams) - options.batch_size + 1, options.batch_size):
+    X = np.asarray(indexed_ngrams[start: start + options.batch_size], dtype='int64')
+    Y = np.asarray(predictions[start: start + options.batch_size], dtype='int64')
+    N = noise_sampler.sample((options.batch_size, options.noise_sample_size)) # (batch_size, noise_sample_size)
+    yield (X, Y, N)
+
+def sgd(indexed_ngrams, predictions, net, options, epoch, noise_sampler):
   logging.info("epoch {0} started".format(epoch))  
   instance_count = 0
   batch_count = 0
-  # for performance issue, if the remaining data is smaller than batch_size, we just discard them
-  for start in range(0, len(indexed_ngrams), options.batch_size):
-    if len(indexed_ngrams) - start >= options.batch_size:
-      X = indexed_ngrams[start: start + options.batch_size]
-      Y = predictions[start: start + options.batch_size]
-      N = np.array(rand.distint(noise_dist, (options.batch_size, options.noise_sample_size)), dtype='int64') # (batch_size, noise_sample_size)
-      net.sgd(X, Y, N, floatX(options.learning_rate))
+  batches = make_batches(indexed_ngrams, predictions, options, noise_sampler)
+  for (X, Y, N) in prefetch(batches, size=options.prefetch, process=options.prefetch_process):
+    net.sgd(X, Y, N, floatX(options.learning_rate))
     instance_count += options.batch_size
     batch_count += 1
     if batch_count % 1 == 0:
       logging.info("{0} instances seen".format(instance_count))
-  N = np.array(rand.distint(noise_dist, (len(indexed_ngrams), options.noise_sample_size)))
+  # N = noise_sampler.sample((len(indexed_ngrams), options.noise_sample_size))
   # total_loss = net.loss(indexed_ngrams, predictions, N)
   # logging.info("epoch {0} finished with NCE loss {1}".format(epoch, total_loss))
   logging.info("epoch {0} finished".format(epoch))
@@ -300,6 +302,7 @@ def main(options):
     unigram_dist[v2i[key]] = floatX(unigram_count[key] / total_unigram_count)
   del unigram_count
   unigram_dist = np.array(unigram_dist, dtype=floatX)
+  noise_sampler = rand.distsampler(unigram_dist)
   logging.info("vocabulary collection finished")
 
   # training
@@ -315,7 +318,7 @@ def main(options):
   net = nplm(options.n_gram, len(vocab), options.word_dim, options.hidden_dim1, options.hidden_dim2,
       options.noise_sample_size, options.batch_size, unigram_dist)
   for epoch in range(1, options.max_epoch + 1):
-    sgd(indexed_ngrams, predictions, net, options, epoch, unigram_dist)
+    sgd(indexed_ngrams, predictions, net, options, epoch, noise_sampler)
     if epoch % options.save_interval == 0:
     	dump(net, options.working_dir + "/nplm.model." + str(epoch), options, vocab)
   logging.info("training finished")
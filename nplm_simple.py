@@ -14,6 +14,7 @@ import pdb
 import theano
 import theano.tensor as T
 import rand
+from prefetch import prefetch
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s: %(message)s',
@@ -33,6 +34,9 @@ parser.add_argument("--max-epoch", dest="max_epoch", type=int, metavar="INT", he
 parser.add_argument("--save-interval", dest="save_interval", type=int, metavar="INT", help="The epoch interval for saving models. Pass 0 if wish to save only once at the end of each epoch (default = 0).")
 parser.add_argument("--batch-size", "-b", dest="batch_size", type=int, metavar="INT", help="Batch size (in sentences) of SGD (default = 1000).")
 parser.add_argument("--gradient-check", dest="gradient_check", type=int, metavar="INT", help="The iteration interval for gradient check. Pass 0 if gradient check should not be performed (default = 0).")
+parser.add_argument("--prefetch", dest="prefetch", type=int, metavar="INT", help="Number of batches prepared in the background ahead of the training step. Pass 0 to prepare them in the training loop (default = 4).")
+parser.add_argument("--prefetch-process", dest="prefetch_process", action="store_true", help="Prepare the batches in a separate process (default = True).")
+parser.add_argument("--prefetch-thread", dest="prefetch_process", action="store_false", help="Prepare the batches in a thread of the training process instead, which saves pickling them but doesn't overlap with the training step, since theano holds the GIL while it runs (default = False).")
 
 parser.set_defaults(
   learning_rate=1.0,
@@ -44,7 +48,9 @@ parser.set_defaults(
   max_epoch=5,
   saving_interval=0,
   batch_size=1000,
-  gradient_check=0)
+  gradient_check=0,
+  prefetch=4,
+  prefetch_process=True)
 
 if theano.config.floatX=='float32':
   floatX = np.float32
@@ -145,18 +151,24 @@ class nplm:
             (self.b, self.b - lr * db)
             ])
 
+# yields the (X, Y) batches of an epoch
+def make_batches(indexed_ngrams, predictions, options, noise_dist):
+  for start in range(0, len(indexed_ngrams), options.batch_size):
+    X = np.asarray(indexed_ngrams[start: min(start + options.batch_size, len(indexed_ngrams))], dtype='int32')
+    Y = np.asarray(predictions[start: min(start + options.batch_size, len(indexed_ngrams))], dtype='int32')
+    # N = np.array(rand.distint(noise_dist, (min(options.batch_size, len(indexed_ngrams) - start), options.noise_sample_size)), dtype='int8') # (batch_size, noise_sample_size)
+    yield (X, Y)
+
 def sgd(indexed_ngrams, predictions, net, options, epoch, noise_dist):
   logging.info("epoch {0} started".format(epoch))  
   instance_count = 0
   batch_count = 0
-  for start in range(0, len(indexed_ngrams), options.batch_size):
-    X = indexed_ngrams[start: min(start + options.batch_size, len(indexed_ngrams))]
-    Y = predictions[start: min(start + options.batch_size, len(indexed_ngrams))]
-    # N = np.array(rand.distint(noise_dist, (min(options.batch_size, len(indexed_ngrams) - start), options.noise_sample_size)), dtype='int8') # (batch_size, noise_sample_size)
+  batches = make_batches(indexed_ngrams, predictions, options, noise_dist)
+  for (X, Y) in prefetch(batches, size=options.prefetch, process=options.prefetch_process):
     # net.sgd(X, Y, N, floatX(options.learning_rate))
     net.sgd(X, Y, floatX(options.learning_rate))
     # pdb.set_trace()
-    instance_count += min(options.batch_size, len(indexed_ngrams) - start)
+    instance_count += len(Y)
     batch_count += 1
     if batch_count % 1 == 0:
       logging.info("{0} instances seen".format(instance_count))
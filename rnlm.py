@@ -75,8 +75,7 @@ def main(options):
       x = [int(token) for token in tokens]
       y = x[1:]
       y.append(vocab.indexOf("</s>"))
-      net.sgd(x, y, options.learning_rate)
-      total_loss += net.loss(x, y)
+      total_loss += net.sgd(x, y, options.learning_rate)
       instance_count += 1
       if instance_count % 1 == 0:
         logging.info("{0} instances seen".format(instance_count))
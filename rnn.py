@@ -70,7 +70,8 @@ class rnn:
     self.pred = theano.function(inputs = [x], outputs = prediction)
     self.loss = theano.function(inputs = [x, y], outputs = loss)
     self.bptt = theano.function(inputs = [x, y], outputs = [dU, dW, dV])
-    self.sgd = theano.function([x, y, lr], [],
+    # returns the loss before the update, computed in the same forward pass
+    self.sgd = theano.function([x, y, lr], loss,
         updates = [(self.U, self.U - lr * dU), (self.W, self.W - lr * dW), (self.V, self.V - lr * dV)])
 
     # used if you want update in batch manner instead of per-sentence
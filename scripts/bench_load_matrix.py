@@ -0,0 +1,62 @@
+#! /usr/bin/python
+
+# Compares the block parser of nnjm.load_matrix with the loader it replaced
+#   (every line of a matrix concatenated into one string, then parsed by np.loadtxt)
+#   on all the matrices of a model in the Moses text format, e.g. NNJM.model.N.
+# Each loader runs in a fresh process, which reports its time and the growth of its peak RSS,
+#   i.e. the memory the loader needed on top of the file being open.
+# Also checks that both loaders give the same float32 weights.
+#
+# usage: PYTHONPATH=.:utils python scripts/bench_load_matrix.py MODEL_FILE
+
+from io import StringIO
+import multiprocessing
+import numpy as np
+import resource
+import sys
+import time
+import nnjm
+
+def old_load_matrix(model_file, shape):
+  line = model_file.readline()
+  mstr = ""
+  while line.strip() != "":
+    mstr += line
+    line = model_file.readline()
+  mstrio = StringIO(unicode(mstr))
+  return np.loadtxt(mstrio).astype(np.float32).reshape(shape)
+
+# loads every matrix of model_dir with load, returns the time, the peak RSS growth (MB) and the matrices
+def run(load, model_dir):
+  config = nnjm.read_model_config(model_dir)
+  shapes = nnjm.model_weight_shapes(config)
+  sections = nnjm.text_model_sections(config["hidden_dim1"])
+  start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start_time = time.time()
+  matrices = {}
+  with open(model_dir) as model_file:
+    for line in iter(model_file.readline, ""):
+      if line.startswith("\\") and line[1:].strip() in sections:
+        name = sections[line[1:].strip()]
+        matrices[name] = load(model_file, shapes[name][::-1] if name == "D" else shapes[name])
+  elapsed = time.time() - start_time
+  return elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 1024.0, matrices
+
+def run_in_process(load, model_dir, results):
+  results.put(run(load, model_dir))
+
+if __name__ == "__main__":
+  model_dir = sys.argv[1]
+  results = {}
+  for (name, load) in [("np.loadtxt", old_load_matrix), ("load_matrix", nnjm.load_matrix)]:
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_in_process, args=(load, model_dir, queue))
+    process.start()
+    results[name] = queue.get()
+    process.join()
+    print "{0:>12}: {1:8.2f}s {2:10.1f}MB peak RSS growth".format(name, results[name][0], results[name][1])
+  old_matrices = results["np.loadtxt"][2]
+  new_matrices = results["load_matrix"][2]
+  same = sorted(old_matrices.keys()) == sorted(new_matrices.keys()) and \
+      all(np.array_equal(old_matrices[name], new_matrices[name]) for name in old_matrices)
+  print "speedup {0:.1f}x, same weights: {1}".format(results["np.loadtxt"][0] / results["load_matrix"][0], same)
@@ -0,0 +1,44 @@
+#! /usr/bin/python
+
+# Compares rand.distint with rand.distsampler for drawing NCE noise samples
+#   from zipfian distributions over several vocabulary sizes.
+# Timings are per batch, i.e. per call made by the training loop.
+# Also reports the total variation distance between the empirical distribution of each sampler
+#   and the true distribution, which should be about the same for both.
+#
+# usage: PYTHONPATH=utils python scripts/bench_noise_sampler.py [NOISE_SAMPLE_SIZE] [BATCHES]
+
+import numpy as np
+import sys
+import time
+import rand
+
+noise_sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+batches = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+def zipf_dist(vocab_size):
+  dist = 1.0 / np.arange(1, vocab_size + 1)
+  return dist / np.sum(dist)
+
+def timed(f, repeat):
+  start = time.time()
+  for i in range(repeat):
+    result = f()
+  return (time.time() - start) / repeat, result
+
+print "{0:>8} {1:>14} {2:>14} {3:>14} {4:>9} {5:>12} {6:>12}".format(
+    "vocab", "distint (ms)", "build (ms)", "sample (ms)", "speedup", "tv distint", "tv sampler")
+for vocab_size in [16000, 50000, 500000]:
+  dist = zipf_dist(vocab_size)
+  (distint_time, _) = timed(lambda: rand.distint(dist, (noise_sample_size,)), batches)
+  (build_time, sampler) = timed(lambda: rand.distsampler(dist), 1)
+  (sample_time, _) = timed(lambda: sampler.sample((noise_sample_size,)), batches * 100)
+
+  n = 200000
+  old = np.bincount(rand.cum_distint(rand.accumulate_dist(dist), (n,)), minlength=vocab_size)
+  new = np.bincount(sampler.sample((n,)), minlength=vocab_size)
+  old_tv = 0.5 * np.sum(np.abs(old / float(n) - dist))
+  new_tv = 0.5 * np.sum(np.abs(new / float(n) - dist))
+
+  print "{0:>8} {1:>14.3f} {2:>14.3f} {3:>14.4f} {4:>9.0f} {5:>12.4f} {6:>12.4f}".format(
+      vocab_size, distint_time * 1000, build_time * 1000, sample_time * 1000, distint_time / sample_time, old_tv, new_tv)
@@ -0,0 +1,74 @@
+#! /usr/bin/python
+
+# Measures what --prefetch buys nnjm.py with each kind of producer, on random instances and a network of the given sizes.
+# First reports how far a python thread gets while the training step (net.sgd) runs, relative to an idle step:
+#   a thread producing batches can only overlap with the step as much as the step releases the GIL.
+# Then times an epoch with the batches prepared inline (--prefetch 0), by a thread and by a process (--prefetch 4).
+# The process can only run beside the step on a machine with more than one core.
+#
+# usage: PYTHONPATH=.:utils python scripts/bench_prefetch.py [TARGET_VOCAB_SIZE] [HIDDEN_DIM2] [BATCHES]
+
+import numpy as np
+import sys
+import threading
+import time
+import nnjm
+import rand
+from utils.prefetch import prefetch
+
+target_vocab_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+hidden_dim2 = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+batches = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+# counts in a thread until stopped
+class spinner(object):
+  def __init__(self):
+    self.count = 0
+    self.stopped = False
+    self.thread = threading.Thread(target=self.spin)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def spin(self):
+    while not self.stopped:
+      self.count += 1
+
+  # the count reached by the thread within f()
+  def during(self, f):
+    start = self.count
+    f()
+    return self.count - start
+
+def timed_epoch(net, options, noise_sampler, X, Y, size, process):
+  start = time.time()
+  for (bX, bY, bN) in prefetch(nnjm.make_batches(X, Y, options, noise_sampler), size=size, process=process):
+    net.sgd(bX, bY, bN, nnjm.floatX(options.learning_rate))
+  return time.time() - start
+
+if __name__ == "__main__":
+  options = nnjm.parser.parse_args(["-w", "."])
+  net = nnjm.NNJM(13, target_vocab_size, target_vocab_size, word_dim=options.word_dim, hidden_dim1=0, hidden_dim2=hidden_dim2,
+      noise_sample_size=options.noise_sample_size, batch_size=options.batch_size)
+  dist = 1.0 / np.arange(1, target_vocab_size + 1)
+  noise_sampler = rand.distsampler(dist / np.sum(dist))
+  X = np.random.randint(target_vocab_size, size=(batches * options.batch_size, 13)).astype('uint16')
+  Y = np.random.randint(target_vocab_size, size=batches * options.batch_size).astype('uint16')
+  (bX, bY, bN) = next(nnjm.make_batches(X, Y, options, noise_sampler))
+  step = lambda: net.sgd(bX, bY, bN, nnjm.floatX(options.learning_rate))
+  step()
+
+  s = spinner()
+  start = time.time()
+  step()
+  step_time = time.time() - start
+  idle = s.during(lambda: time.sleep(step_time))
+  busy = s.during(step)
+  s.stopped = True
+  print "training step {0:.1f}ms: a python thread got {1:.0%} as far as while idle".format(step_time * 1000, float(busy) / idle)
+
+  print "{0:>10} {1:>10} {2:>10}".format("producer", "epoch (s)", "speedup")
+  inline = timed_epoch(net, options, noise_sampler, X, Y, 0, False)
+  print "{0:>10} {1:>10.2f} {2:>10}".format("inline", inline, "")
+  for (name, process) in [("thread", False), ("process", True)]:
+    epoch = timed_epoch(net, options, noise_sampler, X, Y, 4, process)
+    print "{0:>10} {1:>10.2f} {2:>10.2f}".format(name, epoch, inline / epoch)
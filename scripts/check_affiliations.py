@@ -0,0 +1,47 @@
+#! /usr/bin/python
+
+# Checks that utils.heuristics.get_affiliations (one sentence at a time) and get_all_affiliations (the whole corpus at once)
+#   give the same affiliated source position as the per-position get_effective_align they replaced,
+#   at every position of every sentence of an alignment file (by default the n-best alignments of corpus/toy),
+#   for target sentences as long as the lines of the target file plus <s> and </s>, as make_training_instances sees them.
+# Exits with 1 if any position differs.
+#
+# usage: PYTHONPATH=.:utils python scripts/check_affiliations.py [TARGET_FILE ALIGNMENT_FILE]
+
+import numpy as np
+import sys
+from utils.heuristics import get_affiliations, get_all_affiliations, get_nearest_src_align, read_alignment
+
+# get_effective_align as it was, with -1 for no affiliation instead of None
+def old_effective_align(align, idx):
+  ta2sa = {}
+  for sa, ta in align:
+    ta2sa.setdefault(ta, []).append(sa)
+  if idx in ta2sa:
+    _s = sorted(ta2sa[idx])
+    return _s[int(len(_s)/2)]
+  nearest_sa = get_nearest_src_align(ta2sa, idx)
+  return -1 if nearest_sa is None else nearest_sa
+
+if __name__ == "__main__":
+  (target_file, align_file) = sys.argv[1:3] if len(sys.argv) > 2 else ("corpus/toy/toy.nbest.trg", "corpus/toy/toy.nbest.align")
+  with open(target_file) as f:
+    lengths = [len(line.split()) + 2 for line in f]
+  aligns = read_alignment(align_file)
+  num_sentences = min(len(lengths), len(aligns))
+  lengths = lengths[:num_sentences]
+
+  old = []
+  new = []
+  for (align, length) in zip(aligns, lengths):
+    old.append([old_effective_align(align, idx) for idx in range(length)])
+    new.append(get_affiliations(align, length).tolist())
+  all_new = get_all_affiliations(read_alignment(align_file, flat=True).head(num_sentences), lengths).tolist()
+
+  old_flat = sum(old, [])
+  same = old == new
+  all_same = old_flat == all_new
+  print "{0} sentences, {1} positions, {2} without affiliation".format(num_sentences, len(old_flat), old_flat.count(-1))
+  print "get_affiliations:     {0}".format("same as get_effective_align" if same else "DIFFERENT")
+  print "get_all_affiliations: {0}".format("same as get_effective_align" if all_same else "DIFFERENT")
+  sys.exit(0 if same and all_same else 1)
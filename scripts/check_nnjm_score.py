@@ -0,0 +1,72 @@
+#! /usr/bin/python
+
+# Checks nnjm_score.py on corpus/toy cut to different line counts (target, source and alignment files of
+#   30, 28 and 31 lines), with a random model whose output layer is scaled up so that its scores overflow exp:
+#   only the 28 sentences of the shortest file are scored, the scores are finite and equal to a numpy forward pass
+#   (with a float64 log-sum-exp), and they are the same with 1 and 3 workers.
+# Exits with 1 if any check fails.
+#
+# usage: PYTHONPATH=.:utils python scripts/check_nnjm_score.py
+
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import nnjm
+import nnjm_score
+from utils.numberizer import numberizer
+from utils.numberizer import TARGET_TYPE, SOURCE_TYPE
+
+TOY = "corpus/toy"
+
+# log p(Y | X) of every instance, computed with numpy in float64 from the weights of a model
+def reference_log_probs(config, weights, X, Y):
+  w = dict((name, weight.astype(np.float64)) for (name, weight) in weights.items())
+  h = w["D"][:, X].transpose(1, 2, 0).reshape(len(X), -1).T # (num_inputs * word_dim, instances)
+  if config["hidden_dim1"] > 0:
+    h = np.maximum(w["C"].dot(h) + w["Cb"], 0)
+  h = np.maximum(w["M"].dot(h) + w["Mb"], 0)
+  scores = (w["E"].dot(h) + w["Eb"]).T # (instances, target_vocab_size)
+  top = np.max(scores, axis=1)
+  return scores[np.arange(len(Y)), Y] - top - np.log(np.sum(np.exp(scores - top[:, np.newaxis]), axis=1))
+
+def head(path, lines, output_path):
+  with open(path) as f, open(output_path, 'w') as output:
+    for i in range(lines):
+      output.write(f.readline())
+
+def check(name, ok):
+  print "{0:<60} {1}".format(name, "ok" if ok else "FAILED")
+  return ok
+
+if __name__ == "__main__":
+  work_dir = tempfile.mkdtemp()
+  try:
+    head(os.path.join(TOY, "toy.nbest.trg"), 30, os.path.join(work_dir, "trg"))
+    head(os.path.join(TOY, "toy.src.rep"), 28, os.path.join(work_dir, "src"))
+    head(os.path.join(TOY, "toy.nbest.align"), 31, os.path.join(work_dir, "align"))
+    nz = numberizer(limit=1000)
+    nz.build_vocabs([(TARGET_TYPE, os.path.join(work_dir, "trg")), (SOURCE_TYPE, os.path.join(work_dir, "src"))])
+    numberizer.save(nz, os.path.join(work_dir, "numberizer.pickle"))
+
+    net = nnjm.NNJM(13, len(nz.v2i), len(nz.t2i), word_dim=8, hidden_dim1=0, hidden_dim2=16)
+    weights = net.weight_dict()
+    # scores of 100 and more, past the range of exp in float32 (about 88)
+    weights["E"] = weights["E"] * 2000
+    weights["Eb"] = weights["Eb"] + 100
+    nnjm.write_binary_model(os.path.join(work_dir, "model.bin"), net.config(), weights)
+
+    options = nnjm_score.parser.parse_args(["-m", os.path.join(work_dir, "model.bin"), "-z", os.path.join(work_dir, "numberizer.pickle"),
+        "-t", os.path.join(work_dir, "trg"), "-s", os.path.join(work_dir, "src"), "-a", os.path.join(work_dir, "align")])
+    scoring_net = nnjm_score.load_shared_net(options, nz)
+    (X, Y, sentences, num_sentences) = nnjm_score.load_instances(nz, options)
+    ok = check("only the sentences of the shortest file are scored", num_sentences == 28 and len(X) == len(sentences))
+    log_probs = nnjm_score.score(scoring_net, X, Y, 1, 64)
+    reference = reference_log_probs(net.config(), weights, X.astype('int64'), Y.astype('int64'))
+    ok &= check("scores are finite", np.all(np.isfinite(log_probs)))
+    ok &= check("scores equal the numpy forward pass", np.allclose(log_probs, reference, rtol=1e-4, atol=1e-2))
+    ok &= check("scores are the same with 3 workers", np.array_equal(nnjm_score.score(scoring_net, X, Y, 3, 64), log_probs))
+  finally:
+    shutil.rmtree(work_dir)
+  sys.exit(0 if ok else 1)
@@ -0,0 +1,70 @@
+# binfile -- versioned binary container of named numpy arrays, read back through a memory map
+#
+# layout: MAGIC, the length of the header (8 bytes, little endian), the header as JSON, then the arrays,
+#   raw and 64-byte aligned; the header holds the kind of file (e.g. "numberizer") and its format version,
+#   the metadata given by the writer, and the dtype, shape and offset of every array
+# loading maps the file and returns the arrays as read-only views into it, so nothing is read
+#   until it's used, and processes mapping the same file share its pages
+
+import json
+import numpy as np
+import os
+import struct
+
+MAGIC = b"NNJMBIN\x00"
+ALIGNMENT = 64
+
+def is_binfile(path):
+  with open(path, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+# arrays is a list of (name, array) pairs, metadata anything json can hold
+def save(path, kind, version, metadata, arrays):
+  arrays = [(name, np.ascontiguousarray(array)) for (name, array) in arrays]
+  # the offsets depend on the length of the header, which depends on the offsets:
+  #   offsets are counted from the end of a header padded to a multiple of ALIGNMENT
+  entries = []
+  offset = 0
+  for (name, array) in arrays:
+    entries.append({"name": name, "dtype": array.dtype.str, "shape": array.shape, "offset": offset})
+    offset += (array.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+  header = json.dumps({"kind": kind, "version": version, "metadata": metadata, "arrays": entries})
+  data_start = (len(MAGIC) + 8 + len(header) + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+  header += " " * (data_start - len(MAGIC) - 8 - len(header))
+
+  tmp_path = path + ".tmp.{0}".format(os.getpid())
+  with open(tmp_path, 'wb') as f:
+    f.write(MAGIC)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    for ((name, array), entry) in zip(arrays, entries):
+      f.seek(data_start + entry["offset"])
+      f.write(array.data)
+    f.truncate(data_start + offset)
+  os.rename(tmp_path, path)
+
+# returns the version, the metadata and a dict of the arrays of a file written by save with the same kind
+# mode is that of np.memmap: 'r' maps the arrays read-only, 'c' copy-on-write
+#   (writable, the pages written to are copied and the file is left alone)
+def load(path, kind, mode='r'):
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise Exception("{0} is not a binary file of this package".format(path))
+    (header_length,) = struct.unpack("<Q", f.read(8))
+    header = json.loads(f.read(header_length))
+  if header["kind"] != kind:
+    raise Exception("{0} holds a {1}, not a {2}".format(path, header["kind"], kind))
+  data_start = len(MAGIC) + 8 + header_length
+  arrays = {}
+  if os.path.getsize(path) > data_start:
+    # plain ndarray views of one map, indexing a np.memmap subclass is slower
+    data = np.memmap(path, dtype=np.uint8, mode=mode, offset=data_start).view(np.ndarray)
+  for entry in header["arrays"]:
+    dtype = np.dtype(str(entry["dtype"]))
+    shape = tuple(entry["shape"])
+    nbytes = dtype.itemsize * int(np.prod(shape))
+    if nbytes == 0:
+      arrays[entry["name"]] = np.zeros(shape, dtype=dtype)
+    else:
+      arrays[entry["name"]] = data[entry["offset"]: entry["offset"] + nbytes].view(dtype).reshape(shape)
+  return header["version"], header["metadata"], arrays
@@ -0,0 +1,65 @@
+# cache -- content-addressed on-disk cache of numpy arrays
+#
+# arrays derived from a set of input files (e.g. the extracted training instances) are stored as .npy files
+#   in a directory named after a hash of the contents of these files and of everything else the arrays depend on,
+#   so that later runs on the same inputs can memory-map them instead of rebuilding them
+
+import hashlib
+import numpy as np
+import os
+
+# hex digest of the contents of the given files (None entries are skipped) and of the other keys,
+#   which can be anything with a stable repr (strings, numbers, tuples of them...)
+def digest(paths, *keys):
+  h = hashlib.sha1()
+  for path in paths:
+    if path is None:
+      h.update("<none>")
+      continue
+    # the size goes first, so that the boundaries between files are part of the hash as well
+    h.update(str(os.path.getsize(path)))
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+  for key in keys:
+    h.update(repr(key))
+  return h.hexdigest()
+
+def array_file(cache_dir, name):
+  return os.path.join(cache_dir, name + ".npy")
+
+# returns the arrays with the given names as read-only memory maps, or None if any of them isn't cached
+def load_arrays(cache_dir, names):
+  if not all(os.path.exists(array_file(cache_dir, name)) for name in names):
+    return None
+  return [np.load(array_file(cache_dir, name), mmap_mode='r') for name in names]
+
+# arrays are written to a temporary file first and then renamed,
+#   so that an interrupted run never leaves a truncated array behind
+def save_arrays(cache_dir, names, arrays):
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  for name, array in zip(names, arrays):
+    tmp_file = _tmp_file(cache_dir, name)
+    with open(tmp_file, 'wb') as f:
+      np.save(f, array)
+    os.rename(tmp_file, array_file(cache_dir, name))
+
+# saves the concatenation of parts (along the first axis) as the array name,
+#   copying the parts one by one into a memory-mapped file, so the whole array is never held in memory
+def save_concatenated(cache_dir, name, parts):
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  tmp_file = _tmp_file(cache_dir, name)
+  shape = (sum(len(part) for part in parts),) + parts[0].shape[1:]
+  array = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=parts[0].dtype, shape=shape)
+  start = 0
+  for part in parts:
+    array[start: start + len(part)] = part
+    start += len(part)
+  array.flush()
+  del array
+  os.rename(tmp_file, array_file(cache_dir, name))
+
+def _tmp_file(cache_dir, name):
+  return array_file(cache_dir, name) + ".tmp.{0}".format(os.getpid())
@@ -1,12 +1,58 @@
 from numberizer import SOURCE_TYPE, TARGET_TYPE
+import numpy as np
+from ragged import ragged
 
-def read_alignment(align_file):
-  n_align = []
-  with open(align_file) as f:
-    for line in f:
-      n = [(int(t.split('-')[0]), int(t.split('-')[1])) for t in line.strip().split()]
-      n_align.append(n)
-  return n_align
+# reads a giza-style alignment file ("i-j" source-target links, one line per sentence pair)
+#   in large blocks, each of them parsed at once by parse_alignment_block
+# with flat=True, the alignments are a ragged (see ragged.py) of int16 (source position, target position) links,
+#   otherwise a list of lists of (source position, target position) tuples
+def read_alignment(align_file, flat=False, block_size=1 << 26):
+  blocks = []
+  rest = b''
+  with open(align_file, 'rb') as f:
+    for data in iter(lambda: f.read(block_size), b''):
+      # blocks end at the last line break, the rest of the line goes with the next block
+      data = rest + data
+      end = data.rfind(b'\n') + 1
+      if end > 0:
+        blocks.append(parse_alignment_block(data[:end]))
+      rest = data[end:]
+  if rest or not blocks:
+    blocks.append(parse_alignment_block(rest))
+  return alignment_result(ragged.concatenate(blocks), flat)
+
+# same as read_alignment, for any iterable of lines (e.g. a line range of the file)
+def parse_alignment(lines, flat=False):
+  return alignment_result(parse_alignment_block(b''.join(lines)), flat)
+
+# the alignments of all the lines of data, a block of a giza-style alignment file,
+#   with the positions converted by numpy all at once rather than token by token
+def parse_alignment_block(data):
+  chars = np.frombuffer(data, dtype=np.uint8)
+  # every link has a hyphen, so the links of a line are the hyphens between its line breaks
+  hyphens = np.flatnonzero(chars == ord('-'))
+  line_ends = np.searchsorted(hyphens, np.flatnonzero(chars == ord('\n')))
+  if len(chars) > 0 and chars[-1] != ord('\n'):
+    line_ends = np.append(line_ends, len(hyphens))
+  # numpy reads a block with nothing but whitespace as a single 0
+  if len(hyphens) > 0:
+    positions = np.fromstring(data.replace(b'-', b' '), dtype='int64', sep=' ')
+  else:
+    positions = np.zeros(int(np.any((chars >= ord('0')) & (chars <= ord('9')))), dtype='int64')
+  if len(positions) != 2 * len(hyphens):
+    raise Exception("malformed alignment: {0} positions for {1} links".format(len(positions), len(hyphens)))
+  if len(positions) > 0 and positions.max() > np.iinfo(np.int16).max:
+    raise Exception("alignment position {0} doesn't fit in int16".format(positions.max()))
+  offsets = np.zeros(len(line_ends) + 1, dtype='int64')
+  offsets[1:] = line_ends
+  return ragged(positions.astype('int16').reshape((-1, 2)), offsets)
+
+def alignment_result(alignments, flat):
+  if flat:
+    return alignments
+  links = zip(alignments.values[:, 0].tolist(), alignments.values[:, 1].tolist())
+  offsets = alignments.offsets.tolist()
+  return [links[offsets[i]: offsets[i + 1]] for i in range(len(alignments))]
 
 def get_left_src(nz, src, a, w):
   lsc =  src[a - w if a - w > 0 else 0: a]
@@ -37,26 +83,85 @@ def get_nearest_src_align(ta2sa, idx):
         pass
 
 def get_effective_align(align, idx):
-  ta2sa = {}
-  sa2ta = {}
-  for sa,ta in align:
-    _s = ta2sa.get(ta, [])
-    _s.append(sa)
-    ta2sa[ta] = _s
-    _t = sa2ta.get(sa, [])
-    _t.append(ta)
-    sa2ta[sa] = _t
-  if idx in ta2sa and len(ta2sa[idx]) == 1:
-    #if target word is aligned to just one source word
-    return ta2sa[idx][0]
-  elif idx in ta2sa and len(ta2sa[idx]) > 1:
-    #if target word is aligned to many source words, pick the middle alignment
-    _s = sorted(ta2sa[idx])
-    return _s[int(len(_s)/2)]
-  elif idx not in ta2sa:
-    #if the target word is aligned to null
-    nearest_sa = get_nearest_src_align(ta2sa, idx)
-    return nearest_sa
-  else:
-    raise NotImplementedError
+  sa = get_affiliations(align, idx + 1)[idx]
+  return sa if sa >= 0 else None
+
+# affiliated source position of every target position in [0, length) of a sentence, in one pass over its alignment
+# the result is the same as calling get_effective_align on each position:
+#   a target word aligned to several source words is affiliated with the middle one,
+#   a target word aligned to null takes the affiliation of the nearest aligned target word (the right one on ties)
+#   no more than 99 positions away, or -1 if there is none
+def get_affiliations(align, length):
+  size = max([length] + [ta + 1 for sa, ta in align])
+  ta2sa = [[] for ta in range(size)]
+  for sa, ta in align:
+    ta2sa[ta].append(sa)
+  affiliations = [-1] * size
+  for ta, sas in enumerate(ta2sa):
+    if len(sas) > 0:
+      sas.sort()
+      affiliations[ta] = sas[int(len(sas)/2)]
+
+  # nearest aligned target position on the right of each position, scanning from the end
+  right = [-1] * size
+  nearest = -1
+  for ta in range(size - 1, -1, -1):
+    if len(ta2sa[ta]) > 0:
+      nearest = ta
+    right[ta] = nearest
+  # then the nearest one on the left, filling in the null-aligned positions
+  nearest = -1
+  for ta in range(size):
+    if len(ta2sa[ta]) > 0:
+      nearest = ta
+      continue
+    dr = right[ta] - ta if right[ta] >= 0 else size
+    dl = ta - nearest if nearest >= 0 else size
+    if dr <= dl and dr < 100:
+      affiliations[ta] = affiliations[right[ta]]
+    elif dl < dr and dl < 100:
+      affiliations[ta] = affiliations[nearest]
+  return np.array(affiliations[:length], dtype='int64')
+
+# get_affiliations of all the sentences of a corpus at once, with numpy instead of a python loop per position
+# align is a ragged (see ragged.py) of (source position, target position) links, one row per sentence,
+#   and lengths are the lengths of the target sentences
+# returns the affiliations of every position of every target sentence, back to back
+def get_all_affiliations(align, lengths):
+  lengths = np.asarray(lengths, dtype='int64')
+  sa = align.values[:, 0].astype('int64')
+  ta = align.values[:, 1].astype('int64')
+  sentences = align.row_ids()
+  # like in get_affiliations, aligned positions past the end of the sentence are still neighbours
+  sizes = lengths.copy()
+  linked = align.lengths() > 0
+  if np.any(linked):
+    sizes[linked] = np.maximum(sizes[linked], np.maximum.reduceat(ta + 1, align.offsets[:-1][linked] - align.offsets[0]))
+  starts = np.zeros(len(sizes) + 1, dtype='int64')
+  starts[1:] = np.cumsum(sizes)
+  total = starts[-1]
+  positions = np.arange(total)
+  sentence_starts = np.repeat(starts[:-1], sizes)
+  sentence_ends = np.repeat(starts[1:], sizes)
+
+  # the middle of the sorted source positions aligned to each target position
+  links = starts[sentences] + ta
+  # sorting the links by target position then source position, as a single key
+  scale = sa.max() + 1 if len(sa) > 0 else 1
+  sorted_sa = np.sort(links * scale + sa) % scale
+  counts = np.bincount(links, minlength=total)
+  firsts = np.cumsum(counts) - counts
+  aligned = counts > 0
+  affiliations = np.full(total, -1, dtype='int64')
+  affiliations[aligned] = sorted_sa[firsts[aligned] + counts[aligned] // 2]
 
+  # the nearest aligned position on each side, within the same sentence
+  right = np.minimum.accumulate(np.where(aligned, positions, total)[::-1])[::-1]
+  left = np.maximum.accumulate(np.where(aligned, positions, -1))
+  dr = np.where(right < sentence_ends, right - positions, total + 100)
+  dl = np.where(left >= sentence_starts, positions - left, total + 100)
+  from_right = ~aligned & (dr <= dl) & (dr < 100)
+  from_left = ~aligned & (dl < dr) & (dl < 100)
+  affiliations[from_right] = affiliations[right[from_right]]
+  affiliations[from_left] = affiliations[left[from_left]]
+  return affiliations[positions - sentence_starts < np.repeat(lengths, sizes)]
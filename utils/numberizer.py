@@ -7,11 +7,18 @@
 # 
 # April, 2016
 
+import array
+import binfile
+import bisect
 from collections import Counter
 import codecs
+import itertools
 import logging
+import multiprocessing
+import numpy as np
 import operator
 import cPickle as pickle
+from ragged import ragged
 import sys
 
 logging.basicConfig(
@@ -20,6 +27,159 @@ logging.basicConfig(
 global TARGET_TYPE, SOURCE_TYPE
 TARGET_TYPE='t'
 SOURCE_TYPE='s'
+
+# files smaller than this are counted as one range
+MIN_RANGE_SIZE = 1 << 20
+# and larger ones are read at most this many bytes at a time
+MAX_RANGE_SIZE = 1 << 26
+
+# splits the file into about num_ranges (start, end) byte ranges that begin at the start of a line
+def byte_ranges(path, num_ranges):
+  with open(path, 'rb') as f:
+    f.seek(0, 2)
+    size = f.tell()
+    num_ranges = max(min(num_ranges, size // MIN_RANGE_SIZE), (size + MAX_RANGE_SIZE - 1) // MAX_RANGE_SIZE, 1)
+    starts = [0]
+    for i in range(1, num_ranges):
+      f.seek(max(i * size // num_ranges - 1, starts[-1]))
+      f.readline()
+      if f.tell() < size and f.tell() > starts[-1]:
+        starts.append(f.tell())
+  return zip(starts, starts[1:] + [size])
+
+# runs in the pool of build_vocabs: counts the lines and the words of a byte range,
+#   returns the number of lines, the words in the order they first appear and their counts
+def count_range(byte_range):
+  (path, start, end) = byte_range
+  with open(path, 'rb') as f:
+    f.seek(start)
+    text = f.read(end - start).decode('utf8')
+  w2c = {}
+  words = []
+  for word in text.split():
+    if word in w2c:
+      w2c[word] += 1
+    else:
+      w2c[word] = 1
+      words.append(word)
+  # codecs.open splits the lines of a file the way unicode.splitlines does, and the line breaks are whitespace for split
+  return len(text.splitlines()), words, [w2c[word] for word in words]
+
+BINARY_VERSION = 1
+
+# one side of a binary numberizer file: its words, sorted as utf-8 strings, with their ids and counts
+# words are looked up by binary search, and the result is remembered, so only the words that are
+#   actually looked up ever get into a python dict
+class vocab_table:
+
+  def __init__(self, path, vocab_type):
+    self.path = path
+    self.vocab_type = vocab_type
+    (_, _, arrays) = binfile.load(path, "numberizer")
+    self.words = arrays[vocab_type + ".words"]
+    self.offsets = arrays[vocab_type + ".offsets"]
+    self.values = {"ids": arrays[vocab_type + ".ids"], "counts": arrays[vocab_type + ".counts"]}
+    self.indices = {}
+
+  # the maps are pickled as their file (e.g. when sent to a pool), not as their contents
+  def __getstate__(self):
+    return (self.path, self.vocab_type)
+
+  def __setstate__(self, state):
+    self.__init__(*state)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  # as a sequence, for bisect
+  def __getitem__(self, index):
+    return self.words[self.offsets[index]: self.offsets[index + 1]].tostring()
+
+  def word(self, index):
+    return self[index].decode('utf8')
+
+  # index of word in the table, or -1
+  def find(self, word):
+    index = self.indices.get(word)
+    if index is None:
+      encoded = word.encode('utf8') if isinstance(word, unicode) else word
+      index = bisect.bisect_left(self, encoded)
+      if index == len(self) or self[index] != encoded:
+        index = -1
+      self.indices[word] = index
+    return index
+
+# read-only dict over the ids or the counts of a vocab_table
+class vocab_map:
+
+  def __init__(self, table, values):
+    self.table = table
+    self.values = table.values[values]
+
+  def __len__(self):
+    return len(self.table)
+
+  def __contains__(self, word):
+    return self.table.find(word) >= 0
+
+  def __getitem__(self, word):
+    index = self.table.find(word)
+    if index < 0:
+      raise KeyError(word)
+    return int(self.values[index])
+
+  def get(self, word, default=None):
+    index = self.table.find(word)
+    return default if index < 0 else int(self.values[index])
+
+  def iterkeys(self):
+    return (self.table.word(index) for index in xrange(len(self.table)))
+
+  def iteritems(self):
+    return ((self.table.word(index), int(self.values[index])) for index in xrange(len(self.table)))
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def items(self):
+    return list(self.iteritems())
+
+  __iter__ = iterkeys
+
+# read-only dict over (vocab_type, word) keys, like numberizer.v2i, made of one vocab_map per type
+class typed_vocab_map:
+
+  def __init__(self, maps):
+    self.maps = maps
+
+  def __len__(self):
+    return sum(len(m) for m in self.maps.values())
+
+  def __contains__(self, key):
+    return key[0] in self.maps and key[1] in self.maps[key[0]]
+
+  def __getitem__(self, key):
+    if key[0] not in self.maps:
+      raise KeyError(key)
+    return self.maps[key[0]][key[1]]
+
+  def get(self, key, default=None):
+    return self.maps[key[0]].get(key[1], default) if key[0] in self.maps else default
+
+  def iterkeys(self):
+    return ((vocab_type, word) for (vocab_type, m) in self.maps.items() for word in m.iterkeys())
+
+  def iteritems(self):
+    return (((vocab_type, word), i) for (vocab_type, m) in self.maps.items() for (word, i) in m.iteritems())
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def items(self):
+    return list(self.iteritems())
+
+  __iter__ = iterkeys
+
 class numberizer:
 
   # vocabulary limit = 0 means no vocabulary truncating will be performed
@@ -50,13 +210,51 @@ class numberizer:
     return True
   
   # XXX: YOU CANNOT LOAD SELF WITH PICKLE
+  # reads both the pickled and the binary (see save_binary) formats
   @staticmethod
   def load(load_file):
+    if binfile.is_binfile(load_file):
+      return numberizer.load_binary(load_file)
     load_file = open(load_file, 'rb')
     n = pickle.load(load_file)
     load_file.close()
     return n
 
+  # saves the vocabulary as the sorted words of each side with their ids and counts,
+  #   which load_binary maps instead of unpickling dicts of the whole vocabulary
+  def save_binary(self, save_file):
+    arrays = []
+    for (vocab_type, w2i, w2c) in [(TARGET_TYPE, self.t2i, self.t2c), (SOURCE_TYPE, self.s2i, self.s2c)]:
+      if sorted(w2c.keys()) != sorted(w2i.keys()) or any(self.v2i.get((vocab_type, w)) != i for (w, i) in w2i.iteritems()):
+        raise Exception("the {0} side of the vocabulary is inconsistent, it can't be saved in the binary format".format(vocab_type))
+      words = sorted((w.encode('utf8'), w) for w in w2i)
+      offsets = np.zeros(len(words) + 1, dtype='int64')
+      offsets[1:] = np.cumsum([len(encoded) for (encoded, _) in words])
+      arrays.append((vocab_type + ".words", np.frombuffer(b"".join(encoded for (encoded, _) in words), dtype=np.uint8)))
+      arrays.append((vocab_type + ".offsets", offsets))
+      arrays.append((vocab_type + ".ids", np.array([w2i[w] for (_, w) in words], dtype='int32')))
+      arrays.append((vocab_type + ".counts", np.array([w2c[w] for (_, w) in words], dtype='int64')))
+    if len(self.v2i) != len(self.t2i) + len(self.s2i):
+      raise Exception("the vocabulary has words that are neither target nor source words, it can't be saved in the binary format")
+    metadata = {"limit": self.limit, "unk": self.unk, "bos": self.bos, "eos": self.eos}
+    binfile.save(save_file, "numberizer", BINARY_VERSION, metadata, arrays)
+
+  # the dicts of the returned numberizer are read-only maps over the file, see vocab_table
+  @staticmethod
+  def load_binary(load_file):
+    (version, metadata, _) = binfile.load(load_file, "numberizer")
+    if version > BINARY_VERSION:
+      raise Exception("{0} has binary numberizer version {1}, this code only reads up to version {2}".format(load_file, version, BINARY_VERSION))
+    n = numberizer(limit=metadata["limit"], unk=metadata["unk"], bos=metadata["bos"], eos=metadata["eos"])
+    target = vocab_table(load_file, TARGET_TYPE)
+    source = vocab_table(load_file, SOURCE_TYPE)
+    n.t2i = vocab_map(target, "ids")
+    n.t2c = vocab_map(target, "counts")
+    n.s2i = vocab_map(source, "ids")
+    n.s2c = vocab_map(source, "counts")
+    n.v2i = typed_vocab_map({TARGET_TYPE: n.t2i, SOURCE_TYPE: n.s2i})
+    return n
+
   def save_vocab_in_moses_format(self, save_vocab_file):
     src_vocab_file = open(save_vocab_file + ".source", 'w')
     trg_vocab_file = open(save_vocab_file + ".target", 'w') 
@@ -70,30 +268,43 @@ class numberizer:
     src_vocab_file.close()
     trg_vocab_file.close()
 
-  def build_vocab(self,vocab_type, text_file):
-    # self.v2i[vocab_type, self.bos] = self.v2i.get((vocab_type, self.bos), len(self.v2i))
-    # self.v2i[vocab_type, self.eos] = self.v2i.get((vocab_type, self.eos), len(self.v2i))
-    # self.v2i[vocab_type, self.unk] = self.v2i.get((vocab_type, self.unk), len(self.v2i))
-    w2c = {} #temporarily holds words to count...
-    with codecs.open(text_file, 'r', 'utf8') as f:
-      for line in f:
-        # augment bos and eos
-        if vocab_type == TARGET_TYPE:
-            w2c[self.bos] = w2c.get(self.bos, 0) + 1
-            w2c[self.eos] = w2c.get(self.eos, 0) + 1
-        else: 
-            w2c[self.bos] = w2c.get(self.bos, 0) + 1 #self.s2i.get(self.bos, len(self.s2i))
-            w2c[self.eos] = w2c.get(self.eos, 0) + 1 #self.s2i.get(self.eos, len(self.s2i))
-        # collect "real" vocab
-        for word in line.split():
-          #self.v2i[vocab_type, word] = self.v2i.get((vocab_type, word), len(self.v2i))
-          if vocab_type == TARGET_TYPE:
-            w2c[word] = w2c.get(word, 0) + 1
-            #self.t2i[word] = self.t2i.get(word, len(self.t2i))
-          else:
-            w2c[word] = w2c.get(word, 0) + 1
-            #self.s2i[word] = self.s2i.get(word, len(self.s2i))
+  def build_vocab(self,vocab_type, text_file, processes=1):
+    self.build_vocabs([(vocab_type, text_file)], processes)
+
+  # builds the vocabulary of several (vocab_type, text_file) sides of a corpus in one go:
+  #   each file is split into byte ranges that a pool of processes counts, the counts of the ranges
+  #   are then merged in file order, which gives the same vocabulary (ids included) as counting line by line
+  def build_vocabs(self, sides, processes=1):
+    ranges = [(side, (path, start, end)) for (side, (_, path)) in enumerate(sides) for (start, end) in byte_ranges(path, processes)]
+    if processes > 1:
+      pool = multiprocessing.Pool(processes)
+      try:
+        range_counts = pool.map(count_range, [byte_range for (_, byte_range) in ranges])
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      range_counts = [count_range(byte_range) for (_, byte_range) in ranges]
 
+    for (side, (vocab_type, _)) in enumerate(sides):
+      side_counts = [counts for ((range_side, _), counts) in zip(ranges, range_counts) if range_side == side]
+      num_lines = sum(lines for (lines, _, _) in side_counts)
+      w2c = {} #temporarily holds words to count...
+      # bos and eos were the first words counted on every line, the merged dict has to see them first as well,
+      #   so that its iteration order (which breaks the ties when sorting by count) is the same
+      if num_lines > 0:
+        w2c[self.bos] = 0
+        w2c[self.eos] = 0
+      for (_, words, counts) in side_counts:
+        for word, count in itertools.izip(words, counts):
+          w2c[word] = w2c.get(word, 0) + count
+      if num_lines > 0:
+        w2c[self.bos] += num_lines
+        w2c[self.eos] += num_lines
+      self.add_vocab(vocab_type, w2c)
+
+  # assigns ids to the (at most self.limit) most frequent words of w2c
+  def add_vocab(self, vocab_type, w2c):
     if vocab_type == TARGET_TYPE:
         count_sorted = sorted(w2c.items(), key=operator.itemgetter(1), reverse=True) 
         for (w,c)  in count_sorted[:self.limit]:
@@ -113,16 +324,47 @@ class numberizer:
         self.s2i[self.unk] = self.v2i[vocab_type, self.unk]
         self.s2c[self.unk] = self.v2i[vocab_type, self.unk]
 
-  def numberize_sent(self,vocab_type, text_file):
-    n_sent = []
+  # the ids and the counts of the target words, as two aligned arrays
+  def target_counts(self):
+    if isinstance(self.t2c, vocab_map):
+      return np.array(self.t2i.values), np.array(self.t2c.values)
+    words = self.t2c.keys()
+    return np.array([self.t2i[w] for w in words], dtype='int64'), np.array([self.t2c[w] for w in words], dtype='int64')
+
+  # with flat=True, the numberized corpus is a ragged (see ragged.py) of int32 ids rather than a list of lists
+  def numberize_sent(self,vocab_type, text_file, flat=False):
     with codecs.open(text_file, 'r', 'utf8') as f:
-      for line in f:
-        # n = [self.v2i[vocab_type,w] for w in line.split()]
-        n = [self.v2i.get((vocab_type, w), self.v2i[vocab_type, self.unk]) for w in line.split()]
-        n = [self.v2i[vocab_type, self.bos]] + n + [self.v2i[vocab_type, self.eos]]
-        n_sent.append(n)
+      return self.numberize_lines(vocab_type, f, flat)
+
+  # same as numberize_sent, for any iterable of (unicode) lines, e.g. a line range of the corpus
+  def numberize_lines(self, vocab_type, lines, flat=False):
+    if flat:
+      return self.numberize_lines_flat(vocab_type, lines)
+    n_sent = []
+    for line in lines:
+      # n = [self.v2i[vocab_type,w] for w in line.split()]
+      n = [self.v2i.get((vocab_type, w), self.v2i[vocab_type, self.unk]) for w in line.split()]
+      n = [self.v2i[vocab_type, self.bos]] + n + [self.v2i[vocab_type, self.eos]]
+      n_sent.append(n)
     return n_sent
 
+  def numberize_lines_flat(self, vocab_type, lines):
+    # python arrays grow without any per-id object, and numpy takes them over without a copy
+    ids = array.array('i')
+    lengths = []
+    unk = self.v2i[vocab_type, self.unk]
+    bos = self.v2i[vocab_type, self.bos]
+    eos = self.v2i[vocab_type, self.eos]
+    for line in lines:
+      words = line.split()
+      ids.append(bos)
+      ids.extend([self.v2i.get((vocab_type, w), unk) for w in words])
+      ids.append(eos)
+      lengths.append(len(words) + 2)
+    offsets = np.zeros(len(lengths) + 1, dtype='int64')
+    offsets[1:] = np.cumsum(lengths)
+    return ragged(np.frombuffer(ids, dtype='int32'), offsets)
+
   # the three returned values are:
   # + numberized corpus
   # + a list of vocabulary: you can use it as an indexer -- 
@@ -0,0 +1,80 @@
+# prefetch -- prepare training batches in the background
+#
+# the training loops spend part of every step in python (slicing the batch, casting it, drawing the noise sample),
+#   while theano sits idle; prefetch runs the batch generator in a producer process (or thread)
+#   that stays up to size batches ahead of the training step, through a bounded queue
+
+import multiprocessing
+import numpy as np
+import os
+import Queue
+import threading
+import traceback
+
+# whether the consumer has stopped: it sets stop, or, for a producer process, it's gone (e.g. terminated) without setting it
+def _stopped(stop, parent):
+  return stop.is_set() or (parent is not None and os.getppid() != parent)
+
+# puts item in the queue unless the consumer stops first: a full queue is polled, so that the stop is seen
+def _put(queue, item, stop, parent):
+  while not _stopped(stop, parent):
+    try:
+      queue.put(item, timeout=0.1)
+      return True
+    except Queue.Full:
+      pass
+  return False
+
+def _produce(batches, queue, stop, parent=None):
+  try:
+    for batch in batches:
+      if not _put(queue, (True, batch), stop, parent):
+        return
+    _put(queue, (False, None), stop, parent)
+  except Exception:
+    _put(queue, (False, traceback.format_exc()), stop, parent)
+
+def _produce_in_process(batches, queue, stop, parent):
+  # the forked producer inherits the random state of the parent, which would then draw the same noise on every epoch
+  np.random.seed()
+  _produce(batches, queue, stop, parent)
+  if _stopped(stop, parent):
+    # the batches left in the queue won't be read, so don't wait for them to be flushed to the pipe before exiting
+    queue.cancel_join_thread()
+
+# iterates over batches (any iterable) with the next size batches prepared in the background
+#
+# batches are produced by a forked process by default and pickled through the queue;
+#   with process=False they are produced by a thread instead, which saves the pickling but only overlaps
+#   with the training step while the step releases the GIL, which compiled theano functions don't do
+# when the iteration stops early (break, exception), the producer is stopped rather than left blocked on the full queue
+# pass size=0 to iterate in the foreground
+def prefetch(batches, size=2, process=True):
+  if size <= 0:
+    for batch in batches:
+      yield batch
+    return
+
+  if process:
+    queue = multiprocessing.Queue(size)
+    stop = multiprocessing.Event()
+    producer = multiprocessing.Process(target=_produce_in_process, args=(batches, queue, stop, os.getpid()))
+  else:
+    queue = Queue.Queue(size)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce, args=(batches, queue, stop))
+  producer.daemon = True
+  producer.start()
+  try:
+    while True:
+      (more, batch) = queue.get()
+      if not more:
+        if batch is not None:
+          raise Exception("batch preparation failed:\n{0}".format(batch))
+        break
+      yield batch
+  finally:
+    stop.set()
+    producer.join(1.0)
+    if process and producer.is_alive():
+      producer.terminate()
@@ -0,0 +1,75 @@
+# ragged -- flat (CSR-style) storage of a corpus of variable-length sentences
+#
+# a list of python lists costs tens of bytes per token in object overhead;
+#   a ragged keeps all the rows back to back in one numpy array (values),
+#   with row i at values[offsets[i]: offsets[i + 1]]
+# values may have more than one dimension, e.g. the (source position, target position) links of an alignment
+
+import numpy as np
+
+class ragged:
+
+  def __init__(self, values, offsets):
+    self.values = values
+    self.offsets = offsets
+
+  # rows is a list of lists (or of sequences of tuples, for multi-dimensional values)
+  @staticmethod
+  def from_rows(rows, dtype, width=None):
+    offsets = np.zeros(len(rows) + 1, dtype='int64')
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    shape = (offsets[-1],) if width is None else (offsets[-1], width)
+    values = np.empty(shape, dtype=dtype)
+    for i, row in enumerate(rows):
+      if len(row) > 0:
+        values[offsets[i]: offsets[i + 1]] = row
+    return ragged(values, offsets)
+
+  # the rows of all the parts, one after the other
+  @staticmethod
+  def concatenate(parts):
+    offsets = [np.zeros(1, dtype='int64')]
+    for part in parts:
+      offsets.append(part.offsets[1:] - part.offsets[0] + offsets[-1][-1])
+    return ragged(np.concatenate([part.values[part.offsets[0]: part.offsets[-1]] for part in parts]), np.concatenate(offsets))
+
+  # the first n rows, sharing the values (no copy)
+  def head(self, n):
+    offsets = self.offsets[:n + 1]
+    return ragged(self.values[offsets[0]: offsets[-1]], offsets - offsets[0])
+
+  # the given rows, in the given order
+  def take(self, rows):
+    rows = np.asarray(rows, dtype='int64')
+    lengths = self.lengths()[rows]
+    offsets = np.zeros(len(rows) + 1, dtype='int64')
+    np.cumsum(lengths, out=offsets[1:])
+    # position in values of each value of the result
+    index = np.repeat(self.offsets[rows] - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return ragged(self.values[index], offsets)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.values[self.offsets[i]: self.offsets[i + 1]]
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def lengths(self):
+    return np.diff(self.offsets)
+
+  # row index of each value
+  def row_ids(self):
+    return np.repeat(np.arange(len(self)), self.lengths())
+
+  def save(self, prefix):
+    np.save(prefix + ".values.npy", self.values)
+    np.save(prefix + ".offsets.npy", self.offsets)
+
+  # mmap_mode='r' maps the arrays saved by save instead of reading them
+  @staticmethod
+  def load(prefix, mmap_mode=None):
+    return ragged(np.load(prefix + ".values.npy", mmap_mode=mmap_mode), np.load(prefix + ".offsets.npy", mmap_mode=mmap_mode))
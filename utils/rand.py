@@ -61,3 +61,42 @@ def accumulate_dist(dist):
 
   return cumulative_dist
 
+
+# draws integers from a fixed discrete distribution with the alias method (Walker 1977; Vose 1991)
+# 
+# unlike distint, the distribution is only processed once (in O(len(dist)) time) when the sampler is built,
+#   after which each sample costs O(1) and any number of them are drawn by a single numpy call
+# dist and low have the same meaning as in distint
+class distsampler:
+
+  def __init__(self, dist, low = 0):
+    dist = np.asarray(dist, dtype='float64')
+    if abs(1.0 - np.sum(dist)) > 1e-3:
+      raise Exception("distribution {0} not normalized!".format(dist))
+    self.low = low
+
+    # each of the len(dist) columns has a total mass of 1 / len(dist), which is split between
+    #   the integer of the column (with probability prob[i]) and its alias (with probability 1 - prob[i])
+    prob = (dist * len(dist) / np.sum(dist)).tolist()
+    alias = range(len(dist))
+    small = [i for i, p in enumerate(prob) if p < 1.0]
+    large = [i for i, p in enumerate(prob) if p >= 1.0]
+    while small and large:
+      s = small.pop()
+      l = large.pop()
+      alias[s] = l
+      prob[l] -= 1.0 - prob[s]
+      if prob[l] < 1.0:
+        small.append(l)
+      else:
+        large.append(l)
+    # whatever is left over is only off from 1.0 by float point error
+    for i in small + large:
+      prob[i] = 1.0
+    self.prob = np.array(prob)
+    self.alias = np.array(alias, dtype='int64')
+
+  # returns an int64 array of the given shape
+  def sample(self, size):
+    columns = np.random.randint(0, len(self.prob), size=size).astype('int64')
+    return np.where(random(size) < self.prob[columns], columns, self.alias[columns]) + self.low
@@ -0,0 +1,76 @@
+# textmatrix -- fast writer of the text format of the Moses (NPLM and NNJM) model files
+#
+# a model file is a sequence of strings (section headers, config...) and matrices, written with one row per line
+#   as tab-separated %.6f values, i.e. exactly what np.savetxt(fmt="%.6f", delimiter='\t') writes
+# formatting the numbers is by far the slowest part, so the rows of the matrices are cut into blocks
+#   that a pool of processes formats, while the main process writes the formatted blocks to the file in order
+
+import collections
+import multiprocessing
+import numpy as np
+
+# rows are formatted this many values at a time
+BLOCK_VALUES = 1 << 18
+
+# the items of write_items, read by the processes of its pool, which are forked after it's set
+items = None
+
+# the text of the rows start to stop of a 2-D (or 1-D, one value per row) array
+def format_rows(m, start, stop):
+  if m.ndim == 1:
+    m = m.reshape(-1, 1)
+  block = m[start: stop]
+  row_format = "\t".join(["%.6f"] * m.shape[1]) + "\n"
+  # one % over the whole block is several times faster than np.savetxt's one per row, and gives the same text
+  return (row_format * len(block)) % tuple(block.ravel().tolist())
+
+def format_block(block):
+  (item, start, stop) = block
+  return format_rows(items[item], start, stop)
+
+# the (item, start, stop) row blocks of the arrays among items, and the strings among them as they are
+def cut_blocks(items):
+  for (i, item) in enumerate(items):
+    if isinstance(item, basestring):
+      yield item
+    else:
+      rows = len(item)
+      row_values = max(item[0].size, 1) if rows > 0 else 1
+      block_rows = max(BLOCK_VALUES // row_values, 1)
+      for start in range(0, rows, block_rows):
+        yield (i, start, min(start + block_rows, rows))
+
+# writes items to model_file in order: strings as they are and arrays as matrices
+# with processes > 1, the matrices are formatted by a pool of that many processes,
+#   and at most a few blocks per process are formatted ahead of the one being written
+def write_items(model_file, item_list, processes=1):
+  global items
+  items = item_list
+  try:
+    if processes <= 1:
+      for block in cut_blocks(items):
+        model_file.write(block if isinstance(block, basestring) else format_block(block))
+      return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+      pending = collections.deque()
+      for block in cut_blocks(items):
+        pending.append(block if isinstance(block, basestring) else pool.apply_async(format_block, (block,)))
+        while len(pending) > 2 * processes:
+          write_pending(model_file, pending)
+      while pending:
+        write_pending(model_file, pending)
+    finally:
+      pool.close()
+      pool.join()
+  finally:
+    items = None
+
+def write_pending(model_file, pending):
+  block = pending.popleft()
+  model_file.write(block if isinstance(block, basestring) else block.get())
+
+# a single matrix, as np.savetxt(model_file, m, fmt="%.6f", delimiter='\t')
+def dump_matrix(m, model_file, processes=1):
+  write_items(model_file, [np.asarray(m)], processes)